@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import argparse
+from upgraider.Model import parse_model_response, RESPONSE_CACHE_SIZE
+from upgraider.Report import UpdateStatus
+from upgraider.Cache import PersistentCache
+from apiexploration.Library import CodeSnippet
+from benchmark import legacy_response_parser
+from benchmark.response_corpus import build_corpus, library_examples, archived_reports
+
+
+def parsed_fields(model_response) -> tuple:
+    return (
+        model_response.update_status,
+        model_response.updated_code.code,
+        model_response.reason,
+        model_response.references,
+    )
+
+
+def find_mismatches(corpus: list[tuple[str, CodeSnippet]]) -> list[tuple[str, tuple, tuple]]:
+    """
+    Responses that parse_model_response and the legacy parser disagree on,
+    with the fields each of them found.
+    """
+    mismatches = []
+    for response, original_code in corpus:
+        expected = parsed_fields(legacy_response_parser.parse_model_response(response, original_code))
+        actual = parsed_fields(parse_model_response(response, original_code))
+        if expected != actual:
+            mismatches.append((response, expected, actual))
+    return mismatches
+
+
+def responses_per_second(parse, corpus: list[tuple[str, CodeSnippet]], repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for response, original_code in corpus:
+            parse(response, original_code)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(corpus) / best
+
+
+def rescore_report(report_path: str, dry_run: bool) -> tuple[int, int]:
+    """
+    Parses all model responses of a run_experiment report again and updates
+    the parsed fields and counts that depend on them. Fix statuses would
+    need the code to be run again, so they are kept. Returns the number of
+    responses and of responses whose parsed fields changed.
+    """
+    with open(report_path, "r", encoding="utf-8") as f:
+        report = json.load(f)
+
+    num_changed = 0
+    for snippet in report["snippets"].values():
+        model_response = snippet["model_response"]
+        parsed = parse_model_response(
+            model_response["raw_response"],
+            CodeSnippet(code=model_response["original_code"]["code"]),
+        )
+        rescored = {
+            "update_status": parsed.update_status.value,
+            "reason": parsed.reason,
+            "references": parsed.references,
+        }
+        if any(model_response[field] != value for field, value in rescored.items()):
+            num_changed += 1
+            model_response.update(rescored)
+
+    updated = [
+        s["model_response"]
+        for s in report["snippets"].values()
+        if s["model_response"]["update_status"] == UpdateStatus.UPDATE.value
+    ]
+    report["num_updated"] = len(updated)
+    report["num_updated_w_refs"] = len(
+        [
+            model_response
+            for model_response in updated
+            if model_response["references"] is not None
+            and "No references used" not in model_response["references"]
+        ]
+    )
+
+    if num_changed > 0 and not dry_run:
+        with open(report_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=4)
+
+    return len(report["snippets"]), num_changed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Check the response parser against the legacy parser and benchmark both, or re-score archived experiment outputs"
+    )
+    parser.add_argument("--synthetic", type=int, help="Number of synthetic responses", default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, help="Timed passes over the corpus (best is reported)", default=3)
+    parser.add_argument(
+        "--responseCache",
+        action="store_true",
+        help="Add the model responses recorded in the response cache to the corpus",
+    )
+    parser.add_argument(
+        "--outputDir",
+        type=str,
+        help="Folder of run_experiment outputs whose responses are added to the corpus",
+        default=None,
+    )
+    parser.add_argument(
+        "--rescore",
+        action="store_true",
+        help="Parse the responses of all reports under --outputDir again and update the reports",
+    )
+    parser.add_argument("--dryRun", action="store_true", help="With --rescore, only count the changes")
+    args = parser.parse_args()
+
+    if args.rescore:
+        if args.outputDir is None:
+            parser.error("--rescore requires --outputDir")
+
+        start = time.perf_counter()
+        total_responses = 0
+        total_changed = 0
+        for report_path in archived_reports(args.outputDir):
+            num_responses, num_changed = rescore_report(report_path, dry_run=args.dryRun)
+            total_responses += num_responses
+            total_changed += num_changed
+            if num_changed > 0:
+                print(f"{os.path.relpath(report_path, args.outputDir)}: {num_changed} of {num_responses} responses parse differently")
+        print(
+            f"Re-scored {total_responses} responses in {time.perf_counter() - start:.2f}s, "
+            f"{total_changed} changed{' (dry run)' if args.dryRun else ''}"
+        )
+    else:
+        corpus = build_corpus(
+            args.synthetic,
+            seed=args.seed,
+            examples=library_examples(),
+            # only read from, so no entries are ever evicted
+            cache=PersistentCache("responses", RESPONSE_CACHE_SIZE) if args.responseCache else None,
+            output_dir=args.outputDir,
+        )
+
+        mismatches = find_mismatches(corpus)
+        print(f"# Response parsing over {len(corpus)} responses")
+        print(f"Parsed differently from the legacy parser: {len(mismatches)}")
+        for response, expected, actual in mismatches[:5]:
+            print(f"{response!r}\n  legacy: {expected}\n  parser: {actual}")
+
+        print("Parser | Responses/s |")
+        print("-------|------------:|")
+        for name, parse in [
+            ("legacy", legacy_response_parser.parse_model_response),
+            ("single pass", parse_model_response),
+        ]:
+            print(f"{name} | {responses_per_second(parse, corpus, args.repeat):,.0f} |")
@@ -0,0 +1,207 @@
+import os
+import json
+import random
+from upgraider.Cache import PersistentCache
+from apiexploration.Library import CodeSnippet
+from benchmark.list_libraries import list_libraries
+
+ORIGINAL_CODE = "import pandas as pd\n\ndf = pd.DataFrame({'a': [1, 2]})\nprint(df.append(df))"
+UPDATED_CODE = "import pandas as pd\n\ndf = pd.DataFrame({'a': [1, 2]})\nprint(pd.concat([df, df]))"
+
+# responses the parser has had to deal with, from tests/test_Model.py
+EDGE_CASES = [
+    "\n1. ```The full updated code snippet in a fenced code block```\n```python\n\nG = nx.from_numpy_array(A)\nprint(G.edges)\n\n```\n\n2. Some explation\n\n3. No references used\n",
+    "\n1. \n```python\n\nimport numpy as np\nfrom scipy.optimize import minimize\n\ndef rosen(x):\n    return sum(100.0*(x[1:]-x[:-1]**2.0)**2.0 + (1-x[:-1])**2.0)\n\n```\n\n2. No updates needed.\n3. No references used\n    ",
+    "No references used",
+    '\n1. ```\nimport numpy as np\n\nimport pandas as pd\n\ncat = pd.Categorical(["a", "b", "c", "a"], ordered=True)\ndense_cat = np.asarray(cat)\nprint(dense_cat)\n```\n2. The method Categorical.to_dense() has been deprecated and replaced with np.asarray(cat).\n3. 32639\n    ',
+    "\nNo references used\n    ",
+    "\n    No updates needed.\nReason: The code is using valid and up-to-date numpy APIs to create an array and sort it. No deprecated or non-existent APIs are being used.\nReferences used: No references used.\n",
+    "\nPossible response:\n\n```\nsome code\n```\n\nReason for update: Here is the model's reason.\n\nList of reference numbers used: 3\n",
+    "\nPossible response:\n\n```\nsome code\n```\n\n2. Here is the model's reason.\n3. 3\n",
+    "\n```\nsome code\n```\n\n- Reason for update: None\n- List of reference numbers used: No references used\n",
+    "\nPossible response:\n\n```\n# No changes needed\nimport pandas as pd\nsome code\n```\n\n- Reason for update: None\n- List of reference numbers used: No references used\n",
+    "\n```\nsome code\n```\n\nReason for update:\n\n- reason 1\n- reason 2\n\nList of reference numbers used:\n\n- 6\n",
+]
+
+PREAMBLES = [
+    "",
+    "\n",
+    "Possible response:\n\n",
+    "Sure! Here is the updated code:\n",
+    "The code uses a deprecated API.\n\n",
+    "   ",
+]
+CODE_BLOCKS = [
+    "1. ```python\n{code}\n```\n",
+    "1. ```{code}```\n",
+    "1. \n```python\n{code}\n```\n",
+    "1. ```The full updated code snippet in a fenced code block```\n```python\n{code}\n```\n",
+    "```\n{code}\n```\n\n",
+    "```python\n{code}\n```\n",
+    "```markdown\n{code}\n```\n",
+    "1. ```\n```\n",
+    "1. ``````\n",
+    "1. ```python\n# No changes needed\n{code}\n```\n",
+    "1. ```python\n{code}\n",
+    "1. No update needed.\n",
+    "The code does not need to be updated.\n",
+    "",
+]
+REASONS = [
+    "2. {reason}\n",
+    "2. Reason for update: {reason}\n",
+    "2.Reason for update:{reason}\n",
+    "2. None\n",
+    "2.\n",
+    "Reason for update: {reason}\n",
+    "Reason for update: {reason} Reason for update: again\n",
+    "- Reason for update: None\n",
+    "Reason for update:\n\n- {reason}\n- {reason} too\n\n",
+    "Reason for update:\n- {reason}\n",
+    "Reason for update:   \n- {reason}\n",
+    "Reason: {reason}\n",
+    "",
+]
+REFERENCES = [
+    "3. {references}\n",
+    "3. {references}",
+    "3. No references used\n",
+    "3.\n",
+    "References used: {references}\n",
+    "Reference used: {references}. Reference used: again\n",
+    "Reference number: {references}\n",
+    "Reference numbers used: {references}\n",
+    "List of reference numbers used: No references used.\n",
+    "List of reference numbers used:\n\n- {references}\n",
+    "",
+]
+EPILOGUES = [
+    "",
+    "\n",
+    "    ",
+    "\nExplanation: `append` was removed in pandas 2.0; use `pd.concat` instead.\n",
+    "\nFor example:\n```python\nprint(pd.concat([df, df], ignore_index=True))\n```\n",
+    "\nNo update of the imports is needed.\n",
+    "\n2. Another second item\n3. Another third item\n",
+]
+REASON_TEXTS = [
+    "DataFrame.append was removed in pandas 2.0, use pd.concat instead.",
+    "None",
+    "The API is deprecated.",
+]
+REFERENCE_TEXTS = ["1", "1, 3", "2.", "No references used", "None"]
+
+
+def library_examples() -> list[str]:
+    """
+    The code of the examples of all libraries.
+    """
+    examples = []
+    for library in list_libraries():
+        examples_path = os.path.join(library.path, "examples")
+        if not os.path.exists(examples_path):
+            continue
+        for example_file in sorted(os.listdir(examples_path)):
+            if example_file.startswith("."):
+                continue
+            with open(os.path.join(examples_path, example_file), "r", encoding="utf-8") as f:
+                examples.append(f.read())
+    return examples
+
+
+def synthetic_responses(
+    num_responses: int, seed: int = 0, examples: list[str] = None
+) -> list[tuple[str, CodeSnippet]]:
+    """
+    Responses assembled from the formats (and mistakes) seen in model
+    answers, each with the original code it answers about. The code comes
+    from `examples`, answered either unchanged or with an edit.
+    """
+    if examples is None:
+        examples = [ORIGINAL_CODE]
+    rng = random.Random(seed)
+    responses = []
+
+    for _ in range(num_responses):
+        original_code = rng.choice(examples)
+        code = rng.choice(
+            [original_code, original_code.replace("(", "( ", 1), UPDATED_CODE, "x = 1", ""]
+        )
+        parts = [
+            rng.choice(PREAMBLES),
+            rng.choice(CODE_BLOCKS).format(code=code),
+            rng.choice(REASONS).format(reason=rng.choice(REASON_TEXTS)),
+            rng.choice(REFERENCES).format(references=rng.choice(REFERENCE_TEXTS)),
+            rng.choice(EPILOGUES),
+        ]
+        if rng.random() < 0.2:
+            # items out of order or missing
+            rng.shuffle(parts)
+        response = "".join(parts)
+        if rng.random() < 0.1:
+            response = response.replace("\n", "\r\n")
+        responses.append((response, CodeSnippet(code=original_code)))
+
+    return responses
+
+
+def recorded_responses(cache: PersistentCache) -> list[tuple[str, CodeSnippet]]:
+    """
+    The model responses recorded in the response cache. Only the responses
+    are stored, so they are all paired with the same original code.
+    """
+    return [
+        (value.decode("utf-8"), CodeSnippet(code=ORIGINAL_CODE))
+        for value in cache.values()
+    ]
+
+
+def archived_reports(output_dir: str) -> list[str]:
+    """
+    Paths of the report.json files written by run_experiment under output_dir.
+    """
+    return sorted(
+        os.path.join(root, "report.json")
+        for root, _, files in os.walk(output_dir)
+        if "report.json" in files
+    )
+
+
+def archived_responses(output_dir: str) -> list[tuple[str, CodeSnippet]]:
+    """
+    The model responses of all experiment reports under output_dir, with the
+    original code of their snippet.
+    """
+    responses = []
+    for report_path in archived_reports(output_dir):
+        with open(report_path, "r", encoding="utf-8") as f:
+            report = json.load(f)
+        for snippet in report["snippets"].values():
+            model_response = snippet["model_response"]
+            responses.append(
+                (
+                    model_response["raw_response"],
+                    CodeSnippet(code=model_response["original_code"]["code"]),
+                )
+            )
+    return responses
+
+
+def build_corpus(
+    num_synthetic: int,
+    seed: int = 0,
+    examples: list[str] = None,
+    cache: PersistentCache = None,
+    output_dir: str = None,
+) -> list[tuple[str, CodeSnippet]]:
+    """
+    The edge cases, num_synthetic synthetic responses, and the recorded and
+    archived responses when a response cache or an output folder is given.
+    """
+    corpus = [(response, CodeSnippet(code=ORIGINAL_CODE)) for response in EDGE_CASES]
+    corpus += synthetic_responses(num_synthetic, seed, examples)
+    if cache is not None:
+        corpus += recorded_responses(cache)
+    if output_dir is not None:
+        corpus += archived_responses(output_dir)
+    return corpus
@@ -0,0 +1,63 @@
+import argparse
+import numpy as np
+from upgraider.Database import get_embedding_index, get_quantized_index, get_ivf_index
+from upgraider.EmbeddingIndex import ranking_recall
+
+
+def sample_queries(matrix: np.ndarray, num_queries: int, noise: float, seed: int):
+    """
+    Uses perturbed release note embeddings as stand-ins for snippet embeddings,
+    so the report needs no embedding API calls.
+    """
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(matrix), min(num_queries, len(matrix)), replace=False)
+    queries = np.asarray(matrix[np.sort(rows)], dtype=np.float32)
+    queries = queries + rng.normal(scale=noise, size=queries.shape).astype(np.float32)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def same_order(exact, approximate):
+    return np.mean(
+        [
+            [i for _, i in exact_result] == [i for _, i in approximate_result]
+            for exact_result, approximate_result in zip(exact, approximate)
+        ]
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Report the recall of approximate retrieval against exact ranking"
+    )
+    parser.add_argument("--queries", type=int, help="Number of sampled queries", default=200)
+    parser.add_argument("--k", type=int, help="Number of sections retrieved", default=10)
+    parser.add_argument("--noise", type=float, help="Noise added to sampled queries", default=0.02)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    index = get_embedding_index()
+    queries = sample_queries(index.matrix, args.queries, args.noise, args.seed)
+    exact = index.top_k(queries, k=args.k)
+
+    print(f"# Retrieval recall@{args.k} over {len(queries)} queries, {len(index)} sections")
+    print("Method | Matrix size | Recall | Same ranking |")
+    print("-------|------------:|-------:|-------------:|")
+    print(f"exact float32 | {index.matrix.nbytes / 2**20:.1f} MB | 100.00% | 100.00% |")
+
+    for dtype in ["float16", "int8"]:
+        quantized_index = get_quantized_index(dtype)
+        approximate = quantized_index.top_k(queries, k=args.k)
+        print(
+            f"{dtype} + re-scoring | {quantized_index.quantized.nbytes / 2**20:.1f} MB "
+            f"| {ranking_recall(exact, approximate) * 100:.2f}% "
+            f"| {same_order(exact, approximate) * 100:.2f}% |"
+        )
+
+    ivf_index = get_ivf_index()
+    for nprobe in [1, 4, 8, 16]:
+        approximate = ivf_index.search(index, queries, k=args.k, nprobe=nprobe)
+        print(
+            f"ivf nlist={ivf_index.nlist} nprobe={nprobe} | -- "
+            f"| {ranking_recall(exact, approximate) * 100:.2f}% "
+            f"| {same_order(exact, approximate) * 100:.2f}% |"
+        )
@@ -0,0 +1,142 @@
+import ast
+import re
+
+# class given to the nodes of :meth:, :func:, :class: and :attr: roles so the
+# referenced API symbols can be told apart from plain emphasis
+API_SYMBOL_CLASS = "api-symbol"
+
+# a ``literal`` naming an API, e.g. ``from_numpy_array``, ``Index.is_mixed()``
+# or an argument such as ``na_sentinel=None``
+_LITERAL_SYMBOL = re.compile(r"^~?([A-Za-z_][\w.]*)(\(\))?(=.*)?$")
+
+MIN_SYMBOL_LEN = 3
+# names mentioned by more sections than this (e.g. "append") are too generic
+# for a lookup hit to mean anything
+MAX_SECTIONS_PER_SYMBOL = 20
+
+
+def normalize_symbol(text: str) -> str | None:
+    """
+    Turns the text of an API role or literal into a dotted name, e.g.
+    "~pandas.Index.is_mixed" -> "pandas.Index.is_mixed",
+    "title <pandas.Bar>" -> "pandas.Bar", "na_sentinel=None" -> "na_sentinel".
+    """
+    text = text.strip()
+    target = re.search(r"<(.*)>$", text)
+    if target is not None:
+        text = target.group(1)
+
+    match = _LITERAL_SYMBOL.match(text.lstrip("!"))
+    if match is None:
+        return None
+
+    symbol = match.group(1).strip(".")
+    if len(symbol.split(".")[-1]) < MIN_SYMBOL_LEN:
+        return None
+    return symbol
+
+
+def symbol_keys(symbol: str) -> list[str]:
+    """
+    Returns all dotted suffixes of a symbol, most qualified first:
+    "pandas.Index.is_mixed" -> ["pandas.Index.is_mixed", "Index.is_mixed", "is_mixed"].
+    """
+    parts = symbol.split(".")
+    return [".".join(parts[i:]) for i in range(len(parts))]
+
+
+def code_symbols(code: str) -> set[str]:
+    """
+    Returns the API names used by a code snippet: attribute chains
+    ("nx.from_numpy_matrix"), called names, keyword arguments and imported
+    names. Returns an empty set if the code does not parse.
+    """
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return set()
+
+    symbols = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute):
+            chain = _attribute_chain(node)
+            symbols.update(symbol_keys(chain))
+        elif isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Name):
+                symbols.add(node.func.id)
+            symbols.update(kw.arg for kw in node.keywords if kw.arg is not None)
+        elif isinstance(node, ast.ImportFrom):
+            symbols.update(alias.name for alias in node.names)
+            if node.module is not None:
+                symbols.update(f"{node.module}.{alias.name}" for alias in node.names)
+
+    return {symbol for symbol in symbols if len(symbol.split(".")[-1]) >= MIN_SYMBOL_LEN}
+
+
+def _attribute_chain(node: ast.Attribute) -> str:
+    # idx.str.cat -> "idx.str.cat"; chains through calls keep the attribute
+    # names only, e.g. pd.Index(x).is_mixed -> "is_mixed"
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if isinstance(node, ast.Name):
+        parts.append(node.id)
+    return ".".join(reversed(parts))
+
+
+class SymbolIndex:
+    """
+    Maps every dotted suffix of the API symbols mentioned in release note
+    sections to those sections. `release_notes` maps section ids to the ids
+    of the release notes they appear in, for library scoping; `stamp` identifies the DB state the
+    index was built from.
+    """
+
+    def __init__(
+        self,
+        symbols: dict[str, list[int]],
+        release_notes: dict[int, list[int]] = None,
+    ):
+        self.symbols = symbols
+        self.release_notes = release_notes if release_notes is not None else {}
+        self.stamp = None
+
+    @classmethod
+    def build(
+        cls, section_symbols: list[tuple[int, str]], release_notes: dict[int, list[int]] = None
+    ) -> "SymbolIndex":
+        symbols = {}
+        for section_id, symbol in section_symbols:
+            for key in symbol_keys(symbol):
+                sections = symbols.setdefault(key, [])
+                if section_id not in sections:
+                    sections.append(section_id)
+        return cls(symbols, release_notes)
+
+    def lookup(self, code: str, note_ids: list[int] = None) -> list[(float, int)]:
+        """
+        Returns the sections mentioning symbols used in the code as
+        (score, section id), best first. A match on a qualified name
+        ("Index.is_mixed") scores higher than one on a bare name ("is_mixed").
+        """
+        allowed_notes = set(note_ids) if note_ids is not None else None
+        scores = {}
+
+        for symbol in code_symbols(code):
+            weight = len(symbol.split("."))
+            sections = self.symbols.get(symbol, [])
+            if len(sections) > MAX_SECTIONS_PER_SYMBOL:
+                continue
+
+            for section_id in sections:
+                if allowed_notes is not None and allowed_notes.isdisjoint(
+                    self.release_notes.get(section_id, [])
+                ):
+                    continue
+                scores[section_id] = scores.get(section_id, 0) + weight
+
+        return sorted(
+            ((float(score), section_id) for section_id, score in scores.items()),
+            key=lambda item: (-item[0], item[1]),
+        )
@@ -0,0 +1,189 @@
+import numpy as np
+import re
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text: str) -> list[str]:
+    """
+    Splits text (prose or code) into lowercase terms. Identifiers are kept
+    whole and also split on underscores, so `is_mixed` matches both
+    `is_mixed` and `mixed`.
+    """
+    terms = []
+    for identifier in re.findall(r"[A-Za-z_][A-Za-z0-9_]*", text):
+        identifier = identifier.lower()
+        terms.append(identifier)
+        parts = [part for part in identifier.split("_") if part]
+        if len(parts) > 1:
+            terms.extend(parts)
+    return terms
+
+
+class BM25Index:
+    """
+    Inverted index over the release note sections, scored with BM25. The
+    postings of term t are rows[offsets[t] : offsets[t + 1]] with their
+    precomputed BM25 weights, so a query only sums the weights of its terms.
+    `note_links` holds a (row, release note id) pair for every release note a
+    section appears in.
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        note_links: np.ndarray,
+        vocabulary: list[str],
+        offsets: np.ndarray,
+        rows: np.ndarray,
+        weights: np.ndarray,
+    ):
+        self.ids = ids
+        self.note_links = note_links
+        self.terms = {term: t for t, term in enumerate(vocabulary)}
+        self.offsets = offsets
+        self.rows = rows
+        self.weights = weights
+        self._masks = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(
+        cls,
+        ids: list[int],
+        texts: list[str],
+        release_notes: list[list[int]] = None,
+        k1: float = BM25_K1,
+        b: float = BM25_B,
+    ) -> "BM25Index":
+        postings = {}
+        doc_lengths = np.zeros(len(texts), dtype=np.float32)
+
+        for row, text in enumerate(texts):
+            terms = tokenize(text)
+            doc_lengths[row] = len(terms)
+            for term in terms:
+                term_rows = postings.setdefault(term, {})
+                term_rows[row] = term_rows.get(row, 0) + 1
+
+        avg_length = doc_lengths.mean() if len(texts) else 0.0
+        vocabulary = sorted(postings)
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        all_rows = []
+        all_weights = []
+
+        for t, term in enumerate(vocabulary):
+            term_rows = np.fromiter(postings[term].keys(), dtype=np.int64)
+            frequencies = np.fromiter(postings[term].values(), dtype=np.float32)
+            idf = np.log(1 + (len(texts) - len(term_rows) + 0.5) / (len(term_rows) + 0.5))
+            length_norm = 1 - b + b * doc_lengths[term_rows] / avg_length
+            all_rows.append(term_rows)
+            all_weights.append(
+                idf * frequencies * (k1 + 1) / (frequencies + k1 * length_norm)
+            )
+            offsets[t + 1] = offsets[t] + len(term_rows)
+
+        if release_notes is None:
+            release_notes = [[] for _ in ids]
+        note_links = [
+            (row, note_id) for row, note_ids in enumerate(release_notes) for note_id in note_ids
+        ]
+
+        return cls(
+            np.asarray(ids, dtype=np.int64),
+            np.array(note_links, dtype=np.int64).reshape(-1, 2),
+            vocabulary,
+            offsets,
+            np.concatenate(all_rows) if all_rows else np.array([], dtype=np.int64),
+            np.concatenate(all_weights).astype(np.float32)
+            if all_weights
+            else np.array([], dtype=np.float32),
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with np.load(path) as data:
+            if "note_links" in data:
+                note_links = data["note_links"]
+            else:
+                # saved with one release note per section
+                note_links = np.column_stack((np.arange(len(data["ids"])), data["release_notes"]))
+            return cls(
+                data["ids"],
+                note_links,
+                data["vocabulary"].tolist(),
+                data["offsets"],
+                data["rows"],
+                data["weights"],
+            )
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                ids=self.ids,
+                note_links=self.note_links,
+                vocabulary=np.array(list(self.terms), dtype=str),
+                offsets=self.offsets,
+                rows=self.rows,
+                weights=self.weights,
+            )
+
+    def search(
+        self, query: str, k: int = None, note_ids: list[int] = None
+    ) -> list[(float, int)]:
+        """
+        Returns the k best matching sections as (BM25 score, section id), best
+        first. Sections that share no term with the query are not returned.
+        With note_ids, only sections appearing in those release notes are
+        considered.
+        """
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term in set(tokenize(query)):
+            t = self.terms.get(term)
+            if t is None:
+                continue
+            start, end = self.offsets[t], self.offsets[t + 1]
+            scores[self.rows[start:end]] += self.weights[start:end]
+
+        if note_ids is not None:
+            scores[~self._mask(note_ids)] = 0
+
+        candidates = np.flatnonzero(scores > 0)
+        if k is not None and k < len(candidates):
+            kept = np.argpartition(-scores[candidates], k - 1)[:k]
+            candidates = candidates[kept]
+
+        ranked = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(float(scores[row]), int(self.ids[row])) for row in ranked]
+
+    def _mask(self, note_ids: list[int]) -> np.ndarray:
+        key = tuple(sorted(note_ids))
+        if key not in self._masks:
+            mask = np.zeros(len(self), dtype=bool)
+            mask[self.note_links[np.isin(self.note_links[:, 1], key), 0]] = True
+            self._masks[key] = mask
+        return self._masks[key]
+
+
+def reciprocal_rank_fusion(
+    rankings: list[list[(float, int)]], k: int = None, rank_constant: int = 60
+) -> list[(float, int)]:
+    """
+    Merges several (score, section id) rankings into one, scoring each section
+    by the sum of 1 / (rank_constant + rank) over the rankings it appears in.
+    """
+    fused = {}
+    for ranking in rankings:
+        for rank, (_, section_id) in enumerate(ranking, start=1):
+            fused[section_id] = fused.get(section_id, 0.0) + 1 / (rank_constant + rank)
+
+    ranked = sorted(
+        ((score, section_id) for section_id, score in fused.items()),
+        key=lambda item: item[0],
+        reverse=True,
+    )
+    return ranked[:k] if k is not None else ranked
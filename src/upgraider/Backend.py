@@ -0,0 +1,300 @@
+import openai
+import json
+import asyncio
+import contextlib
+import requests
+import aiohttp
+from os import environ as env
+from dotenv import load_dotenv
+from upgraider.Cache import content_key
+
+load_dotenv(override=True)
+
+REQUEST_TIMEOUT = 600
+
+
+def chat_request_key(
+    model: str, messages: list[dict], params: dict, backend: str = None
+) -> str:
+    """
+    Identifies a chat request, for recording its response. `backend` is the
+    identity of the backend answering it, if not the OpenAI API.
+    """
+    parts = [model, json.dumps(params, sort_keys=True), json.dumps(messages)]
+    if backend is not None:
+        parts.append(backend)
+    return content_key(*parts)
+
+
+class Backend:
+    """
+    Chat and embedding endpoints used by Model and promptCrafting. Responses
+    have the shape of OpenAI API responses, and failures raise the
+    `openai.error` exceptions, whatever serves the requests.
+    """
+
+    # called with the headers of every response, where the backend sees them
+    header_listener = None
+
+    @property
+    def identity(self) -> str | None:
+        """
+        Tells the answers of this backend apart from others' in the response
+        and embedding caches. None for the OpenAI API, whose answers were
+        recorded before backends existed.
+        """
+        return type(self).__name__
+
+    def _observe_headers(self, headers):
+        if self.header_listener is not None:
+            self.header_listener(headers)
+
+    def chat(self, messages: list[dict], model: str, **params) -> dict:
+        raise NotImplementedError
+
+    async def achat(self, messages: list[dict], model: str, **params) -> dict:
+        raise NotImplementedError
+
+    async def achat_stream(self, messages: list[dict], model: str, **params):
+        """
+        Yields the text of the answer as it is generated. Closing the
+        generator early stops the generation. Backends that cannot stream
+        yield the whole answer at once.
+        """
+        response = await self.achat(messages, model, **params)
+        yield response["choices"][0]["message"]["content"]
+
+    def embed(self, input: str | list[str], model: str) -> dict:
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        return {}
+
+
+class OpenAIBackend(Backend):
+    """
+    The OpenAI API, through the `openai` module. The key defaults to the
+    OPENAI_API_KEY environment variable.
+    """
+
+    def __init__(self, api_key: str = None):
+        self.api_key = api_key
+
+    @property
+    def identity(self) -> str | None:
+        return None
+
+    def _authenticate(self):
+        openai.api_key = self.api_key or env["OPENAI_API_KEY"]
+
+    def chat(self, messages: list[dict], model: str, **params) -> dict:
+        self._authenticate()
+        return openai.ChatCompletion.create(messages=messages, model=model, **params)
+
+    async def achat(self, messages: list[dict], model: str, **params) -> dict:
+        self._authenticate()
+        return await openai.ChatCompletion.acreate(messages=messages, model=model, **params)
+
+    async def achat_stream(self, messages: list[dict], model: str, **params):
+        self._authenticate()
+        chunks = await openai.ChatCompletion.acreate(
+            messages=messages, model=model, stream=True, **params
+        )
+        try:
+            async for chunk in chunks:
+                content = chunk["choices"][0]["delta"].get("content")
+                if content:
+                    yield content
+        finally:
+            await chunks.aclose()
+
+    def embed(self, input: str | list[str], model: str) -> dict:
+        self._authenticate()
+        return openai.Embedding.create(model=model, input=input)
+
+
+def _api_error(status: int, body: str, headers: dict) -> openai.error.OpenAIError:
+    try:
+        message = json.loads(body)["error"]["message"]
+    except (ValueError, KeyError, TypeError):
+        message = body
+
+    error_args = {"http_body": body, "http_status": status, "headers": dict(headers)}
+    if status == 429:
+        return openai.error.RateLimitError(message, **error_args)
+    if status in (400, 404, 409, 422):
+        return openai.error.InvalidRequestError(message, None, **error_args)
+    if status in (401, 403):
+        return openai.error.AuthenticationError(message, **error_args)
+    if status == 503:
+        return openai.error.ServiceUnavailableError(message, **error_args)
+    return openai.error.APIError(message, **error_args)
+
+
+class OpenAICompatibleBackend(Backend):
+    """
+    Any server implementing the OpenAI chat completions and embeddings
+    endpoints under `api_base` (e.g. "http://localhost:8000/v1").
+    """
+
+    def __init__(self, api_base: str, api_key: str = None, timeout: float = REQUEST_TIMEOUT):
+        self.api_base = api_base.rstrip("/")
+        self.api_key = api_key
+        self.timeout = timeout
+
+    @property
+    def identity(self) -> str | None:
+        return f"{type(self).__name__} {self.api_base}"
+
+    def _headers(self) -> dict:
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = f"Bearer {self.api_key}"
+        return headers
+
+    def _post(self, endpoint: str, payload: dict) -> dict:
+        try:
+            response = requests.post(
+                f"{self.api_base}/{endpoint}",
+                json=payload,
+                headers=self._headers(),
+                timeout=self.timeout,
+            )
+        except requests.RequestException as e:
+            raise openai.error.APIConnectionError(str(e))
+
+        self._observe_headers(response.headers)
+        if response.status_code != 200:
+            raise _api_error(response.status_code, response.text, response.headers)
+        return response.json()
+
+    async def _apost(self, endpoint: str, payload: dict) -> dict:
+        try:
+            async with aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            ) as session:
+                async with session.post(
+                    f"{self.api_base}/{endpoint}", json=payload, headers=self._headers()
+                ) as response:
+                    body = await response.text()
+                    self._observe_headers(response.headers)
+                    if response.status != 200:
+                        raise _api_error(response.status, body, response.headers)
+                    return json.loads(body)
+        except aiohttp.ClientError as e:
+            raise openai.error.APIConnectionError(str(e))
+        except asyncio.TimeoutError:
+            raise openai.error.Timeout(f"Request timed out after {self.timeout} seconds")
+
+    async def _astream(self, endpoint: str, payload: dict):
+        try:
+            async with aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            ) as session:
+                async with session.post(
+                    f"{self.api_base}/{endpoint}",
+                    json={**payload, "stream": True},
+                    headers=self._headers(),
+                ) as response:
+                    self._observe_headers(response.headers)
+                    if response.status != 200:
+                        body = await response.text()
+                        raise _api_error(response.status, body, response.headers)
+
+                    # server-sent events, one chunk of the answer per "data:" line
+                    async for line in response.content:
+                        line = line.decode("utf-8").strip()
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[len("data:") :].strip()
+                        if data == "[DONE]":
+                            break
+                        content = json.loads(data)["choices"][0]["delta"].get("content")
+                        if content:
+                            yield content
+        except aiohttp.ClientError as e:
+            raise openai.error.APIConnectionError(str(e))
+        except asyncio.TimeoutError:
+            raise openai.error.Timeout(f"Request timed out after {self.timeout} seconds")
+
+    def chat(self, messages: list[dict], model: str, **params) -> dict:
+        return self._post("chat/completions", {"model": model, "messages": messages, **params})
+
+    async def achat(self, messages: list[dict], model: str, **params) -> dict:
+        return await self._apost(
+            "chat/completions", {"model": model, "messages": messages, **params}
+        )
+
+    async def achat_stream(self, messages: list[dict], model: str, **params):
+        async with contextlib.aclosing(
+            self._astream(
+                "chat/completions", {"model": model, "messages": messages, **params}
+            )
+        ) as contents:
+            async for content in contents:
+                yield content
+
+    def embed(self, input: str | list[str], model: str) -> dict:
+        return self._post("embeddings", {"model": model, "input": input})
+
+
+class LocalBackend(OpenAICompatibleBackend):
+    """
+    Starts the bundled stand-in server (see standin_server.StandInServer for
+    its options) in this process and sends all requests to it, so the
+    pipeline runs without network access or an API key.
+    """
+
+    def __init__(self, **server_options):
+        from upgraider.standin_server import StandInServer
+
+        self.server = StandInServer(**server_options)
+        self.server.start()
+        super().__init__(self.server.url, api_key="stand-in")
+
+    @property
+    def identity(self) -> str | None:
+        # the server's port changes from run to run, its answers do not
+        return type(self).__name__
+
+
+_backend: Backend = None
+
+
+def backend_from_env() -> Backend:
+    """
+    The backend named by the UPGRAIDER_BACKEND environment variable:
+    "openai" (default), "http" (at UPGRAIDER_API_BASE, with
+    UPGRAIDER_API_KEY) or "local".
+    """
+    name = env.get("UPGRAIDER_BACKEND", "openai")
+    if name == "http":
+        return OpenAICompatibleBackend(
+            env["UPGRAIDER_API_BASE"], api_key=env.get("UPGRAIDER_API_KEY")
+        )
+    elif name == "local":
+        return LocalBackend()
+    elif name == "openai":
+        return OpenAIBackend()
+    else:
+        raise ValueError(f"Unknown backend {name}")
+
+
+def get_backend() -> Backend:
+    """
+    Returns the backend selected with set_backend, or else the one from
+    backend_from_env, retrying transient failures.
+    """
+    global _backend
+
+    if _backend is None:
+        from upgraider.Retry import RetryingBackend
+
+        _backend = RetryingBackend(backend_from_env())
+
+    return _backend
+
+
+def set_backend(backend: Backend):
+    global _backend
+    _backend = backend
@@ -0,0 +1,163 @@
+from sqlalchemy import create_engine, Column, String, Float, LargeBinary, Index
+from sqlalchemy.orm import declarative_base, sessionmaker
+from os import environ as env
+from dotenv import load_dotenv
+import hashlib
+import time
+import os
+
+load_dotenv(override=True)
+
+# a hit only records its use if the last one is older than this (in seconds)
+TOUCH_INTERVAL = 600
+# entries allowed over max_entries (as a fraction of it) before evicting
+EVICTION_SLACK = 0.1
+
+script_path = os.path.dirname(os.path.realpath(__file__))
+CACHE_DB_PATH = env.get(
+    "UPGRAIDER_CACHE_DB", f"{script_path}/resources/database/cache.db"
+)
+
+Base = declarative_base()
+
+
+class CacheEntry(Base):
+    __tablename__ = "cache_entries"
+    namespace = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    value = Column(LargeBinary)
+    last_used = Column(Float)
+
+    __table_args__ = (Index("ix_cache_entries_lru", "namespace", "last_used"),)
+
+
+_sessionmakers = {}
+
+
+def _get_sessionmaker(path: str):
+    if path not in _sessionmakers:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        engine = create_engine(f"sqlite:///{path}", echo=False)
+        Base.metadata.create_all(engine)
+        _sessionmakers[path] = sessionmaker(bind=engine)
+    return _sessionmakers[path]
+
+
+def content_key(*parts: str) -> str:
+    """
+    Returns a content-addressed key: the sha256 of the given parts.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class PersistentCache:
+    """
+    Bytes store persisted in a SQLite file, shared by all caches of a given
+    path and separated by namespace. Each namespace keeps about
+    `max_entries` entries, evicting the least recently used ones.
+
+    To keep hits and puts cheap, uses are only recorded every
+    touch_interval seconds per entry, and evictions happen in batches, once
+    a namespace has grown eviction_slack over max_entries.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        max_entries: int,
+        path: str = None,
+        touch_interval: float = TOUCH_INTERVAL,
+        eviction_slack: float = EVICTION_SLACK,
+    ):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.path = path
+        self.touch_interval = touch_interval
+        self.eviction_slack = eviction_slack
+        self.hits = 0
+        self.misses = 0
+        # entries in the namespace, counted when first needed; puts of
+        # existing keys overcount, which only makes an eviction come earlier
+        self._num_entries = None
+
+    def _session(self):
+        return _get_sessionmaker(self.path or CACHE_DB_PATH)()
+
+    def get(self, key: str) -> bytes | None:
+        session = self._session()
+        entry = session.get(CacheEntry, (self.namespace, key))
+
+        if entry is None:
+            self.misses += 1
+            value = None
+        else:
+            self.hits += 1
+            value = entry.value
+            now = time.time()
+            if entry.last_used is None or entry.last_used <= now - self.touch_interval:
+                entry.last_used = now
+                session.commit()
+
+        session.close()
+        return value
+
+    def put(self, key: str, value: bytes):
+        session = self._session()
+        session.merge(
+            CacheEntry(
+                namespace=self.namespace,
+                key=key,
+                value=value,
+                last_used=time.time(),
+            )
+        )
+        if self._num_entries is None:
+            self._num_entries = (
+                session.query(CacheEntry).filter(CacheEntry.namespace == self.namespace).count()
+            )
+        else:
+            self._num_entries += 1
+
+        if self._num_entries > self.max_entries + int(self.max_entries * self.eviction_slack):
+            self._evict(session)
+
+        session.commit()
+        session.close()
+
+    def _evict(self, session):
+        session.flush()
+        stale_keys = (
+            session.query(CacheEntry.key)
+            .filter(CacheEntry.namespace == self.namespace)
+            .order_by(CacheEntry.last_used.desc())
+            .offset(self.max_entries)
+            .all()
+        )
+        if stale_keys:
+            session.query(CacheEntry).filter(
+                CacheEntry.namespace == self.namespace,
+                CacheEntry.key.in_([stale_key for stale_key, in stale_keys]),
+            ).delete(synchronize_session=False)
+        # counted again on the next put
+        self._num_entries = None
+
+    def values(self) -> list[bytes]:
+        """
+        All values of the namespace, without counting as uses.
+        """
+        session = self._session()
+        values = [
+            value
+            for value, in session.query(CacheEntry.value).filter(
+                CacheEntry.namespace == self.namespace
+            )
+        ]
+        session.close()
+        return values
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses}
@@ -1,53 +1,662 @@
 from sqlalchemy import create_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
 from sqlalchemy import Column, Integer, String, Text
+from sqlalchemy.types import TypeDecorator
+import numpy as np
+from upgraider.EmbeddingIndex import EmbeddingIndex, IVFIndex, QuantizedMatrix, _version_key
+from upgraider.BM25Index import BM25Index
+from upgraider.ApiSymbols import SymbolIndex
+from sqlalchemy.exc import OperationalError
+from sqlalchemy import inspect, text, literal
 import json
 import os
+import tempfile
+import functools
+import threading
+from collections import OrderedDict, namedtuple
 
 script_path = os.path.dirname(os.path.realpath(__file__))
+DB_PATH = f"{script_path}/resources/database/releasenotes.db"
+EMBEDDING_DTYPE = np.float32
+SECTION_CONTENT_CACHE_SIZE = 4096
+# stay below SQLite's limit on the number of bound parameters per query
+MAX_IN_CLAUSE_IDS = 500
+
 Base = declarative_base()
 engine = create_engine(
-    f"sqlite:///{script_path}/resources/database/releasenotes.db",
+    f"sqlite:///{DB_PATH}",
     echo=False,
 )
 Session = sessionmaker(bind=engine)
 
 
+def pack_embedding(embedding) -> bytes:
+    return np.asarray(embedding, dtype=EMBEDDING_DTYPE).tobytes()
+
+
+def unpack_embedding(value) -> np.ndarray:
+    """
+    Decodes a stored embedding. Older databases hold the embedding as JSON text,
+    so both that and the packed float32 format are accepted.
+    """
+    if value is None or value == "NULL":
+        return None
+    if isinstance(value, str):
+        decoded = json.loads(value)
+        # failed embeddings were stored as json.dumps(None)
+        if decoded is None:
+            return None
+        embedding = np.asarray(decoded, dtype=EMBEDDING_DTYPE)
+        return embedding if embedding.ndim == 1 else None
+    return np.frombuffer(value, dtype=EMBEDDING_DTYPE)
+
+
+class PackedEmbedding(TypeDecorator):
+    """
+    Stores an embedding as a packed float32 BLOB (6 KB for an ada embedding
+    instead of ~40 KB of Python floats once decoded from JSON).
+
+    The column is declared over Text so that existing databases keep their
+    schema; SQLite keeps the bytes as a BLOB regardless of column affinity.
+    """
+
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return pack_embedding(value)
+
+    def process_result_value(self, value, dialect):
+        return unpack_embedding(value)
+
+
 class LibReleaseNote(Base):
     __tablename__ = "lib_release_notes"
     id = Column(Integer, primary_key=True)
     library = Column(String)
     version = Column(String)
     filename = Column(String)
+    # sha256 of the release note file when it was last ingested
+    content_hash = Column(String)
 
 
 class DeprecationComment(Base):
     __tablename__ = "deprecation_comments"
     id = Column(Integer, primary_key=True)
+    # release note the section was first ingested from; a text repeated in
+    # several release notes is stored once and linked to all of them through
+    # SectionReleaseNote
     lib_release_note = Column(Integer)
     content = Column(String)
-    embedding = Column(Text)
+    embedding = Column(PackedEmbedding)
+    # tokens of the content as it appears in a prompt, counted at ingestion
+    num_tokens = Column(Integer)
+    # sha256 of the whitespace-normalized content
+    content_hash = Column(String, index=True)
 
 
-def get_section_content(section_id):
+class SectionReleaseNote(Base):
+    __tablename__ = "section_release_notes"
+    id = Column(Integer, primary_key=True)
+    deprecation_comment = Column(Integer, index=True)
+    lib_release_note = Column(Integer, index=True)
+
+
+class ApiSymbol(Base):
+    __tablename__ = "api_symbols"
+    id = Column(Integer, primary_key=True)
+    symbol = Column(String, index=True)
+    deprecation_comment = Column(Integer, index=True)
+
+
+# DB path -> {table: its columns}, as found by _schema
+_schemas: dict[str, dict[str, set[str]]] = {}
+_schema_lock = threading.Lock()
+
+
+def upgrade_schema():
+    """
+    Creates missing tables and adds the columns introduced after a DB was
+    first populated (as NULL for existing rows). Safe to call repeatedly.
+    """
     session = Session()
-    section = (
-        session.query(DeprecationComment)
-        .filter(DeprecationComment.id == section_id)
-        .first()
-    )
+    bind = session.get_bind()
+    Base.metadata.create_all(bind)
+
+    inspector = inspect(bind)
+    for table in Base.metadata.sorted_tables:
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                column_type = column.type.compile(dialect=bind.dialect)
+                session.execute(
+                    text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}")
+                )
+    session.commit()
+
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind, checkfirst=True)
+    session.close()
+    with _schema_lock:
+        _schemas.pop(DB_PATH, None)
+
+
+def missing_schema() -> list[str]:
+    """
+    The tables and columns (as "table.column") that upgrade_schema would
+    add, found without changing the DB.
+    """
+    session = Session()
+    inspector = inspect(session.get_bind())
+    existing_tables = set(inspector.get_table_names())
+
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            missing.append(table.name)
+            continue
+        existing_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        missing += [
+            f"{table.name}.{column.name}"
+            for column in table.columns
+            if column.name not in existing_columns
+        ]
     session.close()
-    return section.content
+    return missing
+
+
+def _schema() -> dict[str, set[str]]:
+    """
+    The tables of the DB and their columns, read once per DB. Readers use it
+    to work with DBs populated before tables or columns were added, since
+    only populate_doc_db upgrades the (checked-in) DB.
+    """
+    with _schema_lock:
+        if DB_PATH not in _schemas:
+            session = Session()
+            inspector = inspect(session.get_bind())
+            _schemas[DB_PATH] = {
+                table: {column["name"] for column in inspector.get_columns(table)}
+                for table in inspector.get_table_names()
+            }
+            session.close()
+        return _schemas[DB_PATH]
+
+
+def _has_column(table: str, column: str) -> bool:
+    return column in _schema().get(table, set())
+
+
+# releases: the (library, version) of every release note the section appears in
+Section = namedtuple("Section", ["content", "num_tokens", "releases"], defaults=[()])
+
+
+def get_section_content(section_id):
+    return get_section_contents([section_id])[section_id]
+
+
+def get_section_contents(section_ids: list[int]) -> dict[int, str]:
+    return {
+        section_id: section.content
+        for section_id, section in get_sections(section_ids).items()
+    }
+
+
+_sections: OrderedDict[int, Section] = OrderedDict()
+_sections_stamp = None
+_sections_lock = threading.Lock()
+
+
+def get_sections(section_ids: list[int]) -> dict[int, Section]:
+    """
+    Returns {section id: Section} for the given ids. Sections are served from
+    an LRU cache; all missing ids are loaded in a single IN (...) query.
+    """
+    global _sections_stamp
+
+    sections = {}
+    with _sections_lock:
+        stamp = _corpus_stamp()
+        if stamp != _sections_stamp:
+            _sections.clear()
+            _sections_stamp = stamp
+
+        for section_id in section_ids:
+            if section_id in _sections:
+                _sections.move_to_end(section_id)
+                sections[section_id] = _sections[section_id]
+
+    missing = list({int(i) for i in section_ids if i not in sections})
+    loaded = {}
+    if missing:
+        # counted when building the prompt for DBs populated before token counts
+        num_tokens_column = (
+            DeprecationComment.num_tokens
+            if _has_column("deprecation_comments", "num_tokens")
+            else literal(None)
+        )
+        release_notes = get_release_notes()
+        session = Session()
+        for start in range(0, len(missing), MAX_IN_CLAUSE_IDS):
+            chunk = missing[start : start + MAX_IN_CLAUSE_IDS]
+            rows = (
+                session.query(
+                    DeprecationComment.id,
+                    DeprecationComment.content,
+                    num_tokens_column,
+                )
+                .filter(DeprecationComment.id.in_(chunk))
+                .all()
+            )
+            section_notes = get_section_release_notes(session, chunk)
+            loaded.update(
+                (
+                    section_id,
+                    Section(
+                        content,
+                        num_tokens,
+                        _releases(section_notes.get(section_id, []), release_notes),
+                    ),
+                )
+                for section_id, content, num_tokens in rows
+            )
+        session.close()
+
+    for section_id in section_ids:
+        if section_id not in sections and section_id in loaded:
+            sections[section_id] = loaded[section_id]
+
+    # the result is complete before other threads' sections can evict these
+    with _sections_lock:
+        if _sections_stamp == stamp:
+            _sections.update(loaded)
+            while len(_sections) > SECTION_CONTENT_CACHE_SIZE:
+                _sections.popitem(last=False)
+
+    return sections
+
+
+def _releases(note_ids: list[int], release_notes: dict[int, tuple[str, str]]):
+    releases = [release_notes[note_id] for note_id in note_ids if note_id in release_notes]
+    return tuple(
+        sorted(releases, key=lambda release: (release[0] or "", _version_key(release[1] or "")))
+    )
+
+
+def get_section_release_notes(session, section_ids: list[int] = None) -> dict[int, list[int]]:
+    """
+    Returns {section id: ids of the release notes the section appears in},
+    for the given sections or all of them. Sections ingested before texts
+    were deduplicated are only linked through their lib_release_note column.
+    """
+    if section_ids is None:
+        chunks = [None]
+    else:
+        chunks = [
+            section_ids[start : start + MAX_IN_CLAUSE_IDS]
+            for start in range(0, len(section_ids), MAX_IN_CLAUSE_IDS)
+        ]
+
+    # DBs populated before texts were deduplicated have no links
+    has_links = SectionReleaseNote.__tablename__ in _schema()
+
+    section_notes = {}
+    for chunk in chunks:
+        owners = session.query(DeprecationComment.id, DeprecationComment.lib_release_note)
+        links = session.query(
+            SectionReleaseNote.deprecation_comment, SectionReleaseNote.lib_release_note
+        )
+        if chunk is not None:
+            owners = owners.filter(DeprecationComment.id.in_(chunk))
+            links = links.filter(SectionReleaseNote.deprecation_comment.in_(chunk))
+
+        for section_id, note_id in owners.all() + (links.all() if has_links else []):
+            if note_id is not None:
+                section_notes.setdefault(section_id, set()).add(note_id)
+
+    return {section_id: sorted(note_ids) for section_id, note_ids in section_notes.items()}
+
+
+def _note_links(ids, section_notes: dict[int, list[int]]) -> np.ndarray:
+    # one (row, release note id) pair per release note a row's section appears in
+    links = [
+        (row, note_id)
+        for row, section_id in enumerate(ids)
+        for note_id in section_notes.get(int(section_id), [])
+    ]
+    return np.array(links, dtype=np.int64).reshape(-1, 2)
+
+
+def get_embedded_doc_sections() -> dict[int, np.ndarray]:
+    return get_embedding_index().sections
+
+
+def _sidecar_path(kind: str, extension: str = "npy") -> str:
+    return f"{os.path.splitext(DB_PATH)[0]}.{kind}.{extension}"
+
+
+def _sidecar_is_fresh() -> bool:
+    sidecars = [_sidecar_path(kind) for kind in ("embeddings", "ids", "note_links")]
+    if not all(os.path.exists(path) for path in sidecars):
+        return False
+
+    db_mtime = os.path.getmtime(DB_PATH)
+    return all(os.path.getmtime(path) >= db_mtime for path in sidecars)
+
+
+def _replace_file(path: str, write):
+    """
+    Calls write with a temporary file next to path and then moves it into
+    place, so that readers never map a partial file. The temporary file is
+    unique, so concurrent writers (other processes) do not clobber it.
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path), prefix=f"{os.path.basename(path)}.", suffix=".tmp"
+    )
+    os.close(fd)
+    try:
+        write(tmp_path)
+        # mkstemp creates the file readable by its owner only
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def _save_array(path: str, array: np.ndarray):
+    def write(tmp_path):
+        with open(tmp_path, "wb") as f:
+            np.save(f, array)
 
+    _replace_file(path, write)
 
-def get_embedded_doc_sections() -> dict[int, list[float]]:
+
+def _save_ivf_index(path: str, ivf_index: IVFIndex):
+    _replace_file(path, ivf_index.save)
+
+
+# prompts are built in worker threads, which must not check, rebuild and
+# export the indexes and their sidecars at the same time
+_index_lock = threading.RLock()
+
+
+def _holding_index_lock(function):
+    @functools.wraps(function)
+    def locked(*args, **kwargs):
+        with _index_lock:
+            return function(*args, **kwargs)
+
+    return locked
+
+
+@_holding_index_lock
+def export_embedding_matrix():
+    """
+    Writes all stored embeddings to `.npy` files next to the DB: one (n, d)
+    float32 matrix, the aligned vector of section ids and the (row, release
+    note id) pairs linking rows to the release notes they appear in. Rows are
+    grouped by library so that per-library partitions are contiguous.
+    """
     session = Session()
-    sections = (
-        session.query(DeprecationComment)
-        .filter(DeprecationComment.embedding != "NULL")
+    rows = (
+        session.query(
+            DeprecationComment.id,
+            DeprecationComment.embedding,
+            DeprecationComment.lib_release_note,
+        )
+        .outerjoin(LibReleaseNote, LibReleaseNote.id == DeprecationComment.lib_release_note)
         .filter(DeprecationComment.embedding != None)
+        .order_by(LibReleaseNote.library, DeprecationComment.id)
         .all()
     )
+    section_notes = get_section_release_notes(session)
+    session.close()
+
+    # legacy rows may hold the string "NULL" or "null", which decode to None
+    rows = [row for row in rows if row[1] is not None]
+    ids = np.array([section_id for section_id, _, _ in rows], dtype=np.int64)
+    if rows:
+        matrix = np.vstack([emb for _, emb, _ in rows])
+    else:
+        matrix = np.empty((0, 0), dtype=EMBEDDING_DTYPE)
+
+    _save_array(_sidecar_path("embeddings"), matrix)
+    _save_array(_sidecar_path("ids"), ids)
+    _save_array(_sidecar_path("note_links"), _note_links(ids, section_notes))
+    invalidate_embedding_index()
+
+
+@_holding_index_lock
+def get_embedding_matrix() -> tuple[np.ndarray, np.ndarray]:
+    """
+    Returns (ids, matrix) where row i of the memory-mapped embedding matrix is
+    the embedding of section ids[i]. The `.npy` sidecars are regenerated
+    whenever the DB is newer than them; processes mapping the same files share
+    their pages.
+    """
+    if not _sidecar_is_fresh():
+        export_embedding_matrix()
+
+    ids = np.load(_sidecar_path("ids"), mmap_mode="r")
+    matrix = np.load(_sidecar_path("embeddings"), mmap_mode="r")
+    return ids, matrix
+
+
+def get_release_notes() -> dict[int, tuple[str, str]]:
+    session = Session()
+    notes = session.query(
+        LibReleaseNote.id, LibReleaseNote.library, LibReleaseNote.version
+    ).all()
+    session.close()
+    return {note_id: (library, version) for note_id, library, version in notes}
+
+
+_embedding_index: EmbeddingIndex = None
+
+
+def _corpus_stamp():
+    if not os.path.exists(DB_PATH):
+        return None
+    stat = os.stat(DB_PATH)
+    return (DB_PATH, stat.st_mtime_ns, stat.st_size)
+
+
+@_holding_index_lock
+def get_embedding_index() -> EmbeddingIndex:
+    """
+    Returns the process-wide embedding index, rebuilding it only when the DB
+    file has changed since the index was loaded.
+    """
+    global _embedding_index
+
+    stamp = _corpus_stamp()
+    if _embedding_index is None or _embedding_index.stamp != stamp:
+        ids, matrix = get_embedding_matrix()
+        _embedding_index = EmbeddingIndex(
+            ids,
+            matrix,
+            stamp=stamp,
+            note_links=np.load(_sidecar_path("note_links"), mmap_mode="r"),
+            notes=get_release_notes(),
+        )
+
+    return _embedding_index
+
+
+@_holding_index_lock
+def invalidate_embedding_index():
+    global _embedding_index, _ivf_index
+    _embedding_index = None
+    _ivf_index = None
+    _quantized_indexes.clear()
+
+
+_quantized_indexes: dict[str, EmbeddingIndex] = {}
+
+
+@_holding_index_lock
+def _load_quantized_matrix(dtype: str) -> QuantizedMatrix:
+    codes_path = _sidecar_path(f"embeddings.{dtype}")
+    scales_path = _sidecar_path(f"scales.{dtype}")
+    sidecars = [codes_path] + ([scales_path] if dtype == "int8" else [])
+
+    embeddings_mtime = os.path.getmtime(_sidecar_path("embeddings"))
+    if not all(
+        os.path.exists(path) and os.path.getmtime(path) >= embeddings_mtime
+        for path in sidecars
+    ):
+        _, matrix = get_embedding_matrix()
+        quantized = QuantizedMatrix.quantize(matrix, dtype)
+        _save_array(codes_path, quantized.codes)
+        if quantized.scales is not None:
+            _save_array(scales_path, quantized.scales)
+
+    codes = np.load(codes_path, mmap_mode="r")
+    scales = np.load(scales_path, mmap_mode="r") if dtype == "int8" else None
+    return QuantizedMatrix(codes, scales)
+
+
+@_holding_index_lock
+def get_quantized_index(dtype: str) -> EmbeddingIndex:
+    """
+    Returns the embedding index with a quantized ("int8" or "float16") copy of
+    the matrix attached, stored as memory-mapped sidecars next to the float32
+    one. Only the best candidates are re-scored against full-precision rows.
+    """
+    index = get_embedding_index()
+    quantized_index = _quantized_indexes.get(dtype)
 
+    if quantized_index is None or quantized_index.stamp != index.stamp:
+        quantized_index = index.with_quantized(_load_quantized_matrix(dtype))
+        _quantized_indexes[dtype] = quantized_index
+
+    return quantized_index
+
+
+_ivf_index: IVFIndex = None
+
+
+@_holding_index_lock
+def get_ivf_index(nlist: int = None) -> IVFIndex:
+    """
+    Returns the IVF index over the current embeddings. It is loaded from the
+    `.ivf.npz` sidecar next to the DB, and rebuilt (and saved) when the
+    sidecar is missing, was built from other sections or with another nlist.
+    """
+    global _ivf_index
+
+    index = get_embedding_index()
+
+    def usable(ivf_index):
+        return (
+            ivf_index is not None
+            and ivf_index.matches(index)
+            and (nlist is None or ivf_index.nlist == nlist)
+        )
+
+    if usable(_ivf_index):
+        return _ivf_index
+
+    path = _sidecar_path("ivf", "npz")
+    ivf_index = IVFIndex.load(path) if os.path.exists(path) else None
+
+    if not usable(ivf_index):
+        print("Building IVF index over release note embeddings...")
+        ivf_index = IVFIndex.build(index, nlist=nlist)
+        _save_ivf_index(path, ivf_index)
+
+    _ivf_index = ivf_index
+    return _ivf_index
+
+
+_bm25_index: BM25Index = None
+_bm25_index_stamp = None
+
+
+@_holding_index_lock
+def export_bm25_index():
+    """
+    Builds the BM25 index over the content of all sections and saves it as a
+    `.bm25.npz` sidecar next to the DB.
+    """
+    global _bm25_index, _bm25_index_stamp
+
+    session = Session()
+    rows = (
+        session.query(DeprecationComment.id, DeprecationComment.content)
+        .order_by(DeprecationComment.id)
+        .all()
+    )
+    section_notes = get_section_release_notes(session)
     session.close()
-    return {section.id: json.loads(section.embedding) for section in sections}
+
+    bm25_index = BM25Index.build(
+        ids=[section_id for section_id, _ in rows],
+        texts=[content or "" for _, content in rows],
+        release_notes=[section_notes.get(section_id, []) for section_id, _ in rows],
+    )
+
+    _replace_file(_sidecar_path("bm25", "npz"), bm25_index.save)
+
+    _bm25_index = bm25_index
+    _bm25_index_stamp = _corpus_stamp()
+
+
+@_holding_index_lock
+def get_bm25_index() -> BM25Index:
+    """
+    Returns the BM25 index, loading it from its sidecar, which is rebuilt
+    when the DB is newer than it.
+    """
+    global _bm25_index, _bm25_index_stamp
+
+    stamp = _corpus_stamp()
+    if _bm25_index is not None and _bm25_index_stamp == stamp:
+        return _bm25_index
+
+    path = _sidecar_path("bm25", "npz")
+    if os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(DB_PATH):
+        _bm25_index = BM25Index.load(path)
+        _bm25_index_stamp = stamp
+    else:
+        export_bm25_index()
+
+    return _bm25_index
+
+
+_symbol_index: SymbolIndex = None
+
+
+@_holding_index_lock
+def get_symbol_index() -> SymbolIndex:
+    """
+    Returns the API symbol index, reloaded from the api_symbols table when
+    the DB changes. DBs populated before symbols were extracted give an empty
+    index.
+    """
+    global _symbol_index
+
+    stamp = _corpus_stamp()
+    if _symbol_index is not None and _symbol_index.stamp == stamp:
+        return _symbol_index
+
+    session = Session()
+    try:
+        rows = session.query(ApiSymbol.deprecation_comment, ApiSymbol.symbol).all()
+        section_notes = get_section_release_notes(
+            session, list({section_id for section_id, _ in rows})
+        )
+    except OperationalError:
+        print("WARNING: no API symbols in DB, re-run populate_doc_db to extract them")
+        rows = []
+        section_notes = {}
+    finally:
+        session.close()
+
+    _symbol_index = SymbolIndex.build(rows, release_notes=section_notes)
+    _symbol_index.stamp = stamp
+    return _symbol_index
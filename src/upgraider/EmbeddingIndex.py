@@ -0,0 +1,411 @@
+import numpy as np
+import re
+
+# rows scored per block when a computation would otherwise materialize a
+# full-size float32 copy of a compact matrix
+CHUNK_SIZE = 65536
+
+# with a quantized matrix, this many candidates per requested result are
+# re-scored against the full-precision embeddings
+RESCORE_FACTOR = 4
+
+
+class QuantizedMatrix:
+    """
+    Compact copy of an embedding matrix for a first scoring pass: either
+    float16 codes, or int8 codes with one scale per row (row ~= codes * scale).
+    """
+
+    def __init__(self, codes: np.ndarray, scales: np.ndarray = None):
+        self.codes = codes
+        self.scales = scales
+
+    @classmethod
+    def quantize(cls, matrix: np.ndarray, dtype: str) -> "QuantizedMatrix":
+        if dtype == "float16":
+            return cls(np.asarray(matrix, dtype=np.float16))
+
+        if dtype != "int8":
+            raise ValueError(f"Unsupported quantization {dtype}")
+
+        codes = np.empty(matrix.shape, dtype=np.int8)
+        scales = np.empty(len(matrix), dtype=np.float32)
+        for start in range(0, len(matrix), CHUNK_SIZE):
+            block = np.asarray(matrix[start : start + CHUNK_SIZE], dtype=np.float32)
+            block_scales = np.abs(block).max(axis=1) / 127
+            block_scales[block_scales == 0] = 1.0
+            codes[start : start + len(block)] = np.round(block / block_scales[:, None])
+            scales[start : start + len(block)] = block_scales
+        return cls(codes, scales)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, rows) -> "QuantizedMatrix":
+        scales = self.scales[rows] if self.scales is not None else None
+        return QuantizedMatrix(self.codes[rows], scales)
+
+    @property
+    def nbytes(self) -> int:
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def scores(self, queries: np.ndarray) -> np.ndarray:
+        """
+        Approximate dot products of a 2D batch of queries with every row.
+        """
+        scores = np.empty((len(queries), len(self)), dtype=np.float32)
+        for start in range(0, len(self), CHUNK_SIZE):
+            block = self.codes[start : start + CHUNK_SIZE].astype(np.float32)
+            scores[:, start : start + len(block)] = queries @ block.T
+
+        if self.scales is not None:
+            scores *= self.scales
+        return scores
+
+
+class EmbeddingIndex:
+    """
+    In-memory view of the release note embeddings: row i of `matrix` is the
+    embedding of section `ids[i]`. `note_links` holds a (row, release note id)
+    pair for every release note a section appears in, and `notes` maps
+    release note ids to their (library, version). `stamp` identifies the DB
+    state the index was built from.
+
+    Partitions are indexes over a subset of the rows of a `parent` index;
+    `row_mask` marks which parent rows they contain and `note_ids` the
+    release notes they were selected from.
+
+    With a `quantized` matrix, top_k scores the compact matrix first and only
+    reads the full-precision rows of the best candidates.
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        matrix: np.ndarray,
+        stamp=None,
+        note_links: np.ndarray = None,
+        notes: dict[int, tuple[str, str]] = None,
+        quantized: QuantizedMatrix = None,
+    ):
+        self.ids = ids
+        self.matrix = matrix
+        self.quantized = quantized
+        self.stamp = stamp
+        self.note_links = note_links
+        self.notes = notes if notes is not None else {}
+        self.parent = None
+        self.row_mask = None
+        self.note_ids = None
+        self._sections = None
+        self._partitions = {}
+
+    @classmethod
+    def from_sections(cls, sections: dict[int, list[float]]) -> "EmbeddingIndex":
+        ids = np.fromiter(sections.keys(), dtype=np.int64, count=len(sections))
+        if len(sections) == 0:
+            return cls(ids, np.empty((0, 0), dtype=np.float32))
+        matrix = np.vstack([np.asarray(e, dtype=np.float32) for e in sections.values()])
+        return cls(ids, matrix)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def with_quantized(self, quantized: QuantizedMatrix) -> "EmbeddingIndex":
+        return EmbeddingIndex(
+            self.ids,
+            self.matrix,
+            stamp=self.stamp,
+            note_links=self.note_links,
+            notes=self.notes,
+            quantized=quantized,
+        )
+
+    @property
+    def sections(self) -> dict[int, np.ndarray]:
+        if self._sections is None:
+            self._sections = {
+                int(section_id): self.matrix[row]
+                for row, section_id in enumerate(self.ids)
+            }
+        return self._sections
+
+    def partition(
+        self, library: str, versions: tuple[str, str] = None
+    ) -> "EmbeddingIndex":
+        """
+        Returns the index restricted to the release notes of `library`, and
+        optionally to those whose version lies in the inclusive
+        (base version, current version) range. Partitions are built once.
+        """
+        key = (library, versions)
+        if key in self._partitions:
+            return self._partitions[key]
+
+        note_ids = [
+            note_id
+            for note_id, (note_library, note_version) in self.notes.items()
+            if note_library == library
+            and (versions is None or _version_in_range(note_version, versions))
+        ]
+        row_mask = np.zeros(len(self), dtype=bool)
+        note_links = np.empty((0, 2), dtype=np.int64)
+        if self.note_links is not None and len(self.note_links) > 0:
+            # a section is in the partition if any of its release notes is
+            row_mask[self.note_links[np.isin(self.note_links[:, 1], note_ids), 0]] = True
+            note_links = self.note_links[row_mask[self.note_links[:, 0]]]
+            # renumber the rows of the partition's links
+            note_links[:, 0] = np.cumsum(row_mask)[note_links[:, 0]] - 1
+        rows = np.flatnonzero(row_mask)
+
+        if len(rows) > 0 and rows[-1] - rows[0] + 1 == len(rows):
+            # rows are grouped by library, so this is usually a zero-copy view
+            rows = slice(rows[0], rows[-1] + 1)
+
+        partition = EmbeddingIndex(
+            self.ids[rows],
+            self.matrix[rows],
+            stamp=self.stamp,
+            note_links=note_links,
+            notes=self.notes,
+            quantized=self.quantized[rows] if self.quantized is not None else None,
+        )
+        partition.parent = self
+        partition.row_mask = row_mask
+        partition.note_ids = note_ids
+        self._partitions[key] = partition
+        return partition
+
+    def top_k(
+        self, queries, k: int = None, threshold: float = None
+    ) -> list[(float, int)]:
+        """
+        Scores the whole corpus against one query embedding (or a 2D batch of
+        them) with a single matrix product and returns the k most similar
+        sections as (similarity, section id), most similar first. Sections
+        scoring at or below a non-zero threshold are dropped.
+
+        A batch of queries returns one such list per query.
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        single_query = queries.ndim == 1
+        queries = np.atleast_2d(queries)
+
+        if len(self) == 0:
+            results = [[] for _ in queries]
+        elif (
+            self.quantized is not None
+            and k is not None
+            and k * RESCORE_FACTOR < len(self)
+        ):
+            results = self._rescored_top_k(queries, k, threshold)
+        else:
+            scores = queries @ self.matrix.T
+            results = [self.select(row, k, threshold) for row in scores]
+
+        return results[0] if single_query else results
+
+    def _rescored_top_k(self, queries: np.ndarray, k: int, threshold: float):
+        n_candidates = k * RESCORE_FACTOR
+        results = []
+        for query, approximate_scores in zip(queries, self.quantized.scores(queries)):
+            candidates = np.argpartition(-approximate_scores, n_candidates - 1)
+            rows = np.sort(candidates[:n_candidates])
+            scores = self.matrix[rows] @ query
+            results.append(self.select(scores, k, threshold, rows=rows))
+        return results
+
+    def select(
+        self, scores: np.ndarray, k: int, threshold: float, rows: np.ndarray = None
+    ) -> list[(float, int)]:
+        """
+        Turns the scores of `rows` (all rows if None) into the top k
+        (similarity, section id) pairs.
+        """
+        if rows is None:
+            rows = np.arange(len(scores))
+
+        if threshold:
+            candidates = np.flatnonzero(scores > threshold)
+        else:
+            candidates = np.arange(len(scores))
+
+        # partial selection so the cost scales with k, not the corpus size
+        if k is not None and k < len(candidates):
+            kept = np.argpartition(-scores[candidates], k - 1)[:k]
+            candidates = candidates[kept]
+
+        ranked = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(float(scores[i]), int(self.ids[rows[i]])) for i in ranked]
+
+
+class IVFIndex:
+    """
+    Approximate nearest-neighbour index over an EmbeddingIndex. Rows are
+    clustered around `nlist` centroids (spherical k-means); a query only
+    scores the rows of its `nprobe` closest clusters, exactly, against the
+    full-precision matrix. More probes trade latency for recall.
+    """
+
+    def __init__(
+        self,
+        ids: np.ndarray,
+        centroids: np.ndarray,
+        order: np.ndarray,
+        offsets: np.ndarray,
+    ):
+        self.ids = ids
+        self.centroids = centroids
+        # rows of cluster c are order[offsets[c] : offsets[c + 1]]
+        self.order = order
+        self.offsets = offsets
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    @classmethod
+    def build(
+        cls,
+        index: EmbeddingIndex,
+        nlist: int = None,
+        n_iter: int = 10,
+        seed: int = 0,
+    ) -> "IVFIndex":
+        matrix = np.asarray(index.matrix, dtype=np.float32)
+        if len(index) == 0:
+            return cls(np.array(index.ids), matrix, np.array([], dtype=np.int64), np.zeros(1, dtype=np.int64))
+
+        if nlist is None:
+            nlist = int(np.sqrt(len(index)))
+        nlist = max(1, min(nlist, len(index)))
+
+        rng = np.random.default_rng(seed)
+        centroids = matrix[rng.choice(len(index), nlist, replace=False)].copy()
+
+        for _ in range(n_iter):
+            assignment = _nearest_centroid(matrix, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, matrix)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # empty clusters keep their previous centroid
+            non_empty = norms[:, 0] > 0
+            centroids[non_empty] = sums[non_empty] / norms[non_empty]
+
+        assignment = _nearest_centroid(matrix, centroids)
+        order = np.argsort(assignment, kind="stable")
+        offsets = np.searchsorted(assignment[order], np.arange(nlist + 1))
+        return cls(np.array(index.ids), centroids, order, offsets)
+
+    @classmethod
+    def load(cls, path: str) -> "IVFIndex":
+        with np.load(path) as data:
+            return cls(data["ids"], data["centroids"], data["order"], data["offsets"])
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            np.savez(
+                f,
+                ids=self.ids,
+                centroids=self.centroids,
+                order=self.order,
+                offsets=self.offsets,
+            )
+
+    def matches(self, index: EmbeddingIndex) -> bool:
+        return np.array_equal(self.ids, index.ids)
+
+    def search(
+        self,
+        index: EmbeddingIndex,
+        queries,
+        k: int = None,
+        threshold: float = None,
+        nprobe: int = 8,
+    ) -> list[(float, int)]:
+        """
+        Same contract as EmbeddingIndex.top_k, restricted to the rows of the
+        `nprobe` clusters closest to each query. `index` may be a partition of
+        the index this IVF index was built over.
+        """
+        row_mask = None
+        if index.parent is not None:
+            row_mask = index.row_mask
+            index = index.parent
+
+        queries = np.asarray(queries, dtype=np.float32)
+        single_query = queries.ndim == 1
+        queries = np.atleast_2d(queries)
+
+        if len(index) == 0:
+            return [] if single_query else [[] for _ in queries]
+
+        nprobe = min(nprobe, self.nlist)
+        centroid_scores = queries @ self.centroids.T
+        results = []
+        for query, query_centroid_scores in zip(queries, centroid_scores):
+            probes = np.argpartition(-query_centroid_scores, nprobe - 1)[:nprobe]
+            # sorted rows keep the reads from the memory-mapped matrix sequential
+            rows = np.sort(
+                np.concatenate(
+                    [self.order[self.offsets[c] : self.offsets[c + 1]] for c in probes]
+                )
+            )
+            if row_mask is not None:
+                rows = rows[row_mask[rows]]
+            scores = index.matrix[rows] @ query
+            results.append(index.select(scores, k, threshold, rows=rows))
+
+        return results[0] if single_query else results
+
+    def recall(self, index: EmbeddingIndex, queries, k: int, nprobe: int) -> float:
+        """
+        Fraction of the exact top k sections that the approximate search finds.
+        """
+        exact = index.top_k(np.atleast_2d(queries), k=k)
+        approximate = self.search(index, np.atleast_2d(queries), k=k, nprobe=nprobe)
+        return ranking_recall(exact, approximate)
+
+
+def ranking_recall(
+    exact: list[list[(float, int)]], approximate: list[list[(float, int)]]
+) -> float:
+    """
+    Fraction of the sections in the exact rankings that the approximate
+    rankings also return.
+    """
+    found = 0
+    expected = 0
+    for exact_result, approximate_result in zip(exact, approximate):
+        exact_ids = {section_id for _, section_id in exact_result}
+        found += len(exact_ids & {section_id for _, section_id in approximate_result})
+        expected += len(exact_ids)
+
+    return found / expected if expected else 1.0
+
+
+def _version_key(version: str) -> tuple[int, ...]:
+    # "v1.5.0" -> (1, 5, 0); trailing zeros are dropped so that "v2.0" == "2.0.0"
+    key = [int(part) for part in re.findall(r"\d+", version)]
+    while key and key[-1] == 0:
+        key.pop()
+    return tuple(key)
+
+
+def _version_in_range(version: str, versions: tuple[str, str]) -> bool:
+    if version is None:
+        return True  # unknown versions are kept rather than silently dropped
+
+    base_version, current_version = versions
+    return _version_key(base_version) <= _version_key(version) <= _version_key(current_version)
+
+
+def _nearest_centroid(
+    matrix: np.ndarray, centroids: np.ndarray, chunk_size: int = 65536
+) -> np.ndarray:
+    return np.concatenate(
+        [
+            np.argmax(matrix[start : start + chunk_size] @ centroids.T, axis=1)
+            for start in range(0, len(matrix), chunk_size)
+        ]
+    )
@@ -0,0 +1,146 @@
+import os
+import json
+import tempfile
+import threading
+import contextlib
+import subprocess
+from concurrent.futures import Future
+from upgraider.VenvPool import Environment, get_venv_pool, overlay_env
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fork_worker.py")
+
+
+class WorkerDied(Exception):
+    """
+    Raised for the runs that were in progress when a worker exited.
+    """
+
+
+class ForkServer:
+    """
+    A long-lived fork_worker in the given environment that has imported the
+    `preload` libraries once, and runs each file in a forked child of
+    itself instead of a new interpreter. Thread safe; runs from several
+    threads proceed concurrently.
+    """
+
+    def __init__(self, environment: Environment, preload: list[str]):
+        self.environment = environment
+        self._worker_dir = tempfile.mkdtemp(prefix="upgraider-worker-")
+        self._process = subprocess.Popen(
+            # isolated, so the worker's own folder is not importable by snippets
+            [environment.python, "-I", "-B", WORKER_SCRIPT, *preload],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=self._worker_dir,
+            env=overlay_env(environment, self._worker_dir),
+        )
+        self._next_id = 0
+        self._pending: dict[int, Future] = {}
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_replies, daemon=True)
+        self._reader.start()
+
+    @property
+    def alive(self) -> bool:
+        return self._process.poll() is None
+
+    def _read_replies(self):
+        for line in self._process.stdout:
+            reply = json.loads(line)
+            with self._lock:
+                future = self._pending.pop(reply["id"])
+            future.set_result((reply["returncode"], reply["stderr"]))
+
+        self._process.wait()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future in pending.values():
+            future.set_exception(
+                WorkerDied(f"Worker exited with status {self._process.returncode}")
+            )
+
+    def run(self, file: str, overlay_dir: str) -> tuple[int, str]:
+        """
+        Runs the file with overlay_dir as working, home and temporary
+        directory, and returns its exit status and stderr.
+        """
+        future = Future()
+        with self._lock:
+            if not self.alive:
+                raise WorkerDied(f"Worker exited with status {self._process.returncode}")
+            self._next_id += 1
+            self._pending[self._next_id] = future
+            request = {
+                "id": self._next_id,
+                "file": os.path.abspath(file),
+                "cwd": overlay_dir,
+                "env": overlay_env(self.environment, overlay_dir),
+            }
+            self._process.stdin.write((json.dumps(request) + "\n").encode("utf-8"))
+            self._process.stdin.flush()
+        return future.result()
+
+    def close(self):
+        with contextlib.suppress(OSError):
+            self._process.stdin.close()
+        self._process.wait()
+        self._reader.join()
+        with contextlib.suppress(OSError):
+            os.rmdir(self._worker_dir)
+
+
+class ForkServerExecutor:
+    """
+    Runs snippets in ForkServers, one per environment of the venv pool,
+    started on first use with the environment's library preloaded. The
+    environments are held (so never evicted) until close.
+
+    Snippets see the library already imported, so warnings the library
+    only emits while being imported are not reported for them.
+    """
+
+    def __init__(self):
+        self._servers: dict = {}
+        self._environments = contextlib.ExitStack()
+        self._lock = threading.Lock()
+        self.starts = 0
+        self.runs = 0
+
+    def _server(self, library: str, version: str, requirements_file: str) -> ForkServer:
+        key = get_venv_pool().key(library, version, requirements_file)
+        with self._lock:
+            server = self._servers.get(key)
+            if server is None or not server.alive:
+                if server is None:
+                    environment = self._environments.enter_context(
+                        get_venv_pool().acquire(library, version, requirements_file)
+                    )
+                else:
+                    print(f"WARNING: worker for {library}=={version} exited, restarting it")
+                    server.close()
+                    environment = server.environment
+                server = ForkServer(environment, preload=[library])
+                self._servers[key] = server
+                self.starts += 1
+            self.runs += 1
+            return server
+
+    def execute(self, library: str, version: str, file: str, requirements_file: str) -> tuple[int, str]:
+        """
+        Runs the file with a fresh working, home and temporary directory and
+        returns its exit status and stderr, like run_code's subprocess.
+        """
+        server = self._server(library, version, requirements_file)
+        with tempfile.TemporaryDirectory(prefix="upgraider-run-") as overlay_dir:
+            return server.run(file, overlay_dir)
+
+    def close(self):
+        with self._lock:
+            for server in self._servers.values():
+                server.close()
+            self._servers = {}
+            self._environments.close()
+
+    def stats(self) -> dict[str, int]:
+        return {"workers": self.starts, "runs": self.runs}
@@ -1,14 +1,21 @@
 # some code in this script is based off https://github.com/openai/openai-cookbook/blob/main/examples/Question_answering_using_embeddings.ipynb
-import openai
-from os import environ as env
 from dotenv import load_dotenv
-from string import Template
 import re
 from upgraider.Database import get_embedded_doc_sections
 from upgraider.Report import UpdateStatus, ModelResponse, CodeSnippet
-import requests
-import json
-from upgraider.promptCrafting import construct_fixing_prompt
+import asyncio
+import contextlib
+import time
+import weakref
+from enum import Enum
+from upgraider.promptCrafting import (
+    construct_fixing_prompt,
+    count_tokens,
+    MAX_RESPONSE_TOKENS,
+)
+from upgraider.RateLimiter import RateLimiter
+from upgraider.Cache import PersistentCache
+from upgraider.Backend import Backend, get_backend, chat_request_key
 
 load_dotenv(override=True)
 
@@ -16,16 +23,50 @@ LLM_API_PARAMS = {
     "temperature": 0.0,
 }
 
+# requests sent concurrently by aquery
+MAX_IN_FLIGHT_REQUESTS = 8
+
+RESPONSE_CACHE_SIZE = 100_000
+response_cache = PersistentCache("responses", max_entries=RESPONSE_CACHE_SIZE)
+
+
+class CacheMode(Enum):
+    read_write = "readwrite"  # reuse recorded responses, record new ones
+    off = "off"
+    replay = "replay"  # only use recorded responses, never call the API
+
+
+class ResponseNotRecorded(Exception):
+    """
+    Raised in replay mode for a prompt that has no recorded response.
+    """
+
 
 class Model:
-    def __init__(self, model_name: str):
+    def __init__(
+        self,
+        model_name: str,
+        max_in_flight: int = MAX_IN_FLIGHT_REQUESTS,
+        rate_limiter: RateLimiter = None,
+        cache_mode: CacheMode = CacheMode.read_write,
+        backend: Backend = None,
+        stream: bool = False,
+    ):
         self.model_name = model_name
-        # self.api_endpoint = env["OPENAI_API_ENDPOINT"]
-        # self.auth_headers = env["OPENAI_AUTH_HEADERS"]
-        self.api_key = env["OPENAI_API_KEY"]
-
-    def query(self, query: str) -> str:
-        prompt = [
+        # aquery streams answers and stops them once the numbered items are complete
+        self.stream = stream
+        # defaults to the backend selected for the whole pipeline
+        self._backend = backend
+        self.max_in_flight = max_in_flight
+        self.rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.cache_mode = cache_mode
+        # asyncio semaphores are bound to the event loop they are first used in
+        self._semaphores = weakref.WeakKeyDictionary()
+        # requests being sent by aquery, shared by identical prompts
+        self._in_flight: dict[str, asyncio.Task] = {}
+
+    def _messages(self, query: str) -> list[dict]:
+        return [
             {
                 "role": "system",
                 "content": "You are a smart code reviewer who can spot code that uses a non-existent or deprecated API.",
@@ -33,16 +74,259 @@ class Model:
             {"role": "user", "content": query},
         ]
 
-        openai.api_key = self.api_key
+    @property
+    def backend(self) -> Backend:
+        return self._backend if self._backend is not None else get_backend()
 
-        response = openai.ChatCompletion.create(
-            messages=prompt, model=self.model_name, **LLM_API_PARAMS
+    def _cache_key(self, messages: list[dict]) -> str:
+        return chat_request_key(
+            self.model_name, messages, LLM_API_PARAMS, self.backend.identity
         )
 
-        result = response["choices"][0]["message"]["content"]
+    def _recorded_response(self, cache_key: str) -> str | None:
+        if self.cache_mode == CacheMode.off:
+            return None
+
+        recorded = response_cache.get(cache_key)
+        if recorded is None:
+            if self.cache_mode == CacheMode.replay:
+                raise ResponseNotRecorded(
+                    f"No recorded {self.model_name} response for prompt {cache_key}"
+                )
+            return None
+
+        return recorded.decode("utf-8")
+
+    def _record_response(self, cache_key: str, result: str):
+        if self.cache_mode != CacheMode.off and result is not None:
+            response_cache.put(cache_key, result.encode("utf-8"))
+
+    def _reserve(self, messages: list[dict]) -> tuple[int, float]:
+        # reserve the prompt and the longest answer, refunded once usage is known
+        tokens = sum(count_tokens([message["content"] for message in messages]))
+        tokens += MAX_RESPONSE_TOKENS
+        return tokens, self.rate_limiter.reserve(tokens)
+
+    def _settle(self, reserved_tokens: int, response) -> str:
+        usage = response.get("usage")
+        if usage is not None:
+            self.rate_limiter.refund(reserved_tokens - usage["total_tokens"])
+        return response["choices"][0]["message"]["content"]
+
+    def query(self, query: str) -> str:
+        """
+        Returns the model's answer to the query. Answers are recorded by
+        (model, parameters, prompt), so the same prompt is only sent once.
+        """
+        prompt = self._messages(query)
+        cache_key = self._cache_key(prompt)
+
+        recorded = self._recorded_response(cache_key)
+        if recorded is not None:
+            return recorded
+
+        reserved_tokens, delay = self._reserve(prompt)
+        time.sleep(delay)
+
+        try:
+            response = self.backend.chat(prompt, self.model_name, **LLM_API_PARAMS)
+        except BaseException:
+            # a failed request uses no tokens; retrying it reserves them again
+            self.rate_limiter.refund(reserved_tokens)
+            raise
+
+        result = self._settle(reserved_tokens, response)
+        self._record_response(cache_key, result)
+        return result
 
+    async def aquery(self, query: str, sections: int = 1) -> str:
+        """
+        Same as query, without blocking the event loop. At most max_in_flight
+        requests are sent at once, requests wait for the rate limiter's
+        requests and tokens per minute quotas, and concurrent identical
+        prompts share a single request. With stream, only the answer up to
+        the last numbered item of its `sections` sections (one per snippet
+        of a batched prompt) is requested (see astream_query).
+        """
+        prompt = self._messages(query)
+        cache_key = self._cache_key(prompt)
+
+        recorded = self._recorded_response(cache_key)
+        if recorded is not None:
+            return recorded
+
+        request = self._in_flight.get(cache_key)
+        if request is None:
+            request = asyncio.ensure_future(self._arequest(prompt, cache_key, sections))
+            self._in_flight[cache_key] = request
+            request.add_done_callback(lambda _: self._in_flight.pop(cache_key, None))
+
+        # a cancelled caller does not cancel the request others wait for
+        return await asyncio.shield(request)
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_in_flight)
+        return self._semaphores[loop]
+
+    async def _arequest(self, prompt: list[dict], cache_key: str, sections: int) -> str:
+        if self.stream:
+            # an empty completion streams no chunks at all
+            result = ""
+            async for parser in self._astream(prompt, cache_key, sections):
+                result = parser.result
+            return result
+
+        async with self._semaphore():
+            reserved_tokens, delay = self._reserve(prompt)
+            try:
+                await asyncio.sleep(delay)
+                response = await self.backend.achat(
+                    prompt, self.model_name, **LLM_API_PARAMS
+                )
+            except BaseException:
+                self.rate_limiter.refund(reserved_tokens)
+                raise
+
+        result = self._settle(reserved_tokens, response)
+        self._record_response(cache_key, result)
         return result
 
+    async def astream_query(self, query: str, sections: int = 1):
+        """
+        Streams the model's answer to the query, yielding a
+        StreamingResponseParser after each chunk so that callers can look
+        at the partial response. The stream is stopped as soon as the
+        numbered items of all `sections` sections of the answer are
+        complete, and the answer up to
+        there is recorded like query's. Unlike aquery, identical prompts
+        are not shared.
+        """
+        prompt = self._messages(query)
+        cache_key = self._cache_key(prompt)
+
+        recorded = self._recorded_response(cache_key)
+        if recorded is not None:
+            parser = StreamingResponseParser(sections)
+            parser.feed(recorded)
+            yield parser
+            return
+
+        async for parser in self._astream(prompt, cache_key, sections):
+            yield parser
+
+    async def _astream(self, prompt: list[dict], cache_key: str, sections: int):
+        async with self._semaphore():
+            reserved_tokens, delay = self._reserve(prompt)
+            await asyncio.sleep(delay)
+
+            parser = StreamingResponseParser(sections)
+            try:
+                async with contextlib.aclosing(
+                    self.backend.achat_stream(prompt, self.model_name, **LLM_API_PARAMS)
+                ) as contents:
+                    async for content in contents:
+                        complete = parser.feed(content)
+                        yield parser
+                        if complete:
+                            break
+            except Exception:
+                self.rate_limiter.refund(reserved_tokens)
+                raise
+
+        # streamed answers come without usage, so count the tokens received
+        self.rate_limiter.refund(
+            MAX_RESPONSE_TOKENS - count_tokens([parser.result])[0]
+        )
+        self._record_response(cache_key, parser.result)
+
+
+class StreamingResponseParser:
+    """
+    Follows an answer in the numbered format of the fixing prompt as it
+    arrives: the fenced code block of item 1, the reason of item 2 and the
+    references of item 3. Once item 3 is complete, whatever the model adds
+    after it (often a long explanation) is not needed to parse the answer,
+    so `complete` is set and `result` holds the answer up to there.
+
+    A batched answer has one such section per snippet; with `sections`, the
+    answer is only complete once that many sections are.
+    """
+
+    REFERENCE_ITEM = re.compile(r"^(?:[-*]|\d+(?:\s*,\s*\d+)*\.?$)")
+
+    def __init__(self, sections: int = 1):
+        self.text = ""
+        self.sections = sections
+        self.sections_complete = 0
+        self.complete = False
+        self._end = None
+        self._line_start = 0
+        self._start_section()
+
+    def _start_section(self):
+        self.code_complete = False
+        self.reason_complete = False
+        self._in_code = False
+        self._reference_items = 0
+
+    @property
+    def result(self) -> str:
+        return self.text[: self._end] if self.complete else self.text
+
+    def feed(self, content: str) -> bool:
+        """
+        Adds the next chunk of the answer and returns whether the answer is
+        complete.
+        """
+        self.text += content
+        while not self.complete:
+            line_end = self.text.find("\n", self._line_start)
+            if line_end == -1:
+                break
+            self._parse_line(self.text[self._line_start : line_end].strip(), line_end + 1)
+            self._line_start = line_end + 1
+        return self.complete
+
+    def response(self, original_code: CodeSnippet) -> ModelResponse:
+        """
+        The answer so far, parsed like a whole answer.
+        """
+        return parse_model_response(self.result, original_code)
+
+    def _finish_section(self, end: int) -> bool:
+        self.sections_complete += 1
+        if self.sections_complete == self.sections:
+            self.complete = True
+            self._end = end
+            return True
+        self._start_section()
+        return False
+
+    def _parse_line(self, line: str, line_end: int):
+        if not self.code_complete:
+            for _ in range(line.count("```")):
+                if self._in_code:
+                    self.code_complete = True
+                    break
+                self._in_code = True
+        elif not self.reason_complete:
+            if line.startswith("3."):
+                self.reason_complete = True
+                references = line[len("3.") :].strip()
+                # otherwise the references follow as a list
+                if references != "" and not references.endswith(":"):
+                    self._finish_section(line_end)
+        elif line == "":
+            if self._reference_items > 0:
+                self._finish_section(line_end)
+        elif self.REFERENCE_ITEM.match(line):
+            self._reference_items += 1
+        elif not self._finish_section(self._line_start):
+            # the line after the references belongs to the next section
+            self._parse_line(line, line_end)
+
 
 # Helper functions to process model response
 
@@ -68,122 +352,138 @@ def strip_markdown_keywords(code: str) -> str:
         return code
 
 
-def find_reason_in_response(model_response: str) -> str:
-
-    reason = None
-
-    prefixes = ["Reason for update:"]
-    # try first the case where the model respects the enumeration
-    reason_matches = re.search(r"^2\.(.*)", model_response, re.MULTILINE)
-    reason = reason_matches.group(1).strip() if reason_matches else None
-
-    if reason is not None:
-        # check if reason starts with any of the prefixes and strip out the prefix
-        for prefix in prefixes:
-            if prefix in reason:
-                reason = reason[len(prefix) :].strip()
-                break
-    else:
-        # did not have enumeration so let's try to search in the response
-        for prefix in prefixes:
-            reason_matches = re.search(
-                r"^.*" + prefix + r"(.*)", model_response, re.MULTILINE
-            )
-            if reason_matches:
-                matched_value = reason_matches.group(1).strip()
-                # if the group is empty, then it just matched the prefix
-                # then it still didn't capture the reasons (could be list)
-                if matched_value != "":
-                    reason = matched_value
-                    break
-
-            multi_reason_matches = re.search(
-                r"^.*" + prefix + "\n*(?P<reasons>(-(.*)\n)+)",
-                model_response,
-                re.MULTILINE,
-            )
-            if multi_reason_matches:
-                reason = multi_reason_matches.group("reasons").strip()
+REASON_PREFIX = "Reason for update:"
+REFERENCE_KEYWORDS = [
+    "Reference used:",
+    "Reference number:",
+    "References used:",
+    "Reference numbers used:",
+    "List of reference numbers used:",
+]
+NO_UPDATE_KEYWORDS = ["No update", "does not need to be updated"]
+
+# everything parse_model_response looks for, found in a single scan: fences,
+# "2." and "3." items and the reason prefix (no groups, which slow the scan down)
+RESPONSE_MARKERS = re.compile(
+    r"```|^[23]\.|" + re.escape(REASON_PREFIX), re.MULTILINE
+)
+# a reason given as a list of lines starting with "-" after the prefix
+REASON_LIST = re.compile(
+    r"^.*" + re.escape(REASON_PREFIX) + r"\n*(?P<reasons>(-(.*)\n)+)", re.MULTILINE
+)
+
+
+def _line_end(text: str, start: int) -> int:
+    end = text.find("\n", start)
+    return len(text) if end == -1 else end
+
+
+def _select_code_block(code_blocks: list[str]) -> str | None:
+    if len(code_blocks) == 0:
+        return None
+    if len(code_blocks) == 1:
+        return strip_markdown_keywords(code_blocks[0].strip())
+
+    # prefer a block marked as python, or else the first one longer than the first
+    selected_block = code_blocks[0].strip()
+    for code_block in code_blocks:
+        code = code_block.strip()
+        if code.startswith("python"):
+            selected_block = code
+        elif len(code.splitlines()) > len(selected_block.splitlines()):
+            selected_block = code
+            break
+    return strip_markdown_keywords(selected_block.strip())
+
+
+def _find_reason(
+    model_response: str, item_start: int | None, prefix_start: int | None
+) -> str | None:
+    if item_start is not None:
+        # the enumerated reason, "2. ..."
+        reason = model_response[item_start + 2 : _line_end(model_response, item_start)].strip()
+        if REASON_PREFIX in reason:
+            reason = reason[len(REASON_PREFIX) :].strip()
+    elif prefix_start is not None:
+        # the rest of the first line with the prefix, after its last occurrence
+        line_end = _line_end(model_response, prefix_start)
+        last_prefix = model_response.rfind(REASON_PREFIX, prefix_start, line_end)
+        reason = model_response[last_prefix + len(REASON_PREFIX) : line_end].strip()
+        if reason == "":
+            reason = None
+            reason_list = REASON_LIST.search(model_response)
+            if reason_list:
+                reason = reason_list.group("reasons").strip()
                 if len(reason.splitlines()) == 1 and reason.startswith("-"):
-                    # if it's a single reason, remove the - since it's not
-                    # really a list
+                    # a single reason is not really a list
                     reason = reason[1:].strip()
-                break
+    else:
+        reason = None
 
     if reason == "None":
         reason = None
-
     return reason
 
 
-def find_references_in_response(model_response: str) -> str:
-    references = None
-    reference_keywords = [
-        "Reference used:",
-        "Reference number:",
-        "References used:",
-        "Reference numbers used:",
-        "List of reference numbers used:",
-    ]
-    reference_matches = re.search(r"^3\.(.*)\n", model_response, re.MULTILINE)
-    references = reference_matches.group(1).strip() if reference_matches else None
+def _find_references(model_response: str, item_start: int | None) -> str | None:
+    if item_start is not None:
+        # the enumerated references, "3. ...", on a complete line
+        line_end = model_response.find("\n", item_start)
+        if line_end != -1:
+            return model_response[item_start + 2 : line_end].strip()
 
     # response did not follow enumerated format
-    if references == None:
-        for keyword in reference_keywords:
-            if keyword in model_response:
-                references = model_response.split(keyword)[1].strip()
-
-                if references.strip(".") == "No references used":
-                    references = None
+    for keyword in REFERENCE_KEYWORDS:
+        if keyword in model_response:
+            references = model_response.split(keyword)[1].strip()
+            if references.strip(".") == "No references used":
+                return None
+            return references
 
-                break
-
-    return references
+    return None
 
 
 def _is_no_update(model_response: str) -> bool:
-    no_update_keywords = ["No update", "does not need to be updated"]
-
-    if any(keyword in model_response for keyword in no_update_keywords):
-        return True
-
-    if model_response == "No references used":
+    if any(keyword in model_response for keyword in NO_UPDATE_KEYWORDS):
         return True
 
-    return False
-
-
-def _find_updated_code_snippet(model_response: str) -> str:
-    # match the updated code by looking for the fenced code block, even without the correct enumeration
-
-    code_snippets = re.findall(r"\s*(```)\s*([\s\S]*?)(```|$)", model_response)
-
-    updated_code = None
-
-    if len(code_snippets) == 0:
-        return updated_code
-    elif len(code_snippets) == 1:
-        updated_code = strip_markdown_keywords(code_snippets[0][1].strip())
-    else:
-        selected_snippet = code_snippets[0][1].strip()
-        for snippet in code_snippets:
-            code = snippet[1].strip()
-            if code.startswith("python"):
-                selected_snippet = code
-            else:
-                if len(code.splitlines()) > len(selected_snippet.splitlines()):
-                    selected_snippet = code
-                    break
-        updated_code = strip_markdown_keywords(selected_snippet.strip())
-    return updated_code
+    return model_response == "No references used"
 
 
 def parse_model_response(
     model_response: str, original_code: CodeSnippet
 ) -> ModelResponse:
+    """
+    Parses the numbered answer to the fixing prompt, tolerating the ways the
+    model strays from the format: code blocks without enumeration or with
+    extra fencing, reasons and references introduced by keywords instead of
+    numbers, and reasons given as lists.
+
+    All markers are found in a single scan of the response: fences pair up
+    into code blocks (an unclosed block runs to the end), and the first "2."
+    and "3." lines and the first line with the reason prefix are kept.
+    """
+    code_blocks = []
+    fence_start = None
+    item_starts = {}
+    prefix_start = None
+
+    for marker in RESPONSE_MARKERS.finditer(model_response):
+        first_char = marker.group()[0]
+        if first_char == "`":
+            if fence_start is None:
+                fence_start = marker.end()
+            else:
+                code_blocks.append(model_response[fence_start : marker.start()])
+                fence_start = None
+        elif first_char != "R":
+            item_starts.setdefault(first_char, marker.start())
+        elif prefix_start is None:
+            prefix_start = marker.start()
+    if fence_start is not None:
+        code_blocks.append(model_response[fence_start:])
 
-    updated_code = _find_updated_code_snippet(model_response)
+    updated_code = _select_code_block(code_blocks)
 
     if updated_code is not None and updated_code.strip() != "":
         if ("No changes needed" in updated_code) or (
@@ -198,16 +498,40 @@ def parse_model_response(
         else:
             update_status = UpdateStatus.NO_RESPONSE
 
-    reason = find_reason_in_response(model_response)
-    references = find_references_in_response(model_response)
-
-    response = ModelResponse(
+    return ModelResponse(
         raw_response=model_response,
         original_code=original_code,
         update_status=update_status,
-        references=references,
+        references=_find_references(model_response, item_starts.get("3")),
         updated_code=CodeSnippet(code=updated_code),
-        reason=reason,
+        reason=_find_reason(model_response, item_starts.get("2"), prefix_start),
     )
 
-    return response
+
+SNIPPET_HEADING = re.compile(
+    r"^[ \t]*(?:#+[ \t]*)?\**[ \t]*Snippet[ \t]+(\d+)[ \t]*\**:?[ \t]*\**[ \t]*$",
+    re.MULTILINE | re.IGNORECASE,
+)
+
+
+def parse_batch_response(
+    model_response: str, original_codes: list[CodeSnippet]
+) -> list[ModelResponse] | None:
+    """
+    Splits the answer to a batched prompt into one ModelResponse per snippet,
+    in order. Returns None if the answer does not have exactly one section
+    per snippet, so that the snippets can be asked about one by one instead.
+    """
+    headings = list(SNIPPET_HEADING.finditer(model_response))
+    numbers = [int(heading.group(1)) for heading in headings]
+    if numbers != list(range(1, len(original_codes) + 1)):
+        return None
+
+    # each section ends with a newline, like a whole answer to the single prompt
+    ends = [heading.start() for heading in headings[1:]] + [len(model_response)]
+    return [
+        parse_model_response(
+            model_response[heading.end() : end].strip() + "\n", original_code
+        )
+        for heading, end, original_code in zip(headings, ends, original_codes)
+    ]
@@ -0,0 +1,67 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Bucket holding up to `per_minute` units, refilled continuously at
+    per_minute / 60 units per second. A reservation always succeeds and may
+    drive the level negative; the caller then waits until the bucket has
+    refilled to zero, so requests are spread out at the allowed rate.
+    Thread safe.
+    """
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.level = per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        """
+        Takes `amount` units and returns how many seconds to wait before
+        using them.
+        """
+        with self._lock:
+            self._refill()
+            self.level -= amount
+            return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount: float):
+        with self._lock:
+            self._refill()
+            self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """
+    Keeps requests under a requests-per-minute and a tokens-per-minute quota
+    (either may be None for no limit). Tokens are reserved up front from an
+    estimate and the unused part is refunded once the actual usage is known.
+    """
+
+    def __init__(self, requests_per_minute: float = None, tokens_per_minute: float = None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+
+    def reserve(self, tokens: int) -> float:
+        """
+        Reserves one request and `tokens` tokens, returning the number of
+        seconds to wait before sending the request.
+        """
+        delays = [0.0]
+        if self.requests is not None:
+            delays.append(self.requests.reserve(1))
+        if self.tokens is not None:
+            delays.append(self.tokens.reserve(tokens))
+        return max(delays)
+
+    def refund(self, tokens: int):
+        if self.tokens is not None and tokens > 0:
+            self.tokens.refund(tokens)
@@ -0,0 +1,390 @@
+import asyncio
+import contextlib
+import random
+import re
+import threading
+import time
+import weakref
+import openai
+from upgraider.Backend import Backend
+
+MAX_RETRIES = 6
+BASE_RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+
+# requests sent concurrently when the server is not pushing back
+MAX_CONCURRENCY = 8
+
+
+def _parse_duration(value: str) -> float | None:
+    """
+    Parses a rate limit duration header: plain seconds ("1.5") or the
+    OpenAI reset format ("20ms", "1s", "6m0s").
+    """
+    if value is None:
+        return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts or "".join(number + unit for number, unit in parts) != value:
+        return None
+    units = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+    return sum(float(number) * units[unit] for number, unit in parts)
+
+
+def retry_after(headers) -> float | None:
+    """
+    Seconds the server asked us to wait before retrying, if it said so.
+    """
+    if not headers:
+        return None
+    headers = {name.lower(): value for name, value in headers.items()}
+    if "retry-after-ms" in headers:
+        delay = _parse_duration(headers["retry-after-ms"])
+        return delay / 1000 if delay is not None else None
+    return _parse_duration(headers.get("retry-after"))
+
+
+def quota_reset(headers) -> float | None:
+    """
+    Seconds until the request or token quota resets, when the server
+    reports that it has run out (x-ratelimit-remaining-* of 0).
+    """
+    if not headers:
+        return None
+    headers = {name.lower(): value for name, value in headers.items()}
+
+    delays = []
+    for quota in ["requests", "tokens"]:
+        remaining = headers.get(f"x-ratelimit-remaining-{quota}")
+        try:
+            exhausted = remaining is not None and float(remaining) <= 0
+        except ValueError:
+            exhausted = False
+        if exhausted:
+            delay = _parse_duration(headers.get(f"x-ratelimit-reset-{quota}"))
+            if delay is not None:
+                delays.append(delay)
+    return max(delays) if delays else None
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(
+        error,
+        (
+            openai.error.RateLimitError,
+            openai.error.ServiceUnavailableError,
+            openai.error.APIConnectionError,
+            openai.error.Timeout,
+            openai.error.TryAgain,
+        ),
+    ):
+        return True
+    # server errors; other API errors are the request's fault
+    return isinstance(error, openai.error.APIError) and (
+        error.http_status is None or error.http_status >= 500
+    )
+
+
+def is_throttle(error: Exception) -> bool:
+    return isinstance(
+        error, (openai.error.RateLimitError, openai.error.ServiceUnavailableError)
+    )
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with jitter: the n-th retry waits a random time
+    between half and all of base_delay * 2^n (capped at max_delay), or what
+    the server's Retry-After header asks for, if it sent one.
+    """
+
+    def __init__(
+        self,
+        max_retries: int = MAX_RETRIES,
+        base_delay: float = BASE_RETRY_DELAY,
+        max_delay: float = MAX_RETRY_DELAY,
+        seed: int = None,
+    ):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._random = random.Random(seed)
+
+    def delay(self, error: Exception, attempt: int) -> float:
+        requested = retry_after(getattr(error, "headers", None))
+        if requested is not None:
+            # spread out the clients that were all told the same time
+            return min(self.max_delay, requested * self._random.uniform(1.0, 1.1))
+
+        backoff = min(self.max_delay, self.base_delay * 2**attempt)
+        return self._random.uniform(backoff / 2, backoff)
+
+
+class AimdController:
+    """
+    Limits the number of concurrent requests, adapting to the server:
+    every successful request raises the limit by increase / limit (so by
+    `increase` per round of requests), and a throttled request multiplies
+    it by `decrease`, at most once per round so that one burst of 429s
+    only counts once. A throttle, or a response reporting an exhausted
+    quota, also pauses all new requests for the time the server asks.
+
+    Async requests wait for a free slot; blocking requests only wait out
+    pauses.
+    """
+
+    def __init__(
+        self,
+        max_limit: int = MAX_CONCURRENCY,
+        min_limit: int = 1,
+        increase: float = 1.0,
+        decrease: float = 0.5,
+    ):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.increase = increase
+        self.decrease = decrease
+        self.limit = float(max_limit)
+        self.in_flight = 0
+        self.resume_at = 0.0
+        self._started = 0
+        self._last_decrease = 0
+        self._lock = threading.Lock()
+        # asyncio conditions are bound to the event loop they are first used in
+        self._conditions = weakref.WeakKeyDictionary()
+
+    @property
+    def concurrency(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    def _condition(self) -> asyncio.Condition:
+        loop = asyncio.get_running_loop()
+        if loop not in self._conditions:
+            self._conditions[loop] = asyncio.Condition()
+        return self._conditions[loop]
+
+    def _start(self) -> int:
+        with self._lock:
+            self.in_flight += 1
+            self._started += 1
+            return self._started
+
+    def wait_time(self) -> float:
+        return max(0.0, self.resume_at - time.monotonic())
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self.resume_at = max(self.resume_at, time.monotonic() + seconds)
+
+    def start(self) -> int:
+        """
+        Blocks until requests are not paused and returns the request's
+        ticket, to pass to done.
+        """
+        while (delay := self.wait_time()) > 0:
+            time.sleep(delay)
+        return self._start()
+
+    async def astart(self) -> int:
+        """
+        Waits until requests are not paused and fewer than `concurrency`
+        are in flight, and returns the request's ticket.
+        """
+        condition = self._condition()
+        while True:
+            delay = self.wait_time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            async with condition:
+                if self.in_flight < self.concurrency:
+                    return self._start()
+                await condition.wait()
+
+    def done(self, ticket: int, throttled: bool = False, success: bool = False):
+        with self._lock:
+            self.in_flight -= 1
+            if success:
+                self.limit = min(self.max_limit, self.limit + self.increase / self.limit)
+            elif throttled and ticket > self._last_decrease:
+                # requests started before the last decrease were sent at the old limit
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+                self._last_decrease = self._started
+
+    async def adone(self, ticket: int, throttled: bool = False, success: bool = False):
+        self.done(ticket, throttled=throttled, success=success)
+        condition = self._condition()
+        async with condition:
+            condition.notify(max(1, self.concurrency - self.in_flight))
+
+
+class RetryingBackend(Backend):
+    """
+    Sends requests to `backend`, retrying transient failures (rate limits,
+    overloaded or unreachable servers, 5xx) according to `policy`, with
+    concurrency adapted to the server's rate limit signals by `controller`.
+    Other errors, and the last failure once retries run out, are raised.
+    """
+
+    def __init__(
+        self,
+        backend: Backend,
+        policy: RetryPolicy = None,
+        controller: AimdController = None,
+    ):
+        self.backend = backend
+        self.policy = policy if policy is not None else RetryPolicy()
+        self.controller = controller if controller is not None else AimdController()
+        self.backend.header_listener = self._observe_headers
+        self.requests = 0
+        self.successes = 0
+        self.retries = 0
+        self.throttles = 0
+        self.failures = 0
+        self._first_request = None
+        self._last_success = None
+        self._lock = threading.Lock()
+
+    @property
+    def identity(self) -> str | None:
+        return self.backend.identity
+
+    def _observe_headers(self, headers):
+        reset = quota_reset(headers)
+        if reset is not None:
+            self.controller.pause(reset)
+
+    def _count_request(self):
+        with self._lock:
+            self.requests += 1
+            if self._first_request is None:
+                self._first_request = time.monotonic()
+
+    def _count_success(self):
+        with self._lock:
+            self.successes += 1
+            self._last_success = time.monotonic()
+
+    def _handle_failure(self, error: Exception, attempt: int) -> float:
+        """
+        Counts the failure and returns how long to wait before retrying it,
+        or raises it if it should not be retried.
+        """
+        throttled = is_throttle(error)
+        with self._lock:
+            if throttled:
+                self.throttles += 1
+            if not is_retryable(error) or attempt >= self.policy.max_retries:
+                self.failures += 1
+                raise error
+            self.retries += 1
+
+        delay = self.policy.delay(error, attempt)
+        if throttled:
+            # every request holds off, not just the one that was throttled
+            self.controller.pause(delay)
+        self._observe_headers(getattr(error, "headers", None))
+        return delay
+
+    def _call(self, request):
+        for attempt in range(self.policy.max_retries + 1):
+            ticket = self.controller.start()
+            self._count_request()
+            try:
+                response = request()
+            except openai.error.OpenAIError as e:
+                self.controller.done(ticket, throttled=is_throttle(e))
+                delay = self._handle_failure(e, attempt)
+            except BaseException:
+                self.controller.done(ticket)
+                raise
+            else:
+                self.controller.done(ticket, success=True)
+                self._count_success()
+                return response
+            time.sleep(delay)
+
+    async def _acall(self, request):
+        for attempt in range(self.policy.max_retries + 1):
+            ticket = await self.controller.astart()
+            self._count_request()
+            try:
+                response = await request()
+            except openai.error.OpenAIError as e:
+                await self.controller.adone(ticket, throttled=is_throttle(e))
+                delay = self._handle_failure(e, attempt)
+            except BaseException:
+                await self.controller.adone(ticket)
+                raise
+            else:
+                await self.controller.adone(ticket, success=True)
+                self._count_success()
+                return response
+            await asyncio.sleep(delay)
+
+    def chat(self, messages: list[dict], model: str, **params) -> dict:
+        return self._call(lambda: self.backend.chat(messages, model, **params))
+
+    async def achat(self, messages: list[dict], model: str, **params) -> dict:
+        return await self._acall(lambda: self.backend.achat(messages, model, **params))
+
+    async def achat_stream(self, messages: list[dict], model: str, **params):
+        """
+        Streams the answer, retrying failures that happen before any of it
+        has arrived; later failures are raised.
+        """
+        for attempt in range(self.policy.max_retries + 1):
+            ticket = await self.controller.astart()
+            self._count_request()
+            started = False
+            try:
+                async with contextlib.aclosing(
+                    self.backend.achat_stream(messages, model, **params)
+                ) as contents:
+                    async for content in contents:
+                        started = True
+                        yield content
+            except openai.error.OpenAIError as e:
+                await self.controller.adone(ticket, throttled=is_throttle(e))
+                if started:
+                    with self._lock:
+                        self.failures += 1
+                    raise
+                delay = self._handle_failure(e, attempt)
+            except GeneratorExit:
+                # the caller has all it needs
+                await self.controller.adone(ticket, success=True)
+                self._count_success()
+                raise
+            except BaseException:
+                await self.controller.adone(ticket)
+                raise
+            else:
+                await self.controller.adone(ticket, success=True)
+                self._count_success()
+                return
+            await asyncio.sleep(delay)
+
+    def embed(self, input: str | list[str], model: str) -> dict:
+        return self._call(lambda: self.backend.embed(input, model))
+
+    def stats(self) -> dict:
+        with self._lock:
+            elapsed = (
+                self._last_success - self._first_request
+                if self._last_success is not None
+                else 0.0
+            )
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "throttles": self.throttles,
+                "failures": self.failures,
+                "qps": round(self.successes / elapsed, 2) if elapsed > 0 else 0.0,
+                "concurrency": self.controller.concurrency,
+            }
@@ -0,0 +1,340 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import contextlib
+import subprocess
+from collections import namedtuple
+from os import environ as env
+from dotenv import load_dotenv
+
+load_dotenv(override=True)
+
+# environments kept before the least recently used ones are deleted
+MAX_ENVIRONMENTS = 8
+MANIFEST_FILE = "upgraider-venv.json"
+
+EnvironmentKey = namedtuple(
+    "EnvironmentKey", ["library", "version", "requirements_hash", "python_version"]
+)
+Environment = namedtuple("Environment", ["path", "python", "key"])
+
+
+class VenvBuildError(Exception):
+    """
+    Raised when an environment cannot be created, its packages cannot be
+    installed, or the installed library is not the requested version.
+    """
+
+
+def requirements_hash(requirements_file: str | None) -> str:
+    if requirements_file is None:
+        return "none"
+    with open(requirements_file, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _release(version: str) -> tuple[str, ...]:
+    # library.json versions look like "v2.0" where the package reports "2.0.0"
+    release = version.strip().removeprefix("v").split(".")
+    while len(release) > 1 and release[-1] == "0":
+        release.pop()
+    return tuple(release)
+
+
+def same_version(version: str, other: str) -> bool:
+    return _release(version) == _release(other)
+
+
+def _venv_python(path: str) -> str:
+    return os.path.join(path, "bin", "python")
+
+
+def _directory_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            file_path = os.path.join(root, file)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
+
+def overlay_env(environment: Environment, overlay_dir: str) -> dict[str, str]:
+    """
+    Environment variables for running a snippet with the given environment's
+    interpreter, with the run's files (home, temporary files, bytecode) kept
+    in overlay_dir so that runs sharing the environment do not see each
+    other's leftovers.
+    """
+    run_env = {
+        name: value
+        for name, value in os.environ.items()
+        if name not in ("PYTHONPATH", "PYTHONHOME", "PYTHONSTARTUP", "VIRTUAL_ENV")
+    }
+    for name in ("HOME", "TMPDIR", "MPLCONFIGDIR"):
+        run_env[name] = overlay_dir
+    run_env["VIRTUAL_ENV"] = environment.path
+    run_env["PATH"] = os.pathsep.join(
+        [os.path.join(environment.path, "bin"), os.environ.get("PATH", "")]
+    )
+    run_env["PYTHONDONTWRITEBYTECODE"] = "1"
+    run_env["PYTHONNOUSERSITE"] = "1"
+    return run_env
+
+
+class VenvPool:
+    """
+    Virtual environments with a given library version installed, kept under
+    `root` and reused across snippets, runs and processes. Each environment
+    is keyed by (library, version, sha256 of the requirements file, Python
+    version), built once, verified, and evicted least recently used first
+    once there are more than max_environments of them or they take more
+    than max_bytes.
+
+    Environments are guarded by file locks: builds and evictions take an
+    exclusive lock, and acquire holds a shared one while the environment is
+    in use, so an environment is never deleted under a running snippet.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        python: str = sys.executable,
+        max_environments: int = MAX_ENVIRONMENTS,
+        max_bytes: int = None,
+    ):
+        self.root = root
+        self.python = python
+        self.max_environments = max_environments
+        self.max_bytes = max_bytes
+        self._python_version = None
+        self.builds = 0
+        self.reuses = 0
+
+    @property
+    def python_version(self) -> str:
+        if self._python_version is None:
+            self._python_version = subprocess.run(
+                [self.python, "-c", "import sys; print('%d.%d' % sys.version_info[:2])"],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout.strip()
+        return self._python_version
+
+    def key(
+        self, library: str, version: str, requirements_file: str = None
+    ) -> EnvironmentKey:
+        return EnvironmentKey(
+            library, version, requirements_hash(requirements_file), self.python_version
+        )
+
+    def _path(self, key: EnvironmentKey) -> str:
+        name = f"{key.library}-{key.version}-py{key.python_version}-{key.requirements_hash[:12]}"
+        return os.path.join(self.root, name)
+
+    def _lock_path(self, path: str) -> str:
+        return f"{path}.lock"
+
+    def _lock(self, path: str):
+        os.makedirs(self.root, exist_ok=True)
+        return open(self._lock_path(path), "a")
+
+    def _holds(self, lock, path: str) -> bool:
+        """
+        Whether the locked file is still the environment's lock file, and
+        not one that an eviction removed while we waited for it.
+        """
+        try:
+            return os.stat(self._lock_path(path)).st_ino == os.fstat(lock.fileno()).st_ino
+        except FileNotFoundError:
+            return False
+
+    def _manifest_path(self, path: str) -> str:
+        return os.path.join(path, MANIFEST_FILE)
+
+    def _read_manifest(self, path: str) -> dict | None:
+        try:
+            with open(self._manifest_path(path), "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # the modification time records the last use
+        manifest["last_used"] = os.path.getmtime(self._manifest_path(path))
+        return manifest
+
+    @contextlib.contextmanager
+    def acquire(self, library: str, version: str, requirements_file: str = None):
+        """
+        Yields the Environment for the library version and requirements,
+        building it first if needed; it is not evicted until released.
+        """
+        key = self.key(library, version, requirements_file)
+        path = self._path(key)
+        built = False
+
+        lock = None
+        try:
+            while True:
+                if lock is None:
+                    lock = self._lock(path)
+                fcntl.flock(lock, fcntl.LOCK_SH)
+                if not self._holds(lock, path):
+                    lock.close()
+                    lock = None
+                    continue
+                if self._read_manifest(path) is not None:
+                    break
+
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not self._holds(lock, path):
+                    lock.close()
+                    lock = None
+                    continue
+                if self._read_manifest(path) is None:
+                    try:
+                        self._build(key, path, requirements_file)
+                    except VenvBuildError:
+                        os.remove(self._lock_path(path))
+                        raise
+                    built = True
+
+            if built:
+                self.builds += 1
+            else:
+                self.reuses += 1
+            os.utime(self._manifest_path(path))
+
+            yield Environment(path, _venv_python(path), key)
+        finally:
+            if lock is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                lock.close()
+
+        if built:
+            self.evict()
+
+    def _create(self, path: str):
+        subprocess.run(
+            [self.python, "-m", "venv", path], check=True, capture_output=True, text=True
+        )
+
+    def _install(self, python: str, library: str, version: str, requirements_file: str):
+        pip = [python, "-m", "pip", "install", "--disable-pip-version-check", "--quiet"]
+        subprocess.run(pip + [f"{library}=={version.removeprefix('v')}"], check=True, capture_output=True, text=True)
+        if requirements_file is not None:
+            subprocess.run(pip + ["-r", requirements_file], check=True, capture_output=True, text=True)
+
+    def _verify(self, python: str, library: str, version: str):
+        installed = subprocess.run(
+            [python, "-c", f"import importlib.metadata; print(importlib.metadata.version({library!r}))"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        if not same_version(installed, version):
+            raise VenvBuildError(f"{library} {installed} was installed instead of {version}")
+
+    def _build(self, key: EnvironmentKey, path: str, requirements_file: str):
+        print(f"Building environment for {key.library}=={key.version} in {path}...")
+        # left over from an interrupted build
+        shutil.rmtree(path, ignore_errors=True)
+
+        python = _venv_python(path)
+        try:
+            self._create(path)
+            self._install(python, key.library, key.version, requirements_file)
+            self._verify(python, key.library, key.version)
+        except subprocess.CalledProcessError as e:
+            shutil.rmtree(path, ignore_errors=True)
+            raise VenvBuildError(
+                f"Could not build environment for {key.library}=={key.version}: {e.stderr}"
+            )
+        except VenvBuildError:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+
+        manifest = {**key._asdict(), "size": _directory_size(path), "created": time.time()}
+        # written last, so only complete environments have a manifest
+        with open(self._manifest_path(path), "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+
+    def environments(self) -> list[tuple[str, dict]]:
+        """
+        The (path, manifest) of every environment, least recently used first.
+        """
+        if not os.path.exists(self.root):
+            return []
+
+        environments = []
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if os.path.isdir(path):
+                manifest = self._read_manifest(path)
+                if manifest is not None:
+                    environments.append((path, manifest))
+        return sorted(environments, key=lambda environment: environment[1]["last_used"])
+
+    def evict(self):
+        """
+        Deletes the least recently used environments that are not in use
+        until the pool is within its quotas.
+        """
+        environments = self.environments()
+        total_bytes = sum(manifest["size"] for _, manifest in environments)
+
+        for path, manifest in environments:
+            over_count = len(environments) > self.max_environments
+            over_bytes = self.max_bytes is not None and total_bytes > self.max_bytes
+            if not (over_count or over_bytes):
+                break
+
+            with self._lock(path) as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    # in use
+                    continue
+                if self._holds(lock, path):
+                    if self._read_manifest(path) is not None:
+                        print(f"Evicting environment {path}...")
+                        os.remove(self._manifest_path(path))
+                        shutil.rmtree(path, ignore_errors=True)
+                    # while still locked, so waiting acquires see it is gone
+                    os.remove(self._lock_path(path))
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+            environments = [e for e in environments if e[0] != path]
+            total_bytes -= manifest["size"]
+
+    def stats(self) -> dict[str, int]:
+        return {"builds": self.builds, "reuses": self.reuses}
+
+
+_venv_pool: VenvPool = None
+
+
+def get_venv_pool() -> VenvPool:
+    """
+    Returns the pool selected with set_venv_pool, or else one kept in
+    UPGRAIDER_VENV_POOL, which defaults to the pool folder of SCRATCH_VENV.
+    """
+    global _venv_pool
+
+    if _venv_pool is None:
+        root = env.get("UPGRAIDER_VENV_POOL")
+        if root is None:
+            root = os.path.join(env.get("SCRATCH_VENV", tempfile.gettempdir()), "pool")
+        _venv_pool = VenvPool(root)
+
+    return _venv_pool
+
+
+def set_venv_pool(venv_pool: VenvPool):
+    global _venv_pool
+    _venv_pool = venv_pool
@@ -0,0 +1,164 @@
+"""
+Runs snippets for ForkServer inside a library environment. It is started
+with that environment's interpreter (so it can only use the standard
+library), imports the given modules once, and then runs each requested
+file in a forked child, so that every snippet starts from the preloaded
+modules but with its own __main__, warnings state and module state.
+
+Requests are read from stdin and replies written to stdout, one JSON
+object per line:
+
+    {"id": 1, "file": "/abs/path.py", "cwd": "/overlay", "env": {...}}
+    {"id": 1, "returncode": 0, "stderr": "..."}
+
+Several snippets may run at once; replies come in the order they finish.
+"""
+import os
+import sys
+import json
+import runpy
+import selectors
+import tempfile
+import traceback
+import warnings
+import importlib
+import importlib.metadata
+
+# the filters before any library had a chance to add its own
+INITIAL_FILTERS = list(warnings.filters)
+
+
+def preload(libraries):
+    """
+    Imports the top-level packages of each library, or the module of that
+    name if it is not an installed distribution. Modules that fail to
+    import are left for the snippets to report.
+    """
+    try:
+        packages = importlib.metadata.packages_distributions()
+    except AttributeError:
+        packages = {}
+
+    for library in libraries:
+        modules = [
+            module
+            for module, distributions in packages.items()
+            if library.lower() in (d.lower() for d in distributions)
+            and not module.startswith("_")
+        ] or [library]
+        for module in modules:
+            try:
+                importlib.import_module(module)
+            except BaseException:
+                pass
+
+
+def _snippet_traceback(error, file):
+    # drop the frames of this worker and runpy, like the interpreter would
+    tb = error.__traceback__
+    while tb is not None and tb.tb_frame.f_code.co_filename != file:
+        tb = tb.tb_next
+    return tb if tb is not None else error.__traceback__
+
+
+def run_snippet(request):
+    """
+    Runs in the forked child. Returns the exit status, or raises the
+    snippet's SystemExit for the interpreter to handle.
+    """
+    file = request["file"]
+    os.chdir(request["cwd"])
+    os.environ.clear()
+    os.environ.update(request["env"])
+    tempfile.tempdir = None
+
+    sys.argv = [file]
+    sys.path.insert(0, os.path.dirname(file))
+    warnings.filters[:] = INITIAL_FILTERS
+    warnings._filters_mutated()
+
+    try:
+        runpy.run_path(file, run_name="__main__")
+    except SystemExit:
+        raise
+    except BaseException as e:
+        traceback.print_exception(type(e), e, _snippet_traceback(e, file))
+        return 1
+    return 0
+
+
+def _write_line(fd, message):
+    data = (json.dumps(message) + "\n").encode("utf-8")
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def serve(replies):
+    selector = selectors.DefaultSelector()
+    selector.register(sys.stdin.fileno(), selectors.EVENT_READ, None)
+    pending = b""
+    # stderr pipe -> (request id, child pid, stderr chunks)
+    running = {}
+    reading = True
+
+    while reading or running:
+        for key, _ in selector.select():
+            if key.data is None:
+                data = os.read(key.fd, 65536)
+                if not data:
+                    reading = False
+                    selector.unregister(key.fd)
+                    continue
+                pending += data
+                while b"\n" in pending:
+                    line, pending = pending.split(b"\n", 1)
+                    request = json.loads(line)
+
+                    read_end, write_end = os.pipe()
+                    sys.stderr.flush()
+                    pid = os.fork()
+                    if pid == 0:
+                        selector.close()
+                        os.close(read_end)
+                        os.close(replies)
+                        devnull = os.open(os.devnull, os.O_RDONLY)
+                        os.dup2(devnull, 0)
+                        os.dup2(write_end, 2)
+                        os.close(devnull)
+                        os.close(write_end)
+                        for other in running:
+                            os.close(other)
+                        # exits through the interpreter, running atexit handlers
+                        sys.exit(run_snippet(request))
+
+                    os.close(write_end)
+                    running[read_end] = (request["id"], pid, [])
+                    selector.register(read_end, selectors.EVENT_READ, request["id"])
+            else:
+                data = os.read(key.fd, 65536)
+                request_id, pid, chunks = running[key.fd]
+                if data:
+                    chunks.append(data)
+                    continue
+                selector.unregister(key.fd)
+                os.close(key.fd)
+                del running[key.fd]
+                _, status = os.waitpid(pid, 0)
+                _write_line(
+                    replies,
+                    {
+                        "id": request_id,
+                        "returncode": os.waitstatus_to_exitcode(status),
+                        "stderr": b"".join(chunks).decode("utf-8", errors="replace"),
+                    },
+                )
+
+
+if __name__ == "__main__":
+    # replies get their own descriptor; anything else printed goes to stderr
+    replies = os.dup(1)
+    os.dup2(2, 1)
+    sys.dont_write_bytecode = True
+
+    preload(sys.argv[1:])
+    serve(replies)
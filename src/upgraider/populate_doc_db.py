@@ -1,50 +1,192 @@
 
-from Model import get_embedding
+from upgraider.promptCrafting import (
+    get_embeddings,
+    count_tokens,
+    reference_text,
+    embedding_cache,
+    EMBEDDING_CONCURRENCY,
+)
 from docutils.utils import Reporter
-from docutils.core import publish_file
+from docutils.core import publish_doctree
 from docutils.parsers.rst import roles, nodes
-from bs4 import BeautifulSoup
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import os
-from upgraider.Database import Session, DeprecationComment, LibReleaseNote
+import argparse
+import hashlib
+from upgraider.Database import (
+    Session,
+    DeprecationComment,
+    LibReleaseNote,
+    ApiSymbol,
+    SectionReleaseNote,
+    MAX_IN_CLAUSE_IDS,
+    export_embedding_matrix,
+    export_bm25_index,
+    upgrade_schema,
+    missing_schema,
+)
+from upgraider.ApiSymbols import API_SYMBOL_CLASS, normalize_symbol
+from upgraider.Cache import content_key
+from upgraider.Backend import get_backend
+from dataclasses import dataclass, field
 import re
-import json
 
-def parse_html(html_file: str):
+API_ROLES = ['meth', 'class', 'func', 'attr']
+PARSE_WORKERS = os.cpu_count() or 1
+
+
+@dataclass
+class ReleaseNoteItem:
+    content: str
+    symbols: list[str] = field(default_factory=list)
+
+
+def api_symbol_role(name, rawtext, text, lineno, inliner, options={}, content=[]):
+    # rendered like the generic emphasis role, but marked so that
+    # parse_doctree can pick up the referenced API symbol
+    node = nodes.emphasis(rawtext, text, classes=[API_SYMBOL_CLASS])
+    return [node], []
+
+
+def register_roles():
+    # also run in every parser process, which may not inherit the registrations
+    roles.register_generic_role('issue', nodes.emphasis)
+    roles.register_generic_role('ref', nodes.emphasis)
+    for role in API_ROLES:
+        roles.register_local_role(role, api_symbol_role)
+
+
+def find_symbols(node) -> list[str]:
+    candidates = [
+        emphasis.astext() for emphasis in node.findall(nodes.emphasis)
+        if API_SYMBOL_CLASS in emphasis['classes']
+    ]
+    candidates += [literal.astext() for literal in node.findall(nodes.literal)]
+
+    symbols = []
+    for candidate in candidates:
+        symbol = normalize_symbol(candidate)
+        if symbol is not None and symbol not in symbols:
+            symbols.append(symbol)
+    return symbols
+
+
+def is_deprecation_section(node) -> bool:
+    return any('deprecat' in section_id.lower() or 'api' in section_id.lower() for section_id in node['ids'])
+
+
+def is_simple_list_item(list_item) -> bool:
+    # a single paragraph, optionally followed by a simple nested list
+    children = [child for child in list_item.children if not isinstance(child, nodes.Invisible)]
+    if len(children) == 2 and isinstance(children[0], nodes.paragraph) and isinstance(children[1], (nodes.bullet_list, nodes.enumerated_list)):
+        return is_simple_list(children[1])
+    return len(children) == 0 or (len(children) == 1 and isinstance(children[0], nodes.paragraph))
+
+
+def is_simple_list(list_node) -> bool:
+    return all(is_simple_list_item(list_item) for list_item in list_node.children)
+
+
+def is_standalone_paragraph(paragraph) -> bool:
+    """
+    Tells whether a paragraph is an item on its own: the paragraphs of
+    simple lists and single-paragraph table cells are only part of their
+    list item (or table), like in the rendered release notes.
+    """
+    parent = paragraph.parent
+    if isinstance(parent, nodes.entry) and len(parent) == 1:
+        return False
+    if isinstance(parent, nodes.list_item):
+        return not is_simple_list(parent.parent)
+    return True
+
+
+def following_code_block(paragraph):
+    for sibling in paragraph.findall(include_self=False, descend=False, siblings=True):
+        if isinstance(sibling, (nodes.literal_block, nodes.doctest_block)):
+            return sibling
+    return None
+
+
+def parse_doctree(doctree) -> list[ReleaseNoteItem]:
+    """
+    Extracts the list items and paragraphs (with the code block following
+    them) of the deprecation and API change sections of a parsed release
+    note. Items of nested matching sections are only extracted once.
+    """
+    for message in list(doctree.findall(nodes.system_message)):
+        # not part of the release note text, e.g. unknown role reports
+        message.parent.remove(message)
+
     deprecation_items = []
+    extracted = set()
 
-    with open(html_file, 'r') as f:
-        html = f.read()
-        soup = BeautifulSoup(html, 'html.parser')
-
-        for section in soup.find_all("div"):
-            section_id = section.get('id')
-            
-            if section_id and ('deprecat' in section_id.lower() or 'api' in section_id.lower()):
-                for list_item in section.find_all("li"):
-                    deprecation_items.append(list_item.text)
-
-                for paragraph in section.find_all("p"):
-                    text = paragraph.text
-                    
-                    next_sibling = paragraph.find_next_sibling("pre")
-                    if next_sibling is not None:
-                        text += "\n" +  next_sibling.text 
-                    
-                    deprecation_items.append(text)
+    for section in doctree.findall(lambda node: isinstance(node, (nodes.document, nodes.section))):
+        if not is_deprecation_section(section):
+            continue
+
+        for list_item in section.findall(nodes.list_item):
+            if id(list_item) not in extracted:
+                extracted.add(id(list_item))
+                deprecation_items.append(ReleaseNoteItem(list_item.astext(), find_symbols(list_item)))
+
+        for paragraph in section.findall(nodes.paragraph):
+            if id(paragraph) in extracted or not is_standalone_paragraph(paragraph):
+                continue
+            extracted.add(id(paragraph))
+
+            text = paragraph.astext()
+            code_block = following_code_block(paragraph)
+            if code_block is not None:
+                text += "\n" + code_block.astext()
+
+            deprecation_items.append(ReleaseNoteItem(text, find_symbols(paragraph)))
 
-    
     return deprecation_items
 
-def save_items(dep_items: list[str], session, release_id):
-    for item in dep_items:
-        embedding = json.dumps(get_embedding(item))
-        session.add(DeprecationComment(
-            content=item,
+
+def parse_release_note(source: str, source_path: str = None) -> list[ReleaseNoteItem]:
+    doctree = publish_doctree(source, source_path=source_path, settings_overrides={'report_level': Reporter.SEVERE_LEVEL})
+    return parse_doctree(doctree)
+
+
+def save_items(dep_items: list[ReleaseNoteItem], session, release_id, concurrency: int = EMBEDDING_CONCURRENCY):
+    # rows are only added to the session; the caller commits once per release note
+    embeddings = get_embeddings([item.content for item in dep_items], concurrency=concurrency)
+    token_counts = count_tokens([reference_text(item.content) for item in dep_items])
+    comments = [
+        DeprecationComment(
+            content=item.content,
             lib_release_note=release_id,
-            embedding=embedding
-        ))
-    
-        session.commit()
+            embedding=embedding,
+            num_tokens=num_tokens,
+            content_hash=item_hash(item.content)
+        )
+        for item, embedding, num_tokens in zip(dep_items, embeddings, token_counts)
+    ]
+    session.add_all(comments)
+    session.flush()
+
+    session.add_all([
+        ApiSymbol(symbol=symbol, deprecation_comment=comment.id)
+        for item, comment in zip(dep_items, comments)
+        for symbol in item.symbols
+    ])
+    session.add_all([
+        SectionReleaseNote(deprecation_comment=comment.id, lib_release_note=release_id)
+        for comment in comments
+    ])
+
+def backfill_token_counts(session):
+    sections = session.query(DeprecationComment).filter(DeprecationComment.num_tokens == None).all()
+    if not sections:
+        return
+
+    print(f"Counting tokens of {len(sections)} sections ingested before token counts were stored...")
+    token_counts = count_tokens([reference_text(section.content or "") for section in sections])
+    for section, num_tokens in zip(sections, token_counts):
+        section.num_tokens = num_tokens
+    session.commit()
 
 def get_version_from_filename(filename: str):
     result = re.search(r"(?P<major> 0|[1-9]\d*)\.(?P<minor>0|[1-9]\d*)\.(?P<patch>0|[1-9]\d*)?(?:-((?:0|[1-9]\d*|\d*[a-zA-Z-][0-9a-zA-Z-]*)(?:\.(?:0|[1-9]\d*|\d*[a-zA-Z-][0-9a-zA-Z-]*))*))?(?:\+([0-9a-zA-Z-]+(?:\.[0-9a-zA-Z-]+)*))?", filename)
@@ -58,68 +200,318 @@ def get_version_from_filename(filename: str):
     
     return None
 
-def main():
-    script_dir = os.path.dirname(__file__)
-    roles.register_generic_role('issue', nodes.emphasis)
-    roles.register_generic_role('ref', nodes.emphasis)
-    roles.register_generic_role('meth', nodes.emphasis)
-    roles.register_generic_role('class', nodes.emphasis)
-    roles.register_generic_role('func', nodes.emphasis)
-    roles.register_generic_role('attr', nodes.emphasis)
+def normalize_content(content: str) -> str:
+    # the same item re-wrapped or re-indented in another release note
+    return " ".join(content.split())
 
-    libraries_folder = os.path.join(script_dir, "../../libraries")
-    for lib_dir in os.listdir(libraries_folder):
-        if lib_dir.startswith("."):
+
+def item_hash(content: str) -> str:
+    return content_key(normalize_content(content))
+
+
+def file_hash(path: str) -> str:
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def extract_items(lib_path: str, note: str) -> list[ReleaseNoteItem]:
+    source_path = os.path.join(lib_path, "releasenotes", note)
+    with open(source_path, 'r') as f:
+        return parse_release_note(f.read(), source_path=source_path)
+
+
+def parse_release_notes(lib_path: str, notes: list[str], workers: int = PARSE_WORKERS):
+    """
+    Parses release notes across a pool of processes, yielding
+    (note, items) as soon as each note is parsed so that the caller can
+    embed one note while the others are still being parsed.
+    """
+    if workers <= 1 or len(notes) <= 1:
+        for note in notes:
+            yield note, extract_items(lib_path, note)
+        return
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(notes)), initializer=register_roles) as executor:
+        futures = {executor.submit(extract_items, lib_path, note): note for note in notes}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def delete_sections(session, section_ids: list[int]):
+    if not section_ids:
+        return
+    session.query(ApiSymbol).filter(ApiSymbol.deprecation_comment.in_(section_ids)).delete(synchronize_session=False)
+    session.query(SectionReleaseNote).filter(SectionReleaseNote.deprecation_comment.in_(section_ids)).delete(synchronize_session=False)
+    session.query(DeprecationComment).filter(DeprecationComment.id.in_(section_ids)).delete(synchronize_session=False)
+
+
+def linked_sections(session, release_id: int):
+    return session.query(DeprecationComment.id, DeprecationComment.content, DeprecationComment.content_hash).join(SectionReleaseNote, SectionReleaseNote.deprecation_comment == DeprecationComment.id).filter(SectionReleaseNote.lib_release_note == release_id).all()
+
+
+def find_sections(session, hashes: list[str]) -> dict[str, int]:
+    """
+    Returns {content hash: section id} for the texts already stored, from any
+    release note of any library.
+    """
+    sections = {}
+    for start in range(0, len(hashes), MAX_IN_CLAUSE_IDS):
+        rows = session.query(DeprecationComment.content_hash, DeprecationComment.id).filter(DeprecationComment.content_hash.in_(hashes[start:start + MAX_IN_CLAUSE_IDS]))
+        for section_hash, section_id in rows:
+            sections.setdefault(section_hash, section_id)
+    return sections
+
+
+def diff_items(existing_sections, items: list[ReleaseNoteItem]):
+    """
+    Matches the items extracted from a release note against the sections
+    already linked to it, by normalized content hash. Returns the items to
+    link (each distinct text once) and the ids of the sections to unlink;
+    unchanged sections are kept as is.
+    """
+    existing_by_hash = {}
+    for section in existing_sections:
+        existing_by_hash[section.content_hash or item_hash(section.content or "")] = section.id
+
+    new_items = {}
+    for item in items:
+        new_items.setdefault(item_hash(item.content), item)
+
+    stale_ids = [section_id for section_hash, section_id in existing_by_hash.items() if section_hash not in new_items]
+    return [item for section_hash, item in new_items.items() if section_hash not in existing_by_hash], stale_ids
+
+
+def link_items(session, items: list[ReleaseNoteItem], release_id: int, stored_sections: dict[str, int], concurrency: int):
+    # texts already stored for another release note are linked, not embedded again
+    session.add_all([
+        SectionReleaseNote(deprecation_comment=stored_sections[item_hash(item.content)], lib_release_note=release_id)
+        for item in items
+        if item_hash(item.content) in stored_sections
+    ])
+    save_items([item for item in items if item_hash(item.content) not in stored_sections], session=session, release_id=release_id, concurrency=concurrency)
+
+
+def unlink_sections(session, release_id: int, section_ids: list[int]):
+    """
+    Removes the links between a release note and the given sections, and
+    deletes the sections that no other release note links to anymore.
+    """
+    if not section_ids:
+        return
+
+    session.query(SectionReleaseNote).filter(SectionReleaseNote.lib_release_note == release_id).filter(SectionReleaseNote.deprecation_comment.in_(section_ids)).delete(synchronize_session=False)
+
+    remaining_links = dict(session.query(SectionReleaseNote.deprecation_comment, SectionReleaseNote.lib_release_note).filter(SectionReleaseNote.deprecation_comment.in_(section_ids)))
+    delete_sections(session, [section_id for section_id in section_ids if section_id not in remaining_links])
+
+    # sections still used elsewhere move to one of their other release notes
+    for section in session.query(DeprecationComment).filter(DeprecationComment.id.in_(list(remaining_links))).filter(DeprecationComment.lib_release_note == release_id):
+        section.lib_release_note = remaining_links[section.id]
+
+
+def deduplicate_sections(session):
+    """
+    Brings sections stored before texts were deduplicated to the current
+    layout: every section is linked to its release note, hashed by its
+    normalized content, and sections with the same text are merged into the
+    oldest one, which keeps the release notes and symbols of all of them.
+    """
+    linked_ids = {section_id for section_id, in session.query(SectionReleaseNote.deprecation_comment).distinct()}
+    sections = session.query(DeprecationComment.id, DeprecationComment.content, DeprecationComment.content_hash, DeprecationComment.lib_release_note).order_by(DeprecationComment.id).all()
+
+    kept_sections = {}
+    duplicates = {}
+    for section_id, content, content_hash, release_id in sections:
+        if section_id not in linked_ids and release_id is not None:
+            session.add(SectionReleaseNote(deprecation_comment=section_id, lib_release_note=release_id))
+
+        section_hash = item_hash(content or "")
+        if content_hash != section_hash:
+            session.query(DeprecationComment).filter(DeprecationComment.id == section_id).update({"content_hash": section_hash})
+
+        if section_hash in kept_sections:
+            duplicates[section_id] = kept_sections[section_hash]
+        else:
+            kept_sections[section_hash] = section_id
+    session.flush()
+
+    if duplicates:
+        print(f"Merging {len(duplicates)} sections whose text is stored more than once...")
+
+    for duplicate_id, kept_id in duplicates.items():
+        kept_notes = {note_id for note_id, in session.query(SectionReleaseNote.lib_release_note).filter(SectionReleaseNote.deprecation_comment == kept_id)}
+        kept_symbols = {symbol for symbol, in session.query(ApiSymbol.symbol).filter(ApiSymbol.deprecation_comment == kept_id)}
+
+        for link in session.query(SectionReleaseNote).filter(SectionReleaseNote.deprecation_comment == duplicate_id):
+            if link.lib_release_note not in kept_notes:
+                session.add(SectionReleaseNote(deprecation_comment=kept_id, lib_release_note=link.lib_release_note))
+                kept_notes.add(link.lib_release_note)
+        for api_symbol in session.query(ApiSymbol).filter(ApiSymbol.deprecation_comment == duplicate_id):
+            if api_symbol.symbol not in kept_symbols:
+                session.add(ApiSymbol(symbol=api_symbol.symbol, deprecation_comment=kept_id))
+                kept_symbols.add(api_symbol.symbol)
+        session.flush()
+
+    delete_sections(session, list(duplicates))
+    session.commit()
+
+
+def changed_release_notes(session, lib_dir: str, lib_path: str, notes: list[str]) -> dict[str, str]:
+    """
+    Returns the hash of each release note file that is new or changed since
+    it was ingested; unchanged release notes are not parsed again.
+    """
+    ingested_hashes = dict(session.query(LibReleaseNote.filename, LibReleaseNote.content_hash).filter(LibReleaseNote.library == lib_dir))
+
+    changed_notes = {}
+    for note in notes:
+        note_hash = file_hash(os.path.join(lib_path, "releasenotes", note))
+        if ingested_hashes.get(note) != note_hash:
+            changed_notes[note] = note_hash
+    return changed_notes
+
+
+def ingest_release_note(session, lib_dir: str, note: str, note_hash: str, items: list[ReleaseNoteItem], dry_run: bool, concurrency: int):
+    """
+    Brings the sections of one parsed release note up to date in a single
+    transaction: texts stored for no release note yet are embedded, texts
+    already stored are only linked, and sections the note no longer
+    contains are unlinked.
+    """
+    version = get_version_from_filename(note)
+    lib_release = session.query(LibReleaseNote).filter(LibReleaseNote.library == lib_dir).filter(LibReleaseNote.filename == note).first()
+
+    existing_sections = [] if lib_release is None else linked_sections(session, lib_release.id)
+    new_items, stale_ids = diff_items(existing_sections, items)
+    stored_sections = find_sections(session, [item_hash(item.content) for item in new_items])
+
+    status = "new" if lib_release is None else "changed"
+    print(f"{'Would update' if dry_run else 'Updating'} {status} release note {note} (version {version}): {len(new_items) - len(stored_sections)} items to embed, {len(stored_sections)} items already stored, {len(stale_ids)} stale items to unlink")
+
+    if dry_run:
+        return
+
+    if lib_release is None:
+        lib_release = LibReleaseNote(library=lib_dir, filename=note, version=version)
+        session.add(lib_release)
+        session.flush()
+
+    lib_release.version = version
+    lib_release.content_hash = note_hash
+    unlink_sections(session, lib_release.id, stale_ids)
+    link_items(session, new_items, lib_release.id, stored_sections, concurrency=concurrency)
+    session.commit()
+
+
+def update_library(session, lib_dir: str, lib_path: str, dry_run: bool, concurrency: int, workers: int) -> bool:
+    """
+    Ingests the new and changed release notes of a library and deletes the
+    removed ones. Returns True if anything changed (or would change).
+    """
+    notes = [
+        note for note in os.listdir(os.path.join(lib_path, "releasenotes"))
+        if not note.startswith(".") and note.endswith(".rst")
+    ]
+
+    changed_notes = changed_release_notes(session, lib_dir, lib_path, notes)
+    for note, items in parse_release_notes(lib_path, list(changed_notes), workers):
+        ingest_release_note(session, lib_dir, note, changed_notes[note], items, dry_run=dry_run, concurrency=concurrency)
+
+    removed = remove_release_notes(session, lib_dir, notes, dry_run=dry_run)
+    return len(changed_notes) > 0 or removed
+
+
+def remove_release_notes(session, lib_dir: str, notes: list[str], dry_run: bool) -> bool:
+    """
+    Deletes the release notes of a library whose files no longer exist.
+    """
+    removed_notes = session.query(LibReleaseNote).filter(LibReleaseNote.library == lib_dir).filter(LibReleaseNote.filename.not_in(notes)).all()
+
+    for lib_release in removed_notes:
+        print(f"{'Would delete' if dry_run else 'Deleting'} removed release note {lib_release.filename}")
+        if dry_run:
             continue
 
-        print(f"Populating DB with release note data for {lib_dir}...")
+        unlink_sections(session, lib_release.id, [section.id for section in linked_sections(session, lib_release.id)])
+        session.delete(lib_release)
+
+    session.commit()
+    return len(removed_notes) > 0
 
-        session = Session()
-  
-        lib_path = os.path.join(script_dir, f"../../libraries/{lib_dir}")
-        
-        for note in os.listdir(os.path.join(lib_path, "releasenotes")):
-            version = get_version_from_filename(note)
-            print(f"Processing release note {note} for version {version}...")
-            if note.startswith(".") or not note.endswith(".rst"):
-                continue
 
-            lib_release = session.query(LibReleaseNote).filter(LibReleaseNote.library == lib_dir).filter(LibReleaseNote.filename == note).first()
+def prepare_db(dry_run: bool) -> bool:
+    """
+    Adds the tables and columns introduced after the DB was first populated
+    and cleans up what older versions left behind. A dry run only reports a
+    needed upgrade, and returns False since the release notes cannot be
+    compared against an outdated schema.
+    """
+    if dry_run:
+        missing = missing_schema()
+        if missing:
+            print(f"Would upgrade the DB schema, adding {', '.join(missing)}; run without --dry-run to compare the release notes")
+            return False
+        return True
 
-            if lib_release is not None:
-                continue # Release note already exists in DB
+    upgrade_schema()
+    session = Session()
+    deduplicate_sections(session)
+    backfill_token_counts(session)
+    session.close()
+    return True
 
-            lib_release = LibReleaseNote(
-                library=lib_dir,
-                filename=note,
-                version=version
-            )
 
-            session.add(lib_release)
-            session.commit()
+def main():
+    parser = argparse.ArgumentParser(description="Populate the release notes DB")
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        help="Maximum number of embedding batches in flight",
+        default=EMBEDDING_CONCURRENCY,
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only report which release notes would be added, updated or deleted",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of processes parsing release notes",
+        default=PARSE_WORKERS,
+    )
+    args = parser.parse_args()
 
-            release_id = lib_release.id
+    script_dir = os.path.dirname(__file__)
+    register_roles()
 
-            base_name = os.path.splitext(note)[0]
-            output_html_file = os.path.join(lib_path, "releasenotes", f"{base_name}.html")
+    if not prepare_db(dry_run=args.dry_run):
+        return
+
+    changed = False
+    libraries_folder = os.path.join(script_dir, "../../libraries")
+    for lib_dir in os.listdir(libraries_folder):
+        if lib_dir.startswith("."):
+            continue
 
-            source_path = os.path.join(lib_path, "releasenotes", note)
-            
-            publish_file(source_path=source_path, writer_name='html', destination_path=output_html_file, settings_overrides={'report_level':Reporter.SEVERE_LEVEL})
-            deprecated_items = parse_html(output_html_file)
-            
+        print(f"Populating DB with release note data for {lib_dir}...")
 
-            print(f"Found {len(deprecated_items)} deprecated items for {note}")
-            save_items(deprecated_items, session=session, release_id=release_id)
-            os.remove(output_html_file)
-            print("Finished embedding and saving items")
-        
-        session.commit()
+        session = Session()
+        lib_path = os.path.join(libraries_folder, lib_dir)
+        changed |= update_library(session, lib_dir, lib_path, dry_run=args.dry_run, concurrency=args.concurrency, workers=args.workers)
         session.close()
 
+    if args.dry_run:
+        if not changed:
+            print("Release notes DB is up to date")
+        return
+
+    # keep the memory-mapped embedding matrix in sync with the DB
+    export_embedding_matrix()
+    export_bm25_index()
+    print(f"Embedding cache: {embedding_cache.stats()}")
+    print(f"Embedding API: {get_backend().stats()}")
 
-    
-    
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
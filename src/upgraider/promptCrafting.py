@@ -1,22 +1,49 @@
 import numpy as np
 import openai
 import os
+import functools
+from dataclasses import dataclass
+from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
 from string import Template
 import tiktoken
 from upgraider.Database import (
-    get_embedded_doc_sections,
-    DeprecationComment,
-    get_section_content,
+    get_embedding_index,
+    get_ivf_index,
+    get_quantized_index,
+    get_bm25_index,
+    get_symbol_index,
+    get_sections,
+    pack_embedding,
+    unpack_embedding,
 )
-from os import environ as env
+from upgraider.EmbeddingIndex import EmbeddingIndex, IVFIndex
+from upgraider.BM25Index import reciprocal_rank_fusion
+from upgraider.Cache import PersistentCache, content_key
+from upgraider.Backend import get_backend
+from apiexploration.Library import Library
 from dotenv import load_dotenv
 
 load_dotenv(override=True)
 
 EMBEDDING_MODEL = "text-embedding-ada-002"
 
-# TODO: use token length
-MAX_SECTION_LEN = 500
+# token budget for the references of one prompt, per model
+MAX_REFERENCE_TOKENS = 650
+REFERENCE_TOKEN_BUDGETS = {
+    "gpt-3.5-turbo-0125": MAX_REFERENCE_TOKENS,
+    "gpt-4": MAX_REFERENCE_TOKENS,
+}
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo-0125": 16385,
+    "gpt-4": 8192,
+}
+# room left in the context window for the model's answer
+MAX_RESPONSE_TOKENS = 1024
+# shorter sections are one or two word references that carry no information
+MIN_REFERENCE_TOKENS = 4
+# number of ranked sections considered when filling the token budget
+MAX_CANDIDATE_SECTIONS = 100
 SEPARATOR = "\n* "
 
 ENCODING = "cl100k_base"  # encoding for text-embedding-ada-002
@@ -24,121 +51,430 @@ ENCODING = "cl100k_base"  # encoding for text-embedding-ada-002
 encoding = tiktoken.get_encoding(ENCODING)
 separator_len = len(encoding.encode(SEPARATOR))
 
+EMBEDDING_CACHE_SIZE = 100_000
+embedding_cache = PersistentCache("embeddings", max_entries=EMBEDDING_CACHE_SIZE)
+
+# limits for a single request to the embeddings endpoint
+EMBEDDING_BATCH_MAX_TOKENS = 8_000
+EMBEDDING_BATCH_MAX_INPUTS = 2048
+EMBEDDING_CONCURRENCY = 4
+
+
+class Retriever(Enum):
+    dense = "dense"  # embedding similarity
+    bm25 = "bm25"  # lexical, no embedding API calls
+    hybrid = "hybrid"  # reciprocal rank fusion of dense and bm25
+
+
+class SearchIndex(Enum):
+    exact = "exact"
+    ivf = "ivf"
+
+
+class Quantization(Enum):
+    none = "none"
+    float16 = "float16"
+    int8 = "int8"
+
+
+@dataclass
+class RetrievalOptions:
+    retriever: Retriever = Retriever.dense
+    search_index: SearchIndex = SearchIndex.exact
+    # IVF only: number of clusters scored per query (higher = better recall, slower)
+    nprobe: int = 8
+    # exact search only: score a compact copy of the embeddings first
+    quantization: Quantization = Quantization.none
+    # only use release notes between the library's base and current version
+    scope_versions: bool = False
+    # put sections mentioning an API used by the snippet before all others
+    symbol_lookup: bool = True
+    # overrides the per-model reference token budget
+    reference_tokens: int = None
+
+
+def count_tokens(texts: list[str]) -> list[int]:
+    return [len(tokens) for tokens in encoding.encode_batch(texts)]
+
+
+def reference_text(content: str) -> str:
+    """
+    The text of a section as it appears in the list of references.
+    """
+    return content.replace("\n", " ")
+
+
+@functools.cache
+def load_template(name: str) -> str:
+    script_dir = os.path.dirname(__file__)
+    with open(
+        os.path.join(script_dir, "resources", name), "r", encoding="utf-8"
+    ) as file:
+        return file.read()
+
+
+def load_chat_template() -> str:
+    return load_template("chat_template.txt")
+
+
+def reference_token_budget(model_name: str, original_code: str) -> int:
+    """
+    Returns the number of tokens the references may use in a prompt for the
+    given model, so that the prompt and the answer fit its context window.
+    """
+    budget = REFERENCE_TOKEN_BUDGETS.get(model_name, MAX_REFERENCE_TOKENS)
+
+    context_window = MODEL_CONTEXT_WINDOWS.get(model_name)
+    if context_window is not None:
+        prompt_tokens = sum(count_tokens([load_chat_template(), original_code]))
+        budget = min(budget, context_window - prompt_tokens - MAX_RESPONSE_TOKENS)
+
+    return max(budget, 0)
+
+
+def fixing_references(
+    original_code: str,
+    use_references: bool,
+    threshold: float = None,
+    retrieval: RetrievalOptions = None,
+    library: Library = None,
+    model_name: str = None,
+) -> list[str]:
+    """
+    Returns the numbered references to show the model with the code, if any.
+    """
+    if use_references is not True:
+        return []
+
+    if retrieval is not None and retrieval.reference_tokens is not None:
+        token_budget = retrieval.reference_tokens
+    else:
+        token_budget = reference_token_budget(model_name, original_code)
+
+    return get_reference_list(
+        original_code=original_code,
+        threshold=threshold,
+        retrieval=retrieval,
+        library=library,
+        token_budget=token_budget,
+    )
+
 
 def construct_fixing_prompt(
     original_code: str,
     use_references: bool,
     threshold: float = None,
+    retrieval: RetrievalOptions = None,
+    library: Library = None,
+    model_name: str = None,
+    references: list[str] = None,
 ):
 
-    if use_references is True:
-        references = get_reference_list(
-            original_code=original_code, threshold=threshold
+    if references is None:
+        references = fixing_references(
+            original_code,
+            use_references,
+            threshold=threshold,
+            retrieval=retrieval,
+            library=library,
+            model_name=model_name,
         )
-    else:
-        references = []
 
-    script_dir = os.path.dirname(__file__)
-    with open(
-        os.path.join(script_dir, "resources/chat_template.txt"), "r", encoding="utf-8"
-    ) as file:
-        chat_template = Template(file.read())
-        prompt_text = chat_template.substitute(
-            original_code=original_code, references="".join(references)
-        )
+    chat_template = Template(load_chat_template())
+    prompt_text = chat_template.substitute(
+        original_code=original_code, references="".join(references)
+    )
 
     return prompt_text
 
 
+def batch_snippet_text(number: int, original_code: str, references: list[str]) -> str:
+    """
+    The numbered slot of one snippet and its references in a batched prompt.
+    """
+    snippet_template = Template(load_template("batch_snippet_template.txt"))
+    return snippet_template.substitute(
+        number=number, original_code=original_code, references="".join(references)
+    )
+
+
+def construct_batch_prompt(snippets: list[tuple[str, list[str]]]) -> str:
+    """
+    Returns a single prompt asking to fix all (code, references) snippets,
+    each in its own numbered slot, answered in numbered sections that
+    parse_batch_response splits back up.
+    """
+    batch_template = Template(load_template("batch_chat_template.txt"))
+    return batch_template.substitute(
+        num_snippets=len(snippets),
+        snippets="".join(
+            batch_snippet_text(number, original_code, references)
+            for number, (original_code, references) in enumerate(snippets, start=1)
+        ),
+    )
+
+
 def order_document_sections_by_code_similarity(
-    code: str, contexts: dict[(int, int), np.array], threshold: float = None
-) -> list[(float, (int, int))]:
+    code: str,
+    contexts: EmbeddingIndex | dict[int, np.array],
+    threshold: float = None,
+    k: int = None,
+    ann_index: IVFIndex = None,
+    nprobe: int = None,
+) -> list[(float, int)]:
     """
     Find the embedding for the supplied code snippet, and compare it against all of the pre-calculated document embeddings
-    to find the most relevant documentation sections.
+    to find the most relevant documentation sections. With an ann_index, only the sections of its
+    nprobe closest clusters are compared.
 
-    Return the list of document sections, sorted by relevance in descending order.
+    Return the top k document sections (all of them if k is None), sorted by relevance in descending order.
     """
     code_embedding = get_embedding(code)
 
     if code_embedding is None:
         return []
 
-    document_similarities = sorted(
-        [
-            (vector_similarity(code_embedding, doc_embedding), doc_index)
-            for doc_index, doc_embedding in contexts.items()
-        ],
-        reverse=True,
-    )
+    if not isinstance(contexts, EmbeddingIndex):
+        contexts = EmbeddingIndex.from_sections(contexts)
+
+    if ann_index is not None:
+        return ann_index.search(
+            contexts, code_embedding, k=k, threshold=threshold, nprobe=nprobe
+        )
 
-    if threshold:
-        document_similarities = [
-            sim for sim in document_similarities if sim[0] > threshold
+    return contexts.top_k(code_embedding, k=k, threshold=threshold)
+
+
+def rank_document_sections(
+    code: str,
+    threshold: float = None,
+    retrieval: RetrievalOptions = None,
+    library: Library = None,
+    k: int = MAX_CANDIDATE_SECTIONS,
+) -> list[(float, int)]:
+    """
+    Returns the k release note sections most relevant to the code as
+    (score, section id), using the retriever selected in `retrieval`. The
+    threshold only applies to embedding similarity.
+
+    Unless disabled, sections that mention an API symbol used by the code come
+    first, found with a dictionary lookup.
+    """
+    if retrieval is None:
+        retrieval = RetrievalOptions()
+
+    if retrieval.quantization == Quantization.none:
+        contexts = get_embedding_index()
+    else:
+        contexts = get_quantized_index(retrieval.quantization.value)
+
+    if library is not None:
+        versions = None
+        if retrieval.scope_versions:
+            versions = (library.baseversion, library.currentversion)
+        contexts = contexts.partition(library.name, versions)
+
+    rankings = []
+
+    if retrieval.retriever in (Retriever.dense, Retriever.hybrid):
+        if retrieval.search_index == SearchIndex.ivf:
+            ann_index = get_ivf_index()
+        else:
+            ann_index = None
+
+        rankings.append(
+            order_document_sections_by_code_similarity(
+                code,
+                contexts,
+                threshold,
+                k=k,
+                ann_index=ann_index,
+                nprobe=retrieval.nprobe,
+            )
+        )
+
+    if retrieval.retriever in (Retriever.bm25, Retriever.hybrid):
+        rankings.append(get_bm25_index().search(code, k=k, note_ids=contexts.note_ids))
+
+    if len(rankings) == 1:
+        ranked_sections = rankings[0]
+    else:
+        ranked_sections = reciprocal_rank_fusion(rankings, k=k)
+
+    if retrieval.symbol_lookup:
+        symbol_hits = get_symbol_index().lookup(code, note_ids=contexts.note_ids)[:k]
+        hit_ids = {section_id for _, section_id in symbol_hits}
+        ranked_sections = symbol_hits + [
+            section for section in ranked_sections if section[1] not in hit_ids
         ]
 
-    return document_similarities
+    return ranked_sections[:k]
 
 
 def get_reference_list(
     original_code: str,
     threshold: float = 0.0,
+    retrieval: RetrievalOptions = None,
+    library: Library = None,
+    token_budget: int = MAX_REFERENCE_TOKENS,
 ):
+    """
+    Returns the numbered references to include in the prompt, in ranked order,
+    using at most token_budget tokens. With a library, only release notes of
+    that library are considered.
+
+    Packing only adds up the token counts stored at ingestion: a section that
+    does not fit is skipped in favour of smaller, lower ranked ones.
+    """
     chosen_sections = []
     chosen_sections_len = 0
     ref_count = 0
 
-    context_embeddings = get_embedded_doc_sections()
+    most_relevant_document_sections = rank_document_sections(
+        original_code, threshold=threshold, retrieval=retrieval, library=library
+    )
 
-    most_relevant_document_sections = order_document_sections_by_code_similarity(
-        original_code, context_embeddings, threshold
+    sections = get_sections(
+        [section_index for _, section_index in most_relevant_document_sections]
     )
 
     for similarity, section_index in most_relevant_document_sections:
 
-        if chosen_sections_len > MAX_SECTION_LEN:
+        if token_budget - chosen_sections_len < MIN_REFERENCE_TOKENS + separator_len:
             break
 
-        # Add sections as context, until we run out of space.
-        section_content = get_section_content(section_index)
-        # section for section in sections if section.id == section_index
+        section_content = reference_text(sections[section_index].content)
+        num_tokens = sections[section_index].num_tokens
+        if num_tokens is None:
+            # sections ingested before token counts were stored
+            num_tokens = count_tokens([section_content])[0]
 
-        section_tokens = section_content.split(" ")
+        if num_tokens < MIN_REFERENCE_TOKENS:
+            continue
 
-        if len(section_tokens) < 3:
-            continue  # skip one or two word references
+        len_if_added = chosen_sections_len + num_tokens + separator_len
 
-        len_if_added = chosen_sections_len + len(section_tokens) + separator_len
+        if len_if_added > token_budget:
+            if ref_count > 0:
+                continue
 
-        # if current section will exceed max length, truncate it
-        if len_if_added > MAX_SECTION_LEN:
-            section_content = " ".join(
-                section_tokens[: MAX_SECTION_LEN - chosen_sections_len]
+            # the most relevant section alone exceeds the budget, so truncate it
+            section_content = encoding.decode(
+                encoding.encode(section_content)[: token_budget - separator_len]
             )
+            len_if_added = token_budget
 
         chosen_sections_len = len_if_added
         ref_count += 1
 
-        chosen_sections.append(
-            "\n" + str(ref_count) + ". " + section_content.replace("\n", " ")
-        )
+        chosen_sections.append("\n" + str(ref_count) + ". " + section_content)
 
     return chosen_sections
 
 
+def _embedding_key(model: str, text: str) -> str:
+    identity = get_backend().identity
+    if identity is None:
+        return content_key(model, text)
+    return content_key(model, text, identity)
+
+
 def get_embedding(text: str, model: str = EMBEDDING_MODEL) -> list[float]:
     """
     Returns the embedding for the supplied text.
+
+    Embeddings are cached on disk by (backend, model, sha256(text)), so the
+    same text is only ever embedded once.
     """
-    openai.api_key = env["OPENAI_API_KEY"]
+    cache_key = _embedding_key(model, text)
+    cached_embedding = embedding_cache.get(cache_key)
+    if cached_embedding is not None:
+        return unpack_embedding(cached_embedding).tolist()
 
     try:
-        result = openai.Embedding.create(model=model, input=text)
+        result = get_backend().embed(text, model)
     except openai.error.InvalidRequestError as e:
         print(f"ERROR: {e}")
         return None
 
-    return result["data"][0]["embedding"]
+    embedding = result["data"][0]["embedding"]
+    embedding_cache.put(cache_key, pack_embedding(embedding))
+    return embedding
+
+
+def get_embeddings(
+    texts: list[str],
+    model: str = EMBEDDING_MODEL,
+    concurrency: int = EMBEDDING_CONCURRENCY,
+) -> list[list[float]]:
+    """
+    Returns the embeddings for all supplied texts, in order.
+
+    Texts that are not cached yet are sent in token-bounded batches, with at
+    most `concurrency` batches in flight at a time.
+    """
+    embeddings = [None] * len(texts)
+    cache_keys = [_embedding_key(model, text) for text in texts]
+
+    uncached = []
+    for i, cache_key in enumerate(cache_keys):
+        cached_embedding = embedding_cache.get(cache_key)
+        if cached_embedding is not None:
+            embeddings[i] = unpack_embedding(cached_embedding).tolist()
+        else:
+            uncached.append(i)
+
+    batches = _batch_by_tokens([texts[i] for i in uncached], uncached)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        batch_results = executor.map(
+            lambda batch: _embed_batch([texts[i] for i in batch], model), batches
+        )
+        for batch, batch_embeddings in zip(batches, batch_results):
+            for i, embedding in zip(batch, batch_embeddings):
+                embeddings[i] = embedding
+                if embedding is not None:
+                    embedding_cache.put(cache_keys[i], pack_embedding(embedding))
+
+    return embeddings
+
+
+def _batch_by_tokens(texts: list[str], indices: list[int]) -> list[list[int]]:
+    batches = []
+    batch = []
+    batch_tokens = 0
+
+    for text, i in zip(texts, indices):
+        text_tokens = len(encoding.encode(text))
+        if batch and (
+            batch_tokens + text_tokens > EMBEDDING_BATCH_MAX_TOKENS
+            or len(batch) >= EMBEDDING_BATCH_MAX_INPUTS
+        ):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+
+        batch.append(i)
+        batch_tokens += text_tokens
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def _embed_batch(texts: list[str], model: str) -> list[list[float]]:
+    try:
+        result = get_backend().embed(texts, model)
+    except openai.error.InvalidRequestError as e:
+        # one bad input fails the whole batch, so retry the texts one by one
+        print(f"WARNING: embedding batch failed ({e}), embedding texts one by one")
+        return [get_embedding(text, model) for text in texts]
+
+    embeddings = [None] * len(texts)
+    for item in result["data"]:
+        embeddings[item["index"]] = item["embedding"]
+    return embeddings
 
 
 def vector_similarity(x: list[float], y: list[float]) -> float:
@@ -1,15 +1,25 @@
 import subprocess
 import os
 import re
+import json
+import hashlib
 import argparse
+import tempfile
+from dataclasses import asdict
 from Report import RunResult, RunProblem, ProblemType
 from apiexploration.Library import Library
+from upgraider.Cache import PersistentCache, content_key
+from upgraider.VenvPool import get_venv_pool, overlay_env, VenvBuildError
+from upgraider.ForkServer import ForkServerExecutor, WorkerDied
 
 from dotenv import load_dotenv
 
 load_dotenv()
 script_dir = os.path.dirname(__file__)
 
+RUN_RESULT_CACHE_SIZE = 100_000
+run_result_cache = PersistentCache("run_results", max_entries=RUN_RESULT_CACHE_SIZE)
+
 def find_attribute_error(error_msg: str):
     attribute_err = re.search(r"AttributeError: (.*) object has no attribute (.*)\n",error_msg)
     if attribute_err is not None:
@@ -24,17 +34,79 @@ def find_type_error(error_msg: str):
     if typeerror is not None:
         return RunProblem(type=ProblemType.ERROR, name="TypeError", element_name=typeerror.group(2), target_obj=typeerror.group(1))
 
-def run_code(library: Library, file: str, requirements_file: str) -> RunResult:
+def run_result_key(
+    library: Library, file: str, requirements_file: str, forked: bool = False
+) -> str:
+    """
+    The file's content together with everything that determines its
+    environment: the library version, requirements and Python version, and
+    whether it ran in a fork server, where the library's import-time
+    warnings are not seen.
+    """
+    with open(file, "rb") as f:
+        code_hash = hashlib.sha256(f.read()).hexdigest()
+    return content_key(
+        code_hash,
+        *get_venv_pool().key(library.name, library.currentversion, requirements_file),
+        "fork server" if forked else "subprocess",
+    )
+
+
+def _encode_run_result(run_result: RunResult) -> bytes:
+    encoded = asdict(run_result)
+    if run_result.problem is not None:
+        encoded["problem"]["type"] = ProblemType(run_result.problem.type).value
+    return json.dumps(encoded).encode("utf-8")
+
+
+def _decode_run_result(value: bytes) -> RunResult:
+    decoded = json.loads(value)
+    problem = decoded["problem"]
+    if problem is not None:
+        problem = RunProblem(**{**problem, "type": ProblemType(problem["type"])})
+    return RunResult(decoded["problem_free"], problem, decoded["msg"])
+
+
+def run_code(
+    library: Library,
+    file: str,
+    requirements_file: str,
+    cache: PersistentCache = None,
+    executor: ForkServerExecutor = None,
+) -> RunResult:
+    """
+    Runs the file with the current version of the library (and the
+    requirements) installed, in an environment from the venv pool. Each run
+    gets a fresh working, home and temporary directory.
+
+    With a cache, the result of a previous run of the same code in the same
+    kind of environment is returned instead of running it again. With an
+    executor, the file runs in a fork of a warm worker of the environment
+    instead of a new interpreter.
+    """
+    if cache is not None:
+        cache_key = run_result_key(
+            library, file, requirements_file, forked=executor is not None
+        )
+        recorded = cache.get(cache_key)
+        if recorded is not None:
+            print(f"Reusing the recorded run of {file}...")
+            return _decode_run_result(recorded)
+
     print(f"Running {file}...")
 
     problem_free = True
     run_result = RunResult(problem_free)
     
     try:
-        if requirements_file is not None:
-            result = subprocess.run([f"{script_dir}/run_code.sh", file, library.name, library.currentversion, requirements_file], check=True, stderr=subprocess.PIPE)
+        if executor is not None:
+            returncode, stderr = executor.execute(library.name, library.currentversion, file, requirements_file)
+            result = subprocess.CompletedProcess(file, returncode, stderr=stderr.encode('utf-8'))
+            result.check_returncode()
         else:
-            result = subprocess.run([f"{script_dir}/run_code.sh", file, library.name, library.currentversion], check=True, stderr=subprocess.PIPE)
+            with get_venv_pool().acquire(library.name, library.currentversion, requirements_file) as environment:
+                with tempfile.TemporaryDirectory(prefix="upgraider-run-") as overlay_dir:
+                    result = subprocess.run([environment.python, os.path.abspath(file)], check=True, stderr=subprocess.PIPE, cwd=overlay_dir, env=overlay_env(environment, overlay_dir))
         
         error_msg = result.stderr.decode('utf-8')
 
@@ -46,6 +118,12 @@ def run_code(library: Library, file: str, requirements_file: str) -> RunResult:
             run_result.problem_free = False
             run_result.msg = error_msg
 
+    except (VenvBuildError, WorkerDied) as e:
+        run_result.problem_free = False
+        run_result.msg = str(e)
+        # not the code's fault, so not recorded
+        return run_result
+
     except subprocess.CalledProcessError as e:
         error_msg = e.stderr.decode('utf-8')
         run_result.problem_free = False
@@ -57,7 +135,8 @@ def run_code(library: Library, file: str, requirements_file: str) -> RunResult:
         elif "TypeError" in error_msg:
             run_result.problem = find_type_error(error_msg)
 
-        
+    if cache is not None:
+        cache.put(cache_key, _encode_run_result(run_result))
     return run_result
 
 if __name__ == "__main__":
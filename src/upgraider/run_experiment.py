@@ -1,26 +1,114 @@
 import os
 import json
 import argparse
-import time
+import asyncio
 from enum import Enum
 from apiexploration.Library import Library, CodeSnippet
-from upgraider.Model import Model
-from upgraider.upgraide import Upgraider
+from upgraider.Model import Model, CacheMode, MAX_IN_FLIGHT_REQUESTS, response_cache
+from upgraider.RateLimiter import RateLimiter
+from upgraider.Backend import (
+    OpenAIBackend,
+    OpenAICompatibleBackend,
+    LocalBackend,
+    backend_from_env,
+    get_backend,
+    set_backend,
+)
+from upgraider.Retry import RetryingBackend, RetryPolicy, AimdController, MAX_RETRIES
+from upgraider.upgraide import Upgraider, MAX_BATCH_SIZE
+from upgraider.run_code import run_result_cache
+from upgraider.ForkServer import ForkServerExecutor
+from upgraider.VenvPool import VenvPool, MAX_ENVIRONMENTS, get_venv_pool, set_venv_pool
+from upgraider.promptCrafting import (
+    RetrievalOptions,
+    Retriever,
+    SearchIndex,
+    Quantization,
+)
 from upgraider.Report import (
     Report,
     UpdateStatus,
     FixStatus,
     DBSource,
     ModelResponse,
+    SnippetReport,
 )
 
 
+async def _validate_example(
+    model_response: ModelResponse,
+    output_dir: str,
+    upgraider: Upgraider,
+    validation_slots: asyncio.Semaphore,
+) -> SnippetReport:
+    # runs share pooled environments but each gets its own overlay, so they can overlap
+    async with validation_slots:
+        snippet_results = await asyncio.to_thread(
+            upgraider.validate_upgraide, model_response
+        )
+
+    prompt_file_path, model_response_file_path = _write_experiment_files(
+        model_response, output_dir
+    )
+    snippet_results.prompt_file = prompt_file_path
+    snippet_results.model_reponse_file = model_response_file_path
+
+    print(f"Finished fixing {model_response.original_code.filename}...")
+    return snippet_results
+
+
+async def _fix_examples(
+    example_files: list[str],
+    examples_path: str,
+    library: Library,
+    output_dir: str,
+    use_references: bool,
+    upgraider: Upgraider,
+    threshold: float,
+    validation_workers: int,
+) -> dict[str, SnippetReport]:
+    """
+    Fixes all examples concurrently: model queries overlap (bounded by the
+    model's in-flight limit and rate limiter), while each example is
+    validated as soon as its response arrives.
+    """
+    code_snippets = [
+        CodeSnippet(
+            filename=example_file,
+            code=_load_example(os.path.join(examples_path, example_file)),
+        )
+        for example_file in example_files
+    ]
+
+    validation_slots = asyncio.Semaphore(validation_workers)
+    validations = []
+    async for model_response in upgraider.aupgraide_all(
+        code_snippets,
+        library=library,
+        use_references=use_references,
+        threshold=threshold,
+        output_dir=output_dir,
+    ):
+        validations.append(
+            asyncio.create_task(
+                _validate_example(model_response, output_dir, upgraider, validation_slots)
+            )
+        )
+
+    results = {
+        snippet_results.model_response.original_code.filename: snippet_results
+        for snippet_results in await asyncio.gather(*validations)
+    }
+    return {example_file: results[example_file] for example_file in example_files}
+
+
 def _fix_lib_examples(
     library: Library,
     output_dir: str,
     use_references: bool,
     upgraider: Upgraider,
     threshold: float = None,
+    validation_workers: int = 1,
 ):
     print(
         f"=== Fixing examples for {library.name} with model {upgraider.model.model_name} ==="
@@ -31,39 +119,24 @@ def _fix_lib_examples(
     examples_path = os.path.join(library.path, "examples")
 
     if os.path.exists(examples_path):
-        requirements_file = os.path.join(library.path, "requirements.txt")
-
-        if not os.path.exists(requirements_file):
-            requirements_file = None
-
-        for example_file in os.listdir(examples_path):
-            if example_file.startswith("."):
-                continue
-
-            model_response = upgraider.upgraide(
-                code_snippet=CodeSnippet(
-                    filename=example_file,
-                    code=_load_example(os.path.join(examples_path, example_file)),
-                ),
-                library=library,
-                use_references=use_references,
-                threshold=threshold,
-                output_dir=output_dir,
-            )
-
-            snippet_results = upgraider.validate_upgraide(model_response)
+        example_files = [
+            example_file
+            for example_file in os.listdir(examples_path)
+            if not example_file.startswith(".")
+        ]
 
-            prompt_file_path, model_response_file_path = _write_experiment_files(
-                model_response, output_dir
+        snippets = asyncio.run(
+            _fix_examples(
+                example_files,
+                examples_path,
+                library,
+                output_dir,
+                use_references,
+                upgraider,
+                threshold,
+                validation_workers,
             )
-            snippet_results.prompt_file = prompt_file_path
-            snippet_results.model_reponse_file = model_response_file_path
-
-            print(f"Finished fixing {example_file}...")
-            snippets[example_file] = snippet_results
-
-            # wait 30 seconds between each example
-            time.sleep(30)
+        )
 
     report.snippets = snippets
     report.num_snippets = len(snippets)
@@ -182,12 +255,209 @@ if __name__ == "__main__":
         default="gpt-3.5-turbo-0125",
         choices=["gpt-3.5-turbo-0125", "gpt-4"],
     )
+    parser.add_argument(
+        "--retriever",
+        type=str,
+        help="How release notes are retrieved: embedding similarity, BM25 or a fusion of both",
+        default=Retriever.dense.value,
+        choices=[retriever.value for retriever in Retriever],
+    )
+    parser.add_argument(
+        "--searchIndex",
+        type=str,
+        help="Index used to find similar release notes (ivf is approximate but faster on large corpora)",
+        default=SearchIndex.exact.value,
+        choices=[index.value for index in SearchIndex],
+    )
+    parser.add_argument(
+        "--quantization",
+        type=str,
+        help="Score a quantized copy of the embeddings first, then re-score the best candidates exactly",
+        default=Quantization.none.value,
+        choices=[quantization.value for quantization in Quantization],
+    )
+    parser.add_argument(
+        "--scopeVersions",
+        action="store_true",
+        help="Only retrieve release notes between the library's base and current version",
+    )
+    parser.add_argument(
+        "--noSymbolLookup",
+        action="store_true",
+        help="Do not prioritize release notes that mention APIs used by the snippet",
+    )
+    parser.add_argument(
+        "--referenceTokens",
+        type=int,
+        help="Token budget for the references in each prompt (defaults to a per-model budget)",
+        default=None,
+    )
+    parser.add_argument(
+        "--nprobe",
+        type=int,
+        help="Number of IVF clusters searched per snippet",
+        default=RetrievalOptions.nprobe,
+    )
+
+    parser.add_argument(
+        "--batchTokens",
+        type=int,
+        help="Ask about several examples per prompt, in prompts of at most this many tokens including the answer (one example per prompt by default)",
+        default=None,
+    )
+    parser.add_argument(
+        "--maxBatchSize",
+        type=int,
+        help="Maximum number of examples per prompt with --batchTokens",
+        default=MAX_BATCH_SIZE,
+    )
+
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream model answers and stop them once the numbered items of the answer are complete",
+    )
+    parser.add_argument(
+        "--maxInFlight",
+        type=int,
+        help="Maximum number of concurrent model requests (fewer while the API is throttling)",
+        default=MAX_IN_FLIGHT_REQUESTS,
+    )
+    parser.add_argument(
+        "--maxRetries",
+        type=int,
+        help="Times a request failing with a rate limit or server error is retried",
+        default=MAX_RETRIES,
+    )
+    parser.add_argument(
+        "--requestsPerMinute",
+        type=int,
+        help="Model requests per minute allowed by the API quota (no limit by default)",
+        default=None,
+    )
+    parser.add_argument(
+        "--tokensPerMinute",
+        type=int,
+        help="Model tokens per minute allowed by the API quota (no limit by default)",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--responseCache",
+        type=str,
+        help="Reuse recorded model responses (readwrite), ignore them (off), or only replay them and fail on unrecorded prompts (replay)",
+        default=CacheMode.read_write.value,
+        choices=[mode.value for mode in CacheMode],
+    )
+
+    parser.add_argument(
+        "--backend",
+        type=str,
+        help="Serve model and embedding requests from the OpenAI API, an OpenAI-compatible server at --apiBase, or the local stand-in server (defaults to $UPGRAIDER_BACKEND, else openai)",
+        default=None,
+        choices=["openai", "http", "local"],
+    )
+    parser.add_argument(
+        "--apiBase",
+        type=str,
+        help="Base URL of the OpenAI-compatible server for --backend http",
+        default=None,
+    )
+    parser.add_argument(
+        "--standInLatency",
+        type=float,
+        help="Seconds the local stand-in server takes per request",
+        default=0.0,
+    )
+    parser.add_argument(
+        "--standInErrorRate",
+        type=float,
+        help="Fraction of requests the local stand-in server fails with a 429",
+        default=0.0,
+    )
+
+    parser.add_argument(
+        "--noRunResultCache",
+        action="store_true",
+        help="Run the original examples again instead of reusing their recorded runs",
+    )
+    parser.add_argument(
+        "--forkServer",
+        action="store_true",
+        help="Run examples in forks of a warm interpreter per library environment that has the library imported, instead of a new interpreter each",
+    )
+    parser.add_argument(
+        "--validationWorkers",
+        type=int,
+        help="Examples run concurrently to validate the fixes",
+        default=os.cpu_count(),
+    )
+    parser.add_argument(
+        "--venvPoolSize",
+        type=int,
+        help="Library environments kept before the least recently used ones are deleted",
+        default=MAX_ENVIRONMENTS,
+    )
+    parser.add_argument(
+        "--venvPoolGB",
+        type=float,
+        help="Disk space the library environments may take (no limit by default)",
+        default=None,
+    )
 
     args = parser.parse_args()
     script_dir = os.path.dirname(__file__)
 
-    model = Model(args.model)
-    upgraider = Upgraider(model)
+    if args.backend == "openai":
+        backend = OpenAIBackend()
+    elif args.backend == "http":
+        if args.apiBase is None:
+            parser.error("--backend http requires --apiBase")
+        backend = OpenAICompatibleBackend(args.apiBase, api_key=os.environ.get("UPGRAIDER_API_KEY"))
+    elif args.backend == "local":
+        backend = LocalBackend(latency=args.standInLatency, error_rate=args.standInErrorRate)
+    else:
+        backend = backend_from_env()
+    set_backend(
+        RetryingBackend(
+            backend,
+            policy=RetryPolicy(max_retries=args.maxRetries),
+            controller=AimdController(max_limit=args.maxInFlight),
+        )
+    )
+
+    set_venv_pool(
+        VenvPool(
+            get_venv_pool().root,
+            max_environments=args.venvPoolSize,
+            max_bytes=int(args.venvPoolGB * 2**30) if args.venvPoolGB is not None else None,
+        )
+    )
+
+    model = Model(
+        args.model,
+        max_in_flight=args.maxInFlight,
+        rate_limiter=RateLimiter(args.requestsPerMinute, args.tokensPerMinute),
+        cache_mode=CacheMode(args.responseCache),
+        stream=args.stream,
+    )
+    retrieval = RetrievalOptions(
+        retriever=Retriever(args.retriever),
+        search_index=SearchIndex(args.searchIndex),
+        nprobe=args.nprobe,
+        quantization=Quantization(args.quantization),
+        scope_versions=args.scopeVersions,
+        symbol_lookup=not args.noSymbolLookup,
+        reference_tokens=args.referenceTokens,
+    )
+    upgraider = Upgraider(
+        model,
+        retrieval=retrieval,
+        batch_tokens=args.batchTokens,
+        max_batch_size=args.maxBatchSize,
+        run_cache=None if args.noRunResultCache else run_result_cache,
+        executor=ForkServerExecutor() if args.forkServer else None,
+    )
 
     with open(
         os.path.join(args.libpath, "library.json"), mode="r", encoding="utf-8"
@@ -210,6 +480,7 @@ if __name__ == "__main__":
         use_references=False,
         threshold=args.threshold,
         upgraider=upgraider,
+        validation_workers=args.validationWorkers,
     )
 
     print(f"Fixing examples for {library.name} with documentation...")
@@ -219,4 +490,13 @@ if __name__ == "__main__":
         use_references=True,
         threshold=args.threshold,
         upgraider=upgraider,
+        validation_workers=args.validationWorkers,
     )
+
+    print(f"Response cache: {response_cache.stats()}")
+    print(f"Model API: {get_backend().stats()}")
+    print(f"Venv pool: {get_venv_pool().stats()}")
+    print(f"Run result cache: {run_result_cache.stats()}")
+    if upgraider.executor is not None:
+        upgraider.executor.close()
+        print(f"Fork server: {upgraider.executor.stats()}")
@@ -0,0 +1,272 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from upgraider.Backend import chat_request_key
+from upgraider.Cache import PersistentCache
+
+EMBEDDING_DIMENSIONS = 1536
+
+
+def canned_answer(prompt: str) -> str:
+    """
+    A well-formed answer that keeps the provided code unchanged, with one
+    numbered section per snippet for batched prompts.
+    """
+    codes = [
+        code.strip() for code in re.findall(r"Provided code:\s*```\n?([\s\S]*?)```", prompt)
+    ]
+    answers = [
+        f"1. ```python\n{code}\n```\n2. No update needed\n3. No references used"
+        for code in codes or [""]
+    ]
+    if re.search(r"^### Snippet 1$", prompt, re.MULTILINE) is None:
+        return answers[0]
+    return "\n\n".join(
+        f"### Snippet {number}\n{answer}" for number, answer in enumerate(answers, start=1)
+    )
+
+
+def canned_embedding(text: str, dimensions: int = EMBEDDING_DIMENSIONS) -> list[float]:
+    # a unit vector seeded by the text, so the same text always gets the same embedding
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).normal(size=dimensions)
+    return (vector / np.linalg.norm(vector)).astype(np.float32).tolist()
+
+
+def _num_tokens(text: str) -> int:
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+class StandInServer:
+    """
+    Local server implementing the OpenAI chat completions and embeddings
+    endpoints under /v1, for running and load testing the pipeline offline.
+
+    Chat requests are answered with the response recorded for the same
+    request in `recordings` (a PersistentCache of responses, like Model's)
+    if there is one, and with canned_answer otherwise; embeddings are
+    deterministic per text. Every request takes `latency` seconds plus up to
+    `jitter` seconds, and fails with `error_status` (with a Retry-After of
+    `retry_after` seconds) with probability `error_rate`. Streamed answers
+    are sent a word at a time, `token_latency` seconds apart; `cancelled`
+    counts the streams the client closed before the end.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        jitter: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 429,
+        retry_after: float = 1.0,
+        token_latency: float = 0.0,
+        recordings: PersistentCache = None,
+        embedding_dimensions: int = EMBEDDING_DIMENSIONS,
+        seed: int = 0,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.token_latency = token_latency
+        self.recordings = recordings
+        self.embedding_dimensions = embedding_dimensions
+        self.requests = 0
+        self.errors = 0
+        self.cancelled = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                server._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "StandInServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def _draw(self) -> tuple[float, bool]:
+        with self._lock:
+            self.requests += 1
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        return delay, failed
+
+    def _handle(self, request: BaseHTTPRequestHandler):
+        length = int(request.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(request.rfile.read(length) or b"{}")
+        except ValueError:
+            self._reply(request, 400, {"error": {"message": "Invalid JSON body"}})
+            return
+
+        delay, failed = self._draw()
+        time.sleep(delay)
+
+        if failed:
+            self._reply(
+                request,
+                self.error_status,
+                {"error": {"message": "Injected error", "type": "stand_in"}},
+                headers={"Retry-After": str(self.retry_after)},
+            )
+        elif request.path.rstrip("/").endswith("/chat/completions"):
+            if payload.get("stream"):
+                self._stream_chat(request, payload)
+            else:
+                self._reply(request, 200, self._chat(payload))
+        elif request.path.rstrip("/").endswith("/embeddings"):
+            self._reply(request, 200, self._embeddings(payload))
+        else:
+            self._reply(request, 404, {"error": {"message": f"Unknown endpoint {request.path}"}})
+
+    def _answer(self, payload: dict) -> str:
+        messages = payload.get("messages", [])
+        params = {
+            key: value
+            for key, value in payload.items()
+            if key not in ("model", "messages", "stream")
+        }
+
+        if self.recordings is not None:
+            recorded = self.recordings.get(
+                chat_request_key(payload.get("model"), messages, params)
+            )
+            if recorded is not None:
+                return recorded.decode("utf-8")
+        return canned_answer(messages[-1]["content"] if messages else "")
+
+    def _chat(self, payload: dict) -> dict:
+        messages = payload.get("messages", [])
+        answer = self._answer(payload)
+
+        prompt_tokens = sum(_num_tokens(message.get("content", "")) for message in messages)
+        completion_tokens = _num_tokens(answer)
+        return {
+            "object": "chat.completion",
+            "model": payload.get("model"),
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": answer},
+                    "finish_reason": "stop",
+                }
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def _stream_chat(self, request: BaseHTTPRequestHandler, payload: dict):
+        request.send_response(200)
+        request.send_header("Content-Type", "text/event-stream")
+        request.end_headers()
+
+        chunks = [
+            {"choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]}
+            for word in re.findall(r"\s*\S+\s*", self._answer(payload))
+        ]
+        chunks.append({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        try:
+            for chunk in chunks:
+                request.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+                request.wfile.flush()
+                time.sleep(self.token_latency)
+            request.wfile.write(b"data: [DONE]\n\n")
+            request.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            with self._lock:
+                self.cancelled += 1
+
+    def _embeddings(self, payload: dict) -> dict:
+        texts = payload.get("input", [])
+        if isinstance(texts, str):
+            texts = [texts]
+
+        num_tokens = sum(_num_tokens(text) for text in texts)
+        return {
+            "object": "list",
+            "model": payload.get("model"),
+            "data": [
+                {
+                    "object": "embedding",
+                    "index": i,
+                    "embedding": canned_embedding(text, self.embedding_dimensions),
+                }
+                for i, text in enumerate(texts)
+            ],
+            "usage": {"prompt_tokens": num_tokens, "total_tokens": num_tokens},
+        }
+
+    def _reply(self, request: BaseHTTPRequestHandler, status: int, body: dict, headers: dict = None):
+        data = json.dumps(body).encode("utf-8")
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(data)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve canned or recorded OpenAI-compatible responses locally"
+    )
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", type=float, help="Seconds added to every request", default=0.0)
+    parser.add_argument("--jitter", type=float, help="Up to this many more seconds per request", default=0.0)
+    parser.add_argument("--errorRate", type=float, help="Fraction of requests that fail", default=0.0)
+    parser.add_argument("--errorStatus", type=int, help="HTTP status of failed requests", default=429)
+    parser.add_argument("--tokenLatency", type=float, help="Seconds between the words of streamed answers", default=0.0)
+    parser.add_argument(
+        "--recordings",
+        action="store_true",
+        help="Answer with the model responses recorded in the cache when available",
+    )
+    args = parser.parse_args()
+
+    server = StandInServer(
+        port=args.port,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.errorRate,
+        error_status=args.errorStatus,
+        token_latency=args.tokenLatency,
+        # only read from, so no entries are ever evicted
+        recordings=PersistentCache("responses", max_entries=0) if args.recordings else None,
+    )
+    print(f"Serving stand-in OpenAI API at {server.url}")
+    server.httpd.serve_forever()
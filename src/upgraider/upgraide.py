@@ -1,12 +1,27 @@
 import os
+import asyncio
 import difflib
 import ast
 from collections import namedtuple
-from enum import Enum
-from upgraider.Model import ModelResponse, Model, parse_model_response
+from upgraider.Model import (
+    ModelResponse,
+    Model,
+    parse_model_response,
+    parse_batch_response,
+)
 from apiexploration.Library import CodeSnippet, Library
-from upgraider.promptCrafting import construct_fixing_prompt
+from upgraider.promptCrafting import (
+    construct_fixing_prompt,
+    construct_batch_prompt,
+    batch_snippet_text,
+    fixing_references,
+    count_tokens,
+    RetrievalOptions,
+    MODEL_CONTEXT_WINDOWS,
+)
 from upgraider.run_code import run_code
+from upgraider.Cache import PersistentCache
+from upgraider.ForkServer import ForkServerExecutor
 from upgraider.Report import (
     SnippetReport,
     UpdateStatus,
@@ -17,10 +32,76 @@ from upgraider.Report import (
 
 Import = namedtuple("Import", ["module", "name", "alias"])
 
+# snippets packed into one prompt in batched mode
+MAX_BATCH_SIZE = 8
+# tokens of the answer to a snippet besides its updated code
+ANSWER_OVERHEAD_TOKENS = 100
+
+
+def pack_batches(
+    costs: list[int], header_tokens: int, token_budget: int, max_batch_size: int
+) -> list[list[int]]:
+    """
+    Groups consecutive items into batches whose costs, plus header_tokens,
+    add up to at most token_budget, with at most max_batch_size items each.
+    An item that does not fit on its own gets a batch of its own.
+    """
+    batches = []
+    batch = []
+    used_tokens = header_tokens
+
+    for i, cost in enumerate(costs):
+        if batch and (
+            used_tokens + cost > token_budget or len(batch) == max_batch_size
+        ):
+            batches.append(batch)
+            batch = []
+            used_tokens = header_tokens
+
+        batch.append(i)
+        used_tokens += cost
+
+    if batch:
+        batches.append(batch)
+
+    return batches
+
 
 class Upgraider:
-    def __init__(self, model: Model):
+    def __init__(
+        self,
+        model: Model,
+        retrieval: RetrievalOptions = None,
+        batch_tokens: int = None,
+        max_batch_size: int = MAX_BATCH_SIZE,
+        run_cache: PersistentCache = None,
+        executor: ForkServerExecutor = None,
+    ):
+        """
+        With batch_tokens, aupgraide_all asks about several snippets in one
+        prompt of at most batch_tokens tokens, counting the expected answer.
+        With a run_cache, the runs of the original examples are recorded and
+        reused by validate_upgraide, since they do not depend on the model.
+        With an executor, validate_upgraide runs the examples in it.
+        """
         self.model = model
+        self.retrieval = retrieval
+        self.batch_tokens = batch_tokens
+        self.max_batch_size = max_batch_size
+        self.run_cache = run_cache
+        self.executor = executor
+
+    def _fixing_prompt(
+        self, code_snippet: CodeSnippet, library: Library, use_references: bool, threshold: float
+    ) -> str:
+        return construct_fixing_prompt(
+            original_code=code_snippet.code,
+            use_references=use_references,
+            threshold=threshold,
+            retrieval=self.retrieval,
+            library=library,
+            model_name=self.model.model_name,
+        )
 
     def upgraide(
         self,
@@ -31,15 +112,207 @@ class Upgraider:
         output_dir: str = None,
     ):
 
+        prompt_text = self._fixing_prompt(code_snippet, library, use_references, threshold)
+
+        model_response = self.model.query(prompt_text)
+
+        return self._process_response(
+            model_response, prompt_text, code_snippet, library, output_dir
+        )
+
+    async def aupgraide(
+        self,
+        code_snippet: CodeSnippet,
+        library: Library,
+        use_references: bool,
+        threshold: float = 0.0,
+        output_dir: str = None,
+    ):
+        """
+        Same as upgraide, but queries the model with aquery so that several
+        snippets can be fixed concurrently. The prompt is built in a worker
+        thread since retrieval may call the embeddings API.
+        """
+        prompt_text = await asyncio.to_thread(
+            self._fixing_prompt, code_snippet, library, use_references, threshold
+        )
+
+        model_response = await self.model.aquery(prompt_text)
+
+        return self._process_response(
+            model_response, prompt_text, code_snippet, library, output_dir
+        )
+
+    async def aupgraide_all(
+        self,
+        code_snippets: list[CodeSnippet],
+        library: Library,
+        use_references: bool,
+        threshold: float = 0.0,
+        output_dir: str = None,
+    ):
+        """
+        Fixes all snippets concurrently, yielding their ModelResponses as they
+        arrive. In batched mode, consecutive snippets are packed into shared
+        prompts; if the answer to a batch cannot be split into one answer per
+        snippet, its snippets are asked about one by one instead.
+        """
+        if self.batch_tokens is None:
+            requests = [
+                self._aupgraide_one(code_snippet, library, use_references, threshold, output_dir)
+                for code_snippet in code_snippets
+            ]
+        else:
+            references = await asyncio.gather(
+                *[
+                    asyncio.to_thread(
+                        fixing_references,
+                        code_snippet.code,
+                        use_references,
+                        threshold=threshold,
+                        retrieval=self.retrieval,
+                        library=library,
+                        model_name=self.model.model_name,
+                    )
+                    for code_snippet in code_snippets
+                ]
+            )
+            requests = [
+                self._aupgraide_batch(
+                    [code_snippets[i] for i in batch],
+                    [references[i] for i in batch],
+                    library,
+                    output_dir,
+                )
+                for batch in self._batches(code_snippets, references)
+            ]
+
+        for request in asyncio.as_completed(requests):
+            for model_response in await request:
+                yield model_response
+
+    async def _aupgraide_one(
+        self,
+        code_snippet: CodeSnippet,
+        library: Library,
+        use_references: bool,
+        threshold: float,
+        output_dir: str,
+    ) -> list[ModelResponse]:
+        return [
+            await self.aupgraide(
+                code_snippet, library, use_references, threshold, output_dir
+            )
+        ]
+
+    def _batches(
+        self, code_snippets: list[CodeSnippet], references: list[list[str]]
+    ) -> list[list[int]]:
+        token_budget = self.batch_tokens
+        context_window = MODEL_CONTEXT_WINDOWS.get(self.model.model_name)
+        if context_window is not None:
+            token_budget = min(token_budget, context_window)
+
+        # each snippet costs its slot in the prompt and its answer, which repeats the code
+        slot_tokens = count_tokens(
+            [
+                batch_snippet_text(i, code_snippet.code, snippet_references)
+                for i, (code_snippet, snippet_references) in enumerate(
+                    zip(code_snippets, references), start=1
+                )
+            ]
+        )
+        code_tokens = count_tokens([code_snippet.code for code_snippet in code_snippets])
+        costs = [
+            slot + code + ANSWER_OVERHEAD_TOKENS
+            for slot, code in zip(slot_tokens, code_tokens)
+        ]
+
+        header_tokens = count_tokens([construct_batch_prompt([])])[0]
+        return pack_batches(costs, header_tokens, token_budget, self.max_batch_size)
+
+    async def _aupgraide_batch(
+        self,
+        code_snippets: list[CodeSnippet],
+        references: list[list[str]],
+        library: Library,
+        output_dir: str,
+    ) -> list[ModelResponse]:
+        if len(code_snippets) > 1:
+            prompt_text = construct_batch_prompt(
+                [
+                    (code_snippet.code, snippet_references)
+                    for code_snippet, snippet_references in zip(code_snippets, references)
+                ]
+            )
+            # a streamed answer is only cut after the last snippet's section
+            model_response = await self.model.aquery(
+                prompt_text, sections=len(code_snippets)
+            )
+
+            parsed_model_responses = parse_batch_response(model_response, code_snippets)
+            if parsed_model_responses is not None:
+                return [
+                    self._finish_response(
+                        parsed_model_response, prompt_text, library, output_dir
+                    )
+                    for parsed_model_response in parsed_model_responses
+                ]
+
+            print(
+                f"WARNING: could not split the answer about {', '.join(code_snippet.filename for code_snippet in code_snippets)}, asking about each snippet separately"
+            )
+
+        return await asyncio.gather(
+            *[
+                self._aupgraide_with_references(
+                    code_snippet, snippet_references, library, output_dir
+                )
+                for code_snippet, snippet_references in zip(code_snippets, references)
+            ]
+        )
+
+    async def _aupgraide_with_references(
+        self,
+        code_snippet: CodeSnippet,
+        references: list[str],
+        library: Library,
+        output_dir: str,
+    ) -> ModelResponse:
         prompt_text = construct_fixing_prompt(
             original_code=code_snippet.code,
-            use_references=use_references,
-            threshold=threshold,
+            use_references=bool(references),
+            references=references,
         )
 
-        model_response = self.model.query(prompt_text)
+        model_response = await self.model.aquery(prompt_text)
+
+        return self._process_response(
+            model_response, prompt_text, code_snippet, library, output_dir
+        )
+
+    def _process_response(
+        self,
+        model_response: str,
+        prompt_text: str,
+        code_snippet: CodeSnippet,
+        library: Library,
+        output_dir: str,
+    ) -> ModelResponse:
 
         parsed_model_response = parse_model_response(model_response, code_snippet)
+        return self._finish_response(
+            parsed_model_response, prompt_text, library, output_dir
+        )
+
+    def _finish_response(
+        self,
+        parsed_model_response: ModelResponse,
+        prompt_text: str,
+        library: Library,
+        output_dir: str,
+    ) -> ModelResponse:
+
         parsed_model_response.prompt = prompt_text
         parsed_model_response.library = library
 
@@ -70,7 +343,13 @@ class Upgraider:
             examples_path, model_response.original_code.filename
         )
 
-        original_code_result = run_code(library, example_file_path, requirements_file)
+        original_code_result = run_code(
+            library,
+            example_file_path,
+            requirements_file,
+            cache=self.run_cache,
+            executor=self.executor,
+        )
 
         updated_code_result = None  # will stay as None if no update occurs
         diff = None
@@ -83,7 +362,10 @@ class Upgraider:
                 )
             else:
                 updated_code_result = run_code(
-                    library, model_response.updated_code.filename, requirements_file
+                    library,
+                    model_response.updated_code.filename,
+                    requirements_file,
+                    executor=self.executor,
                 )
                 diff = _unidiff(
                     model_response.original_code.code, model_response.updated_code.code
@@ -6,3 +6,81 @@ import sys
 # the `tests` package.
 root_path = os.path.abspath(os.path.join(__file__, "..", ".."))
 sys.path.insert(0, root_path)
+
+import asyncio
+import pytest
+import openai
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from upgraider import Database, Model, promptCrafting
+from upgraider.Cache import PersistentCache
+
+
+@pytest.fixture
+def doc_db(tmp_path, monkeypatch):
+    """
+    Points the Database module at an empty release notes DB in a temp folder.
+    """
+    db_path = str(tmp_path / "releasenotes.db")
+    engine = create_engine(f"sqlite:///{db_path}", echo=False)
+    Database.Base.metadata.create_all(engine)
+
+    monkeypatch.setattr(Database, "DB_PATH", db_path)
+    monkeypatch.setattr(Database, "Session", sessionmaker(bind=engine))
+    monkeypatch.setattr(Database, "_embedding_index", None)
+    monkeypatch.setattr(Database, "_bm25_index", None)
+    monkeypatch.setattr(Database, "_symbol_index", None)
+    monkeypatch.setattr(Database, "_quantized_indexes", {})
+    monkeypatch.setattr(Database, "_schemas", {})
+    return Database
+
+
+@pytest.fixture
+def embedding_api(tmp_path, monkeypatch):
+    """
+    Replaces the embeddings endpoint with one that records each request and
+    embeds a text as [len(text), 1.0].
+    """
+    requests = []
+
+    def create(model, input):
+        inputs = input if isinstance(input, list) else [input]
+        requests.append(inputs)
+        return {
+            "data": [
+                {"index": i, "embedding": [float(len(text)), 1.0]}
+                for i, text in enumerate(inputs)
+            ]
+        }
+
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setattr(openai.Embedding, "create", create)
+    monkeypatch.setattr(
+        promptCrafting,
+        "embedding_cache",
+        PersistentCache("embeddings", 100, path=str(tmp_path / "cache.db")),
+    )
+    return requests
+
+
+@pytest.fixture
+def chat_api(tmp_path, monkeypatch):
+    """
+    Replaces the async chat endpoint with one that records each request and
+    echoes the prompt, and gives Model an empty response cache.
+    """
+    requests = []
+
+    async def acreate(messages, model, **params):
+        requests.append(messages[-1]["content"])
+        await asyncio.sleep(0.01)
+        return {"choices": [{"message": {"content": f"answer to {messages[-1]['content']}"}}]}
+
+    monkeypatch.setenv("OPENAI_API_KEY", "test")
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", acreate)
+    monkeypatch.setattr(
+        Model,
+        "response_cache",
+        PersistentCache("responses", 100, path=str(tmp_path / "cache.db")),
+    )
+    return requests
@@ -0,0 +1,57 @@
+from upgraider.ApiSymbols import SymbolIndex, code_symbols, normalize_symbol
+
+
+def test_normalize_symbol():
+    assert normalize_symbol("~pandas.Index.is_mixed") == "pandas.Index.is_mixed"
+    assert normalize_symbol("Index.is_mixed()") == "Index.is_mixed"
+    assert normalize_symbol("title <pandas.Bar>") == "pandas.Bar"
+    assert normalize_symbol("na_sentinel=None") == "na_sentinel"
+    assert normalize_symbol("x == y") is None
+
+
+def test_code_symbols():
+    code = """
+import networkx as nx
+from pandas import factorize
+
+G = nx.from_numpy_matrix(A)
+codes, uniques = factorize(values, na_sentinel=-1)
+"""
+    symbols = code_symbols(code)
+    assert {"nx.from_numpy_matrix", "from_numpy_matrix", "factorize", "na_sentinel"} <= symbols
+    assert code_symbols("not python(") == set()
+
+
+def test_symbol_lookup():
+    index = SymbolIndex.build(
+        [
+            (1, "pandas.Index.is_mixed"),
+            (2, "networkx.from_numpy_matrix"),
+            (3, "na_sentinel"),
+            (4, "is_mixed"),
+        ],
+        release_notes={1: [10], 2: [20], 3: [10], 4: [20, 30]},
+    )
+
+    assert [i for _, i in index.lookup("idx = pd.Index([0]); idx.is_mixed()")] == [1, 4]
+    assert [i for _, i in index.lookup("pd.Index.is_mixed(idx)")] == [1, 4]
+    assert index.lookup("pd.Index.is_mixed(idx)")[0][0] > index.lookup("pd.Index.is_mixed(idx)")[1][0]
+    assert [i for _, i in index.lookup("nx.from_numpy_matrix(A)")] == [2]
+    assert [i for _, i in index.lookup("idx.is_mixed()", note_ids=[30])] == [4]
+
+
+def test_release_note_symbols():
+    from upgraider.populate_doc_db import parse_release_note, register_roles
+
+    register_roles()
+    items = parse_release_note(
+        "Deprecations\n"
+        "------------\n\n"
+        "- :meth:`Index.is_mixed` is deprecated, use ``infer_objects``.\n"
+        "- The ``na_sentinel`` argument of :func:`~pandas.factorize` is *deprecated*.\n"
+    )
+    assert [item.symbols for item in items] == [
+        ["Index.is_mixed", "infer_objects"],
+        ["pandas.factorize", "na_sentinel"],
+    ]
+    assert items[0].content == "Index.is_mixed is deprecated, use infer_objects."
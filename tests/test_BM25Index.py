@@ -0,0 +1,41 @@
+from upgraider.BM25Index import BM25Index, tokenize, reciprocal_rank_fusion
+
+
+def _index():
+    return BM25Index.build(
+        ids=[1, 2, 3],
+        texts=[
+            "Index.is_mixed is deprecated, use Index.infer_objects instead",
+            "from_numpy_matrix was removed, use from_numpy_array",
+            "The na_sentinel argument of factorize is deprecated",
+        ],
+        release_notes=[[10], [20], [10, 20]],
+    )
+
+
+def test_tokenize():
+    assert tokenize("idx.is_mixed()") == ["idx", "is_mixed", "is", "mixed"]
+
+
+def test_search():
+    index = _index()
+
+    assert [i for _, i in index.search("G = nx.from_numpy_matrix(A)")] == [2]
+    assert [i for _, i in index.search("pd.factorize(values, na_sentinel=-1)")] == [3]
+    assert index.search("print('hello')") == []
+    assert [i for _, i in index.search("is deprecated", note_ids=[10])] == [1, 3]
+    assert [i for _, i in index.search("is deprecated", note_ids=[20])] == [3]
+
+
+def test_save_load(tmp_path):
+    index = _index()
+    path = str(tmp_path / "bm25.npz")
+    index.save(path)
+
+    loaded = BM25Index.load(path)
+    assert loaded.search("idx.is_mixed()") == index.search("idx.is_mixed()")
+
+
+def test_reciprocal_rank_fusion():
+    fused = reciprocal_rank_fusion([[(0.9, 1), (0.5, 2)], [(7.0, 2), (3.0, 3)]])
+    assert [i for _, i in fused] == [2, 1, 3]
@@ -0,0 +1,111 @@
+import asyncio
+import openai
+import pytest
+from upgraider import Backend
+from upgraider.Backend import LocalBackend, OpenAICompatibleBackend, chat_request_key
+from upgraider.Cache import PersistentCache
+from upgraider.Model import CacheMode, Model
+from upgraider.standin_server import StandInServer
+
+PROMPT = "Provided code:\n\n```\nimport pandas\n```\n\nProvided reference information:\n"
+
+
+@pytest.fixture
+def stand_in():
+    server = StandInServer().start()
+    yield server
+    server.stop()
+
+
+def test_chat_and_embeddings(stand_in):
+    backend = OpenAICompatibleBackend(stand_in.url)
+
+    response = backend.chat([{"role": "user", "content": PROMPT}], "gpt-4", temperature=0.0)
+    assert response["choices"][0]["message"]["content"].startswith("1. ```python\nimport pandas\n```")
+    assert response["usage"]["total_tokens"] > 0
+
+    async_response = asyncio.run(backend.achat([{"role": "user", "content": PROMPT}], "gpt-4"))
+    assert async_response["choices"] == response["choices"]
+
+    embeddings = backend.embed(["a", "b", "a"], "text-embedding-ada-002")["data"]
+    assert len(embeddings[0]["embedding"]) == 1536
+    assert embeddings[0]["embedding"] == embeddings[2]["embedding"]
+    assert embeddings[0]["embedding"] != embeddings[1]["embedding"]
+
+
+def test_recorded_responses(tmp_path):
+    recordings = PersistentCache("responses", 10, path=str(tmp_path / "cache.db"))
+    messages = [{"role": "user", "content": "recorded prompt"}]
+    recordings.put(chat_request_key("gpt-4", messages, {"temperature": 0.0}), b"recorded answer")
+
+    backend = LocalBackend(recordings=recordings)
+    try:
+        response = backend.chat(messages, "gpt-4", temperature=0.0)
+        assert response["choices"][0]["message"]["content"] == "recorded answer"
+    finally:
+        backend.server.stop()
+
+
+def test_error_injection():
+    backend = LocalBackend(error_rate=1.0, retry_after=2.5)
+    try:
+        with pytest.raises(openai.error.RateLimitError) as error:
+            backend.embed("text", "text-embedding-ada-002")
+        assert error.value.headers["Retry-After"] == "2.5"
+
+        with pytest.raises(openai.error.RateLimitError):
+            asyncio.run(backend.achat([{"role": "user", "content": PROMPT}], "gpt-4"))
+        assert backend.server.errors == 2
+    finally:
+        backend.server.stop()
+
+
+def test_model_and_embeddings_use_backend(stand_in, embedding_api, monkeypatch):
+    from upgraider.promptCrafting import get_embeddings
+
+    backend = OpenAICompatibleBackend(stand_in.url)
+    monkeypatch.setattr(Backend, "_backend", backend)
+
+    model = Model("gpt-4", cache_mode=CacheMode.off)
+
+    async def query_all():
+        return await asyncio.gather(*[model.aquery(PROMPT) for _ in range(3)])
+
+    answers = asyncio.run(query_all())
+    assert len(set(answers)) == 1
+    assert model.query(PROMPT) == answers[0]
+
+    assert len(get_embeddings(["some text", "other text"])[0]) == 1536
+    assert embedding_api == []  # not sent to the OpenAI module
+    assert stand_in.requests == 3  # identical in-flight queries are sent once
+
+
+def test_caches_kept_apart_per_backend(chat_api, embedding_api, monkeypatch):
+    from upgraider.Backend import OpenAIBackend
+    from upgraider.promptCrafting import get_embedding
+
+    local = LocalBackend()
+    try:
+        monkeypatch.setattr(Backend, "_backend", local)
+        model = Model("gpt-4", cache_mode=CacheMode.read_write)
+        local_answer = asyncio.run(model.aquery(PROMPT))
+        local_embedding = get_embedding("some text")
+    finally:
+        local.server.stop()
+
+    # the stand-in's answers are not taken for the OpenAI API's
+    monkeypatch.setattr(Backend, "_backend", OpenAIBackend())
+    assert asyncio.run(model.aquery(PROMPT)) == f"answer to {PROMPT}" != local_answer
+    assert get_embedding("some text") == [9.0, 1.0] != local_embedding
+    assert chat_api == [PROMPT]
+    assert embedding_api == [["some text"]]
+
+    # a new stand-in server listens elsewhere, but gives the same answers
+    local = LocalBackend()
+    try:
+        monkeypatch.setattr(Backend, "_backend", local)
+        assert asyncio.run(model.aquery(PROMPT)) == local_answer
+        assert get_embedding("some text") == local_embedding
+        assert local.server.requests == 0
+    finally:
+        local.server.stop()
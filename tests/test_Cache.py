@@ -0,0 +1,58 @@
+from upgraider.Cache import PersistentCache, CacheEntry, content_key
+
+
+def test_cache_roundtrip_and_counters(tmp_path):
+    cache = PersistentCache("test", max_entries=10, path=str(tmp_path / "cache.db"))
+
+    assert cache.get("a") is None
+    cache.put("a", b"value")
+    assert cache.get("a") == b"value"
+    assert cache.stats() == {"hits": 1, "misses": 1}
+
+
+def test_cache_lru_eviction(tmp_path):
+    # every use recorded, and evicted as soon as over max_entries
+    cache = PersistentCache(
+        "test",
+        max_entries=2,
+        path=str(tmp_path / "cache.db"),
+        touch_interval=0,
+        eviction_slack=0,
+    )
+
+    cache.put("a", b"1")
+    cache.put("b", b"2")
+    cache.get("a")  # "b" is now the least recently used entry
+    cache.put("c", b"3")
+
+    assert cache.get("b") is None
+    assert cache.get("a") == b"1"
+    assert cache.get("c") == b"3"
+
+
+def test_cache_batches_evictions_and_uses(tmp_path):
+    cache = PersistentCache("test", max_entries=10, path=str(tmp_path / "cache.db"), eviction_slack=0.5)
+
+    for i in range(15):
+        cache.put(str(i), b"value")
+    # within the slack
+    assert len(cache.values()) == 15
+
+    cache.put("15", b"value")
+    assert len(cache.values()) == 10
+    assert cache.get("5") is None
+    assert cache.get("15") == b"value"
+
+    session = cache._session()
+    last_used = session.get(CacheEntry, ("test", "15")).last_used
+    session.close()
+    cache.get("15")
+    session = cache._session()
+    # used too recently to be recorded again
+    assert session.get(CacheEntry, ("test", "15")).last_used == last_used
+    session.close()
+
+
+def test_content_key():
+    assert content_key("model", "text") == content_key("model", "text")
+    assert content_key("model", "text") != content_key("modelt", "ext")
@@ -0,0 +1,183 @@
+import os
+import json
+import random
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text
+from upgraider.Database import (
+    DeprecationComment,
+    LibReleaseNote,
+    unpack_embedding,
+    pack_embedding,
+)
+from upgraider.EmbeddingIndex import IVFIndex
+
+
+def test_pack_roundtrip():
+    embedding = [0.25, -1.0, 3.5]
+    assert unpack_embedding(pack_embedding(embedding)).tolist() == embedding
+
+
+def test_legacy_json_embedding():
+    assert unpack_embedding(json.dumps([0.5, 1.5])).tolist() == [0.5, 1.5]
+    assert unpack_embedding("NULL") is None
+    assert unpack_embedding("null") is None
+    assert unpack_embedding("1.5") is None
+
+
+def test_embedding_matrix(doc_db):
+    session = doc_db.Session()
+    session.add(DeprecationComment(content="a", lib_release_note=1, embedding=[1.0, 0.0]))
+    session.add(DeprecationComment(content="b", lib_release_note=1, embedding=None))
+    session.add(DeprecationComment(content="c", lib_release_note=1, embedding=[0.0, 1.0]))
+    session.commit()
+    # rows written before the binary format hold JSON text
+    session.execute(
+        text("INSERT INTO deprecation_comments (content, embedding) VALUES ('d', '[0.5, 0.5]')")
+    )
+    # failed embeddings were stored as json.dumps(None)
+    session.execute(
+        text("INSERT INTO deprecation_comments (content, embedding) VALUES ('e', 'null')")
+    )
+    session.commit()
+    session.close()
+
+    ids, matrix = doc_db.get_embedding_matrix()
+
+    assert ids.tolist() == [1, 3, 4]
+    assert matrix.dtype == np.float32
+    assert isinstance(matrix, np.memmap)
+    assert matrix.tolist() == [[1.0, 0.0], [0.0, 1.0], [0.5, 0.5]]
+    assert doc_db.get_embedded_doc_sections()[3].tolist() == [0.0, 1.0]
+
+
+def test_embedding_index_cached_until_db_changes(doc_db):
+    session = doc_db.Session()
+    session.add(DeprecationComment(content="a", lib_release_note=1, embedding=[1.0, 0.0]))
+    session.commit()
+
+    index = doc_db.get_embedding_index()
+    assert doc_db.get_embedding_index() is index
+    assert len(index) == 1
+
+    session.add(DeprecationComment(content="b", lib_release_note=1, embedding=[0.0, 1.0]))
+    session.commit()
+    session.close()
+
+    rebuilt = doc_db.get_embedding_index()
+    assert rebuilt is not index
+    assert rebuilt.ids.tolist() == [1, 2]
+
+
+def test_section_contents_bulk_fetch(doc_db, monkeypatch):
+    session = doc_db.Session()
+    for content in ["first", "second", "third"]:
+        session.add(DeprecationComment(content=content, lib_release_note=1))
+    session.commit()
+    session.close()
+
+    assert doc_db.get_section_contents([3, 1, 42]) == {3: "third", 1: "first"}
+
+    # cached contents are served without opening a session
+    monkeypatch.setattr(doc_db, "Session", None)
+    assert doc_db.get_section_content(1) == "first"
+
+
+def test_library_partitions(doc_db):
+    session = doc_db.Session()
+    session.add_all(
+        [
+            LibReleaseNote(id=1, library="pandas", version="1.5.0"),
+            LibReleaseNote(id=2, library="numpy", version="1.24.0"),
+            LibReleaseNote(id=3, library="pandas", version="2.0.0"),
+        ]
+    )
+    for note_id in [1, 2, 3, 2, 1]:
+        session.add(DeprecationComment(content="x", lib_release_note=note_id, embedding=[1.0, 0.0]))
+    session.commit()
+    session.close()
+
+    index = doc_db.get_embedding_index()
+    pandas = index.partition("pandas")
+
+    assert sorted(pandas.ids.tolist()) == [1, 3, 5]
+    assert index.partition("pandas") is pandas
+    assert pandas.matrix.base is not None  # a view of the shared matrix
+    assert index.partition("pandas", ("v1.4.2", "v1.5.3")).ids.tolist() == [1, 5]
+    assert {i for _, i in pandas.top_k([1.0, 0.0])} == {1, 3, 5}
+
+    ivf_index = IVFIndex.build(index, nlist=2)
+    assert {i for _, i in ivf_index.search(pandas, [1.0, 0.0], nprobe=2)} == {1, 3, 5}
+
+
+def test_read_old_schema_without_upgrading(doc_db):
+    session = doc_db.Session()
+    session.execute(text("DROP TABLE section_release_notes"))
+    session.execute(text("DROP TABLE deprecation_comments"))
+    session.execute(
+        text(
+            "CREATE TABLE deprecation_comments (id INTEGER PRIMARY KEY, "
+            "lib_release_note INTEGER, content VARCHAR, embedding TEXT)"
+        )
+    )
+    session.execute(
+        text(
+            "INSERT INTO deprecation_comments (lib_release_note, content, embedding) "
+            "VALUES (1, 'old section', '[1.0, 0.0]')"
+        )
+    )
+    session.commit()
+    session.close()
+    missing = doc_db.missing_schema()
+
+    assert doc_db.get_sections([1]) == {1: doc_db.Section("old section", None)}
+    assert doc_db.get_embedding_index().ids.tolist() == [1]
+    assert doc_db.get_bm25_index().ids.tolist() == [1]
+    # reading leaves the DB as it was
+    assert doc_db.missing_schema() == missing
+
+    doc_db.upgrade_schema()
+    assert doc_db.missing_schema() == []
+
+
+def test_get_sections_from_threads(doc_db, monkeypatch):
+    session = doc_db.Session()
+    for i in range(200):
+        session.add(DeprecationComment(content=f"section {i}", lib_release_note=1, num_tokens=2))
+    session.commit()
+    session.close()
+    # far smaller than what the threads ask for, so they keep evicting each other's sections
+    monkeypatch.setattr(doc_db, "SECTION_CONTENT_CACHE_SIZE", 16)
+
+    def request(seed):
+        rng = random.Random(seed)
+        incomplete = 0
+        for _ in range(50):
+            section_ids = rng.sample(range(1, 201), 30)
+            sections = doc_db.get_sections(section_ids)
+            if set(sections) != set(section_ids):
+                incomplete += 1
+        return incomplete
+
+    with ThreadPoolExecutor(8) as threads:
+        assert sum(threads.map(request, range(8))) == 0
+
+
+def test_indexes_rebuilt_from_threads(doc_db):
+    session = doc_db.Session()
+
+    def use_indexes(_):
+        assert len(doc_db.get_embedding_index()) == num_sections
+        assert len(doc_db.get_quantized_index("int8")) == num_sections
+        assert len(doc_db.get_bm25_index().ids) == num_sections
+
+    for num_sections in range(1, 6):
+        # the sidecars are stale every round
+        session.add(DeprecationComment(content=f"section {num_sections}", lib_release_note=1, embedding=[1.0, float(num_sections)]))
+        session.commit()
+        with ThreadPoolExecutor(16) as threads:
+            list(threads.map(use_indexes, range(16)))
+    session.close()
+
+    sidecar_dir = os.path.dirname(doc_db.DB_PATH)
+    assert [name for name in os.listdir(sidecar_dir) if name.endswith(".tmp")] == []
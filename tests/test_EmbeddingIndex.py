@@ -0,0 +1,96 @@
+import numpy as np
+from upgraider.EmbeddingIndex import (
+    EmbeddingIndex,
+    IVFIndex,
+    QuantizedMatrix,
+    ranking_recall,
+)
+
+
+def _index():
+    return EmbeddingIndex.from_sections(
+        {
+            10: [1.0, 0.0],
+            11: [0.0, 1.0],
+            12: [0.6, 0.8],
+            13: [-1.0, 0.0],
+        }
+    )
+
+
+def test_top_k_matches_full_sort():
+    index = _index()
+    query = [0.8, 0.6]
+    expected = sorted(
+        [(float(np.dot(query, index.sections[i])), i) for i in index.sections],
+        reverse=True,
+    )
+
+    ranked = index.top_k(query)
+    assert [i for _, i in ranked] == [i for _, i in expected]
+    assert np.allclose([s for s, _ in ranked], [s for s, _ in expected])
+    assert [i for _, i in index.top_k(query, k=2)] == [12, 10]
+
+
+def test_top_k_threshold_and_batch():
+    index = _index()
+    assert [i for _, i in index.top_k([1.0, 0.0], threshold=0.5)] == [10, 12]
+
+    batch = index.top_k([[1.0, 0.0], [0.0, 1.0]], k=1)
+    assert [[i for _, i in result] for result in batch] == [[10], [11]]
+
+
+def test_top_k_empty_index():
+    assert EmbeddingIndex.from_sections({}).top_k([1.0, 0.0], k=3) == []
+
+
+def _random_index(n=500, dim=16, seed=0):
+    rng = np.random.default_rng(seed)
+    matrix = rng.normal(size=(n, dim)).astype(np.float32)
+    matrix /= np.linalg.norm(matrix, axis=1, keepdims=True)
+    return EmbeddingIndex(np.arange(100, 100 + n), matrix)
+
+
+def test_ivf_search_probing_all_clusters_is_exact():
+    index = _random_index()
+    ivf_index = IVFIndex.build(index, nlist=10)
+    query = index.matrix[7]
+
+    assert ivf_index.search(index, query, k=5, nprobe=10) == index.top_k(query, k=5)
+    assert ivf_index.search(index, query, k=1, nprobe=1)[0][1] == 107
+    assert ivf_index.recall(index, index.matrix[:20], k=5, nprobe=10) == 1.0
+
+
+def test_ivf_save_load(tmp_path):
+    index = _random_index()
+    ivf_index = IVFIndex.build(index, nlist=8)
+    path = str(tmp_path / "index.npz")
+    ivf_index.save(path)
+
+    loaded = IVFIndex.load(path)
+    assert loaded.matches(index)
+    assert loaded.search(index, index.matrix[3], k=3, nprobe=2) == ivf_index.search(
+        index, index.matrix[3], k=3, nprobe=2
+    )
+
+
+def test_quantized_top_k_matches_exact():
+    index = _random_index(n=2000, dim=32)
+    queries = index.matrix[:50] + 0.05
+
+    exact = index.top_k(queries, k=5)
+    for dtype in ["float16", "int8"]:
+        quantized = QuantizedMatrix.quantize(index.matrix, dtype)
+        assert quantized.nbytes < index.matrix.nbytes
+        assert ranking_recall(exact, index.with_quantized(quantized).top_k(queries, k=5)) > 0.95
+
+
+def test_quantized_partition():
+    index = _random_index(n=10)
+    index.note_links = np.array([(row, 1 if row < 5 else 2) for row in range(10)])
+    index.notes = {1: ("a", "1.0"), 2: ("b", "1.0")}
+    quantized_index = index.with_quantized(QuantizedMatrix.quantize(index.matrix, "int8"))
+
+    partition = quantized_index.partition("b")
+    assert len(partition.quantized) == 5
+    assert {i for _, i in partition.top_k(index.matrix[7], k=1)} == {107}
@@ -0,0 +1,130 @@
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+from upgraider import VenvPool as venv_pool_module
+from upgraider.VenvPool import set_venv_pool
+from upgraider.ForkServer import ForkServerExecutor
+from upgraider.run_code import run_code
+from upgraider.Cache import PersistentCache
+from apiexploration.Library import Library
+from tests.test_VenvPool import FakeInstallPool
+
+SNIPPETS = {
+    "ok.py": "import fakelib\nprint(fakelib.__version__)\n",
+    "future_warning.py": "import warnings\nwarnings.warn('fakelib.old is deprecated since 1.0', FutureWarning)\n",
+    "deprecation_warning.py": "import warnings\nwarnings.warn('fakelib.older has been deprecated for a while', DeprecationWarning)\n",
+    "attribute_error.py": "import fakelib\nfakelib.removed_function()\n",
+    "type_error.py": "def f():\n    pass\n\nf(x=1)\n",
+    "exit.py": "import sys\nsys.exit(3)\n",
+    "leaks.py": (
+        "import os\n"
+        "import fakelib\n"
+        "assert not hasattr(fakelib, 'patched')\n"
+        "assert not os.path.exists('leftover.txt')\n"
+        "fakelib.patched = True\n"
+        "open('leftover.txt', 'w').write('x')\n"
+    ),
+}
+
+
+class CountingInstallPool(FakeInstallPool):
+    """
+    Installs a fakelib that records each time it is imported.
+    """
+
+    def __init__(self, root: str, imports_file: str):
+        super().__init__(root)
+        self.imports_file = imports_file
+
+    def module_source(self, version: str) -> str:
+        return super().module_source(version) + (
+            f"open({self.imports_file!r}, 'a').write('import\\n')\n"
+        )
+
+
+@pytest.fixture
+def library(tmp_path, monkeypatch):
+    monkeypatch.setattr(venv_pool_module, "_venv_pool", None)
+    set_venv_pool(CountingInstallPool(str(tmp_path / "pool"), str(tmp_path / "imports.txt")))
+    return Library(name="fakelib", ghurl="", baseversion="0.1", currentversion="1.0")
+
+
+@pytest.fixture
+def snippets(tmp_path):
+    snippets = {}
+    for name, code in SNIPPETS.items():
+        path = tmp_path / name
+        path.write_text(code)
+        snippets[name] = str(path)
+    return snippets
+
+
+def test_same_results_as_new_interpreters(library, snippets):
+    executor = ForkServerExecutor()
+    try:
+        for name, file in snippets.items():
+            expected = run_code(library, file, None)
+            # twice, to check nothing carries over between runs
+            for _ in range(2):
+                actual = run_code(library, file, None, executor=executor)
+                assert actual == expected, name
+    finally:
+        executor.close()
+
+    assert executor.stats() == {"workers": 1, "runs": 2 * len(SNIPPETS)}
+
+
+def test_library_imported_once(library, snippets, tmp_path):
+    executor = ForkServerExecutor()
+    try:
+        for _ in range(3):
+            assert run_code(library, snippets["ok.py"], None, executor=executor).problem_free
+    finally:
+        executor.close()
+
+    assert (tmp_path / "imports.txt").read_text().splitlines() == ["import"]
+
+
+def test_concurrent_runs(library, snippets):
+    executor = ForkServerExecutor()
+    try:
+        with ThreadPoolExecutor(4) as threads:
+            results = list(
+                threads.map(
+                    lambda name: run_code(library, snippets[name], None, executor=executor),
+                    ["ok.py", "attribute_error.py"] * 4,
+                )
+            )
+    finally:
+        executor.close()
+
+    assert [result.problem_free for result in results] == [True, False] * 4
+
+
+class ImportWarningInstallPool(FakeInstallPool):
+    """
+    Installs a fakelib that warns about a deprecation when imported.
+    """
+
+    def module_source(self, version: str) -> str:
+        return super().module_source(version) + (
+            "import warnings\n"
+            "warnings.warn('fakelib.old is deprecated since 1.0', FutureWarning, stacklevel=2)\n"
+        )
+
+
+def test_run_results_recorded_per_mode(tmp_path, monkeypatch, snippets):
+    monkeypatch.setattr(venv_pool_module, "_venv_pool", None)
+    set_venv_pool(ImportWarningInstallPool(str(tmp_path / "pool")))
+    library = Library(name="fakelib", ghurl="", baseversion="0.1", currentversion="1.0")
+    cache = PersistentCache("run_results", 100, path=str(tmp_path / "cache.db"))
+
+    executor = ForkServerExecutor()
+    try:
+        for _ in range(2):
+            # the fork server imported fakelib before the snippet ran
+            assert run_code(library, snippets["ok.py"], None, cache=cache, executor=executor).problem_free
+            assert not run_code(library, snippets["ok.py"], None, cache=cache).problem_free
+    finally:
+        executor.close()
+
+    assert cache.stats() == {"hits": 2, "misses": 2}
@@ -203,3 +203,267 @@ List of reference numbers used:
     result = parse_model_response(response, CodeSnippet(code=original_code))
     assert result.update_status == UpdateStatus.UPDATE
     assert result.reason == f"- {reason1}\n- {reason2}"
+
+
+
+def test_aquery_limits_requests_in_flight(chat_api, monkeypatch):
+    import asyncio
+    import openai
+    from upgraider.Model import Model
+
+    in_flight = []
+    max_in_flight = []
+    acreate = openai.ChatCompletion.acreate
+
+    async def tracked_acreate(messages, model, **params):
+        in_flight.append(1)
+        max_in_flight.append(len(in_flight))
+        response = await acreate(messages, model, **params)
+        in_flight.pop()
+        return response
+
+    monkeypatch.setattr(openai.ChatCompletion, "acreate", tracked_acreate)
+    model = Model("gpt-4", max_in_flight=3)
+
+    async def query_all():
+        return await asyncio.gather(*[model.aquery(f"prompt {i}") for i in range(10)])
+
+    assert asyncio.run(query_all()) == [f"answer to prompt {i}" for i in range(10)]
+    assert max(max_in_flight) == 3
+    # a new event loop gets its own semaphore; answers now come from the cache
+    assert asyncio.run(query_all())[0] == "answer to prompt 0"
+    assert len(chat_api) == 10
+
+
+def test_response_cache_and_replay(chat_api):
+    import asyncio
+    import pytest
+    from upgraider.Model import Model, CacheMode, ResponseNotRecorded
+
+    model = Model("gpt-4")
+
+    async def query_all(prompts):
+        return await asyncio.gather(*[model.aquery(prompt) for prompt in prompts])
+
+    # identical prompts in flight at the same time share one request
+    assert asyncio.run(query_all(["a", "a", "b", "a"])) == [
+        "answer to a",
+        "answer to a",
+        "answer to b",
+        "answer to a",
+    ]
+    assert sorted(chat_api) == ["a", "b"]
+
+    replay_model = Model("gpt-4", cache_mode=CacheMode.replay)
+    assert replay_model.query("b") == "answer to b"
+    with pytest.raises(ResponseNotRecorded):
+        asyncio.run(replay_model.aquery("c"))
+    assert len(chat_api) == 2
+
+    # recorded responses are per model
+    assert asyncio.run(Model("gpt-3.5-turbo-0125").aquery("a")) == "answer to a"
+    assert len(chat_api) == 3
+
+
+STREAMED_ANSWER = """1. ```python
+import networkx as nx
+G = nx.from_numpy_array(A)
+```
+2. Reason for update: from_numpy_matrix was removed in networkx 3.0
+3. 1, 2
+Explanation: the function `from_numpy_matrix` was deprecated and later removed.
+```python
+G = nx.from_numpy_matrix(A)
+```
+"""
+
+
+def test_streaming_parser_stops_after_numbered_items():
+    from upgraider.Model import StreamingResponseParser
+
+    parser = StreamingResponseParser()
+    for i, char in enumerate(STREAMED_ANSWER):
+        if parser.feed(char):
+            break
+
+    assert parser.code_complete and parser.reason_complete and parser.complete
+    assert parser.result == STREAMED_ANSWER[: STREAMED_ANSWER.index("Explanation")]
+    assert i == len(parser.result) - 1
+
+    response = parser.response(CodeSnippet(code="G = nx.from_numpy_matrix(A)"))
+    assert response.update_status == UpdateStatus.UPDATE
+    assert response.updated_code.code.endswith("G = nx.from_numpy_array(A)")
+    assert response.reason == "from_numpy_matrix was removed in networkx 3.0"
+    assert response.references == "1, 2"
+
+
+def test_streaming_parser_reference_lists():
+    from upgraider.Model import StreamingResponseParser
+
+    parser = StreamingResponseParser()
+    answer = "1. ```\n```\n2. None\n3. References used:\n- 1\n- 3\n\nThe rest"
+    assert parser.feed(answer)
+    assert parser.result == "1. ```\n```\n2. None\n3. References used:\n- 1\n- 3\n\n"
+
+    # "3." inside the code block does not end the answer
+    parser = StreamingResponseParser()
+    assert not parser.feed("1. ```python\n3. x = 1\n")
+    assert not parser.feed("```\n2. reason\n3. No references used")
+    assert parser.feed("\nmore")
+    assert parser.result.endswith("3. No references used\n")
+
+    parser = StreamingResponseParser()
+    assert not parser.feed("The code does not need to be updated.\n")
+    assert parser.result == "The code does not need to be updated.\n"
+
+
+def test_streamed_query_stops_early(tmp_path, chat_api):
+    import asyncio
+    import time
+    from upgraider.Model import Model, CacheMode, LLM_API_PARAMS
+    from upgraider.Backend import OpenAICompatibleBackend, chat_request_key
+    from upgraider.Retry import RetryingBackend
+    from upgraider.Cache import PersistentCache
+    from upgraider.standin_server import StandInServer
+
+    model = Model("gpt-4", cache_mode=CacheMode.read_write, stream=True)
+    recordings = PersistentCache("responses", 10, path=str(tmp_path / "recordings.db"))
+    recordings.put(
+        chat_request_key("gpt-4", model._messages("prompt"), LLM_API_PARAMS),
+        (STREAMED_ANSWER + "More explanation. " * 200).encode("utf-8"),
+    )
+
+    server = StandInServer(token_latency=0.002, recordings=recordings).start()
+    try:
+        model._backend = RetryingBackend(OpenAICompatibleBackend(server.url))
+        answer = asyncio.run(model.aquery("prompt"))
+        assert answer == STREAMED_ANSWER[: STREAMED_ANSWER.index("Explanation")]
+
+        for _ in range(100):
+            if server.cancelled:
+                break
+            time.sleep(0.01)
+        assert server.cancelled == 1
+        assert model._backend.stats()["failures"] == 0
+    finally:
+        server.stop()
+
+    # the truncated answer is recorded
+    replay_model = Model("gpt-4", cache_mode=CacheMode.replay)
+    replay_model._backend = model._backend
+    assert replay_model.query("prompt") == answer
+
+
+def test_streamed_batch_waits_for_every_snippet(chat_api):
+    import asyncio
+    from upgraider.Model import Model, CacheMode, parse_batch_response
+    from upgraider.Backend import Backend
+
+    batch_answer = (
+        "### Snippet 1\n"
+        + STREAMED_ANSWER[: STREAMED_ANSWER.index("Explanation")]
+        + "### Snippet 2\n"
+        + STREAMED_ANSWER
+    )
+
+    class BatchStreamBackend(Backend):
+        async def achat_stream(self, messages, model, **params):
+            for line in (batch_answer + "More explanation.\n" * 20).splitlines(True):
+                yield line
+
+    model = Model("gpt-4", cache_mode=CacheMode.read_write, stream=True)
+    model._backend = BatchStreamBackend()
+
+    answer = asyncio.run(model.aquery("batch prompt", sections=2))
+    assert answer == batch_answer[: batch_answer.rindex("Explanation")]
+    original_code = CodeSnippet(code="G = nx.from_numpy_matrix(A)")
+    responses = parse_batch_response(answer, [original_code, original_code])
+    assert [response.update_status for response in responses] == [UpdateStatus.UPDATE] * 2
+    assert [response.references for response in responses] == ["1, 2"] * 2
+
+    # the recorded answer holds both snippets
+    replay_model = Model("gpt-4", cache_mode=CacheMode.replay)
+    replay_model._backend = model._backend
+    assert replay_model.query("batch prompt") == answer
+
+
+def test_streamed_query_of_empty_completion(chat_api):
+    import asyncio
+    from upgraider.Model import Model, CacheMode
+    from upgraider.Backend import Backend
+
+    class EmptyStreamBackend(Backend):
+        async def achat_stream(self, messages, model, **params):
+            return
+            yield
+
+    model = Model("gpt-4", cache_mode=CacheMode.read_write, stream=True)
+    model._backend = EmptyStreamBackend()
+
+    assert asyncio.run(model.aquery("prompt")) == ""
+
+
+def test_failed_requests_give_back_their_tokens(chat_api):
+    import asyncio
+    import pytest
+    from upgraider.Model import Model
+    from upgraider.Backend import Backend
+    from upgraider.RateLimiter import RateLimiter
+
+    class FailingBackend(Backend):
+        def chat(self, messages, model, **params):
+            raise ConnectionError("down")
+
+        async def achat(self, messages, model, **params):
+            raise ConnectionError("down")
+
+        async def achat_stream(self, messages, model, **params):
+            yield "1. "
+            raise ConnectionError("down")
+
+    limiter = RateLimiter(tokens_per_minute=10**6)
+    for stream in (False, True):
+        model = Model("gpt-4", rate_limiter=limiter, stream=stream)
+        model._backend = FailingBackend()
+        with pytest.raises(ConnectionError):
+            model.query("prompt")
+        with pytest.raises(ConnectionError):
+            asyncio.run(model.aquery("prompt"))
+
+    assert limiter.tokens.level == pytest.approx(10**6)
+
+
+def test_parser_matches_legacy_parser():
+    from benchmark.parse_responses import find_mismatches
+    from benchmark.response_corpus import build_corpus, library_examples
+
+    corpus = build_corpus(3000, seed=0, examples=library_examples())
+    assert find_mismatches(corpus) == []
+
+
+def test_rescore_report(tmp_path):
+    import json
+    from benchmark.parse_responses import rescore_report
+
+    snippet = {
+        "model_response": {
+            "raw_response": "1. ```python\nimport c\n```\n2. b was renamed\n3. 1\n",
+            "update_status": "NO_RESPONSE",
+            "references": None,
+            "updated_code": {"code": None, "filename": None},
+            "reason": None,
+            "original_code": {"code": "import b", "filename": "b.py"},
+        },
+        "fix_status": "NOT_FIXED",
+    }
+    report_path = tmp_path / "lib" / "doc" / "report.json"
+    report_path.parent.mkdir(parents=True)
+    report_path.write_text(json.dumps({"snippets": {"b.py": snippet}, "num_updated": 0, "num_updated_w_refs": 0}))
+
+    assert rescore_report(str(report_path), dry_run=False) == (1, 1)
+    report = json.loads(report_path.read_text())
+    assert report["snippets"]["b.py"]["model_response"]["update_status"] == "UPDATE"
+    assert report["snippets"]["b.py"]["model_response"]["reason"] == "b was renamed"
+    assert report["num_updated"] == report["num_updated_w_refs"] == 1
+
+    assert rescore_report(str(report_path), dry_run=False) == (1, 0)
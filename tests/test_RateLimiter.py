@@ -0,0 +1,51 @@
+import threading
+import pytest
+from upgraider.RateLimiter import RateLimiter, TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("upgraider.RateLimiter.time.monotonic", lambda: now[0])
+    return now
+
+
+def test_token_bucket(clock):
+    bucket = TokenBucket(per_minute=60)
+
+    assert bucket.reserve(60) == 0.0
+    assert bucket.reserve(3) == pytest.approx(3.0)
+    clock[0] += 3
+    assert bucket.reserve(1) == pytest.approx(1.0)
+
+
+def test_rate_limiter_waits_for_tightest_quota(clock):
+    limiter = RateLimiter(requests_per_minute=600, tokens_per_minute=6000)
+
+    assert limiter.reserve(6000) == 0.0
+    assert limiter.reserve(500) == pytest.approx(5.0)
+
+    # unused tokens of the previous reservations are given back
+    limiter.refund(500)
+    assert limiter.reserve(100) == pytest.approx(1.0)
+
+
+def test_token_bucket_shared_between_threads(clock):
+    bucket = TokenBucket(per_minute=10**6)
+
+    def reserve_many():
+        for _ in range(1000):
+            bucket.reserve(1)
+            bucket.refund(0.5)
+
+    threads = [threading.Thread(target=reserve_many) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert bucket.level == 10**6 - 8 * 1000 * 0.5
+
+
+def test_unlimited():
+    assert RateLimiter().reserve(10**9) == 0.0
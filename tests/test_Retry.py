@@ -0,0 +1,113 @@
+import asyncio
+import openai
+import pytest
+from upgraider.Backend import Backend, LocalBackend
+from upgraider.Retry import (
+    AimdController,
+    RetryingBackend,
+    RetryPolicy,
+    quota_reset,
+    retry_after,
+)
+
+
+def test_rate_limit_headers():
+    assert retry_after({"Retry-After": "2"}) == 2.0
+    assert retry_after({"retry-after-ms": "250"}) == 0.25
+    assert retry_after({"Retry-After": "Wed, 21 Oct 2015 07:28:00 GMT"}) is None
+    assert retry_after({}) is None
+
+    assert quota_reset({"x-ratelimit-remaining-requests": "3", "x-ratelimit-reset-requests": "1s"}) is None
+    assert quota_reset(
+        {
+            "x-ratelimit-remaining-requests": "0",
+            "x-ratelimit-reset-requests": "6m0s",
+            "x-ratelimit-remaining-tokens": "0",
+            "x-ratelimit-reset-tokens": "20ms",
+        }
+    ) == 360.0
+
+
+def test_aimd_controller():
+    controller = AimdController(max_limit=8)
+    tickets = [controller.start() for _ in range(4)]
+
+    # a burst of throttles from requests sent at the same limit halves it once
+    for ticket in tickets:
+        controller.done(ticket, throttled=True)
+    assert controller.concurrency == 4
+
+    ticket = controller.start()
+    controller.done(ticket, throttled=True)
+    assert controller.concurrency == 2
+
+    # grows back by about one per round of successful requests
+    for _ in range(3):
+        controller.done(controller.start(), success=True)
+    assert controller.concurrency == 3
+    for _ in range(30):
+        controller.done(controller.start(), success=True)
+    assert controller.concurrency == 8
+    assert controller.in_flight == 0
+
+
+def test_retries_throttled_requests():
+    inner = LocalBackend(error_rate=0.5, retry_after=0.01, seed=1)
+    backend = RetryingBackend(inner, policy=RetryPolicy(max_retries=20, base_delay=0.01, seed=0))
+    try:
+        for i in range(10):
+            assert backend.embed(f"text {i}", "text-embedding-ada-002")["data"]
+
+        stats = backend.stats()
+        assert stats["requests"] == inner.server.requests
+        assert stats["retries"] == stats["throttles"] == inner.server.errors > 0
+        assert stats["failures"] == 0
+        assert stats["qps"] > 0
+    finally:
+        inner.server.stop()
+
+
+class FlakyBackend(Backend):
+    """
+    Rate limits requests while more than `capacity` are in flight.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_flight = 0
+        self.peak = 0
+
+    async def achat(self, messages, model, **params):
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        try:
+            await asyncio.sleep(0.01)
+            if self.in_flight > self.capacity:
+                raise openai.error.RateLimitError("Too many requests", headers={"Retry-After": "0.01"})
+            return {"choices": [{"message": {"content": "answer"}}]}
+        finally:
+            self.in_flight -= 1
+
+    def embed(self, input, model):
+        raise openai.error.InvalidRequestError("Bad input", None)
+
+
+def test_adapts_concurrency():
+    inner = FlakyBackend(capacity=2)
+    backend = RetryingBackend(inner, policy=RetryPolicy(max_retries=20, base_delay=0.01, seed=0))
+
+    async def chat_all():
+        return await asyncio.gather(*[backend.achat([], "gpt-4") for _ in range(30)])
+
+    assert len(asyncio.run(chat_all())) == 30
+    assert inner.peak == 8
+    assert backend.throttles > 0
+    assert backend.controller.concurrency < 8
+
+
+def test_does_not_retry_invalid_requests():
+    backend = RetryingBackend(FlakyBackend(capacity=1))
+    with pytest.raises(openai.error.InvalidRequestError):
+        backend.embed("text", "text-embedding-ada-002")
+    assert backend.stats()["retries"] == 0
+    assert backend.stats()["failures"] == 1
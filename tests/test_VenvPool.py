@@ -0,0 +1,168 @@
+import os
+import subprocess
+import threading
+import pytest
+from upgraider import VenvPool as venv_pool_module
+from upgraider.VenvPool import VenvPool, VenvBuildError, set_venv_pool
+from upgraider.run_code import run_code
+from apiexploration.Library import Library
+
+
+class FakeInstallPool(VenvPool):
+    """
+    Builds venvs without pip, and "installs" a library by writing a module
+    and its package metadata into the venv, so no network is needed.
+    `installed_versions` maps a library to the version actually installed.
+    """
+
+    def __init__(self, root: str, installed_versions: dict = None, **kwargs):
+        super().__init__(root, **kwargs)
+        self.installed_versions = installed_versions or {}
+
+    def _create(self, path: str):
+        subprocess.run(
+            [self.python, "-m", "venv", "--without-pip", path],
+            check=True,
+            capture_output=True,
+            text=True,
+        )
+
+    def _install(self, python, library, version, requirements_file):
+        version = self.installed_versions.get(library, version)
+        purelib = subprocess.run(
+            [python, "-c", "import sysconfig; print(sysconfig.get_paths()['purelib'])"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        dist_info = os.path.join(purelib, f"{library}-{version}.dist-info")
+        os.makedirs(dist_info)
+        with open(os.path.join(dist_info, "METADATA"), "w") as f:
+            f.write(f"Metadata-Version: 2.1\nName: {library}\nVersion: {version}\n")
+        with open(os.path.join(purelib, f"{library}.py"), "w") as f:
+            f.write(self.module_source(version))
+
+    def module_source(self, version: str) -> str:
+        return f"__version__ = {version!r}\n"
+
+
+def test_environment_built_once_and_reused(tmp_path):
+    pool = FakeInstallPool(str(tmp_path))
+
+    with pool.acquire("fakelib", "1.0") as environment:
+        version = subprocess.run(
+            [environment.python, "-c", "import fakelib; print(fakelib.__version__)"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    with pool.acquire("fakelib", "1.0") as reused:
+        pass
+
+    assert version == "1.0"
+    assert reused.path == environment.path
+    assert pool.stats() == {"builds": 1, "reuses": 1}
+
+
+def test_environment_keyed_by_requirements(tmp_path):
+    requirements = tmp_path / "requirements.txt"
+    requirements.write_text("numpy\n")
+    pool = FakeInstallPool(str(tmp_path / "pool"))
+
+    with pool.acquire("fakelib", "1.0") as environment:
+        pass
+    with pool.acquire("fakelib", "1.0", str(requirements)) as with_requirements:
+        pass
+
+    assert with_requirements.key.requirements_hash != environment.key.requirements_hash
+    assert with_requirements.path != environment.path
+    assert pool.stats()["builds"] == 2
+
+
+def test_wrong_version_is_not_kept(tmp_path):
+    pool = FakeInstallPool(str(tmp_path), installed_versions={"fakelib": "2.0"})
+
+    with pytest.raises(VenvBuildError):
+        with pool.acquire("fakelib", "1.0"):
+            pass
+
+    assert pool.environments() == []
+    assert os.listdir(tmp_path) == []
+
+
+def test_evicts_least_recently_used_unless_in_use(tmp_path):
+    pool = FakeInstallPool(str(tmp_path), max_environments=2)
+
+    with pool.acquire("fakelib", "1.0") as in_use:
+        with pool.acquire("fakelib", "2.0"):
+            pass
+        # 1.0 is least recently used but in use, so 2.0 goes instead
+        with pool.acquire("fakelib", "3.0"):
+            pass
+        assert os.path.exists(in_use.python)
+
+    versions = sorted(manifest["version"] for _, manifest in pool.environments())
+    assert versions == ["1.0", "3.0"]
+
+    # 1.0 is no longer in use and now the least recently used
+    with pool.acquire("fakelib", "4.0"):
+        pass
+    versions = sorted(manifest["version"] for _, manifest in pool.environments())
+    assert versions == ["3.0", "4.0"]
+    # evicted environments leave no lock files behind
+    assert sorted(name for name in os.listdir(tmp_path) if name.endswith(".lock")) == sorted(
+        f"{os.path.basename(path)}.lock" for path, _ in pool.environments()
+    )
+
+
+def test_concurrent_acquires_build_once(tmp_path):
+    pool = FakeInstallPool(str(tmp_path))
+    paths = []
+
+    def use():
+        with pool.acquire("fakelib", "1.0") as environment:
+            paths.append(environment.path)
+
+    threads = [threading.Thread(target=use) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(paths)) == 1
+    assert pool.stats() == {"builds": 1, "reuses": 3}
+
+
+def test_run_code_in_pooled_environment(tmp_path, monkeypatch):
+    monkeypatch.setattr(venv_pool_module, "_venv_pool", None)
+    set_venv_pool(FakeInstallPool(str(tmp_path / "pool")))
+    library = Library(name="fakelib", ghurl="", baseversion="0.1", currentversion="1.0")
+
+    writes_file = tmp_path / "writes_file.py"
+    writes_file.write_text(
+        "import os\n"
+        "import fakelib\n"
+        "assert not os.path.exists('leftover.txt')\n"
+        "open('leftover.txt', 'w').write(fakelib.__version__)\n"
+    )
+    missing_attribute = tmp_path / "missing_attribute.py"
+    missing_attribute.write_text("import fakelib\nfakelib.removed_function()\n")
+
+    first = run_code(library, str(writes_file), None)
+    # the previous run's files are not visible
+    second = run_code(library, str(writes_file), None)
+    failing = run_code(library, str(missing_attribute), None)
+
+    assert first.problem_free and second.problem_free
+    assert not failing.problem_free
+    assert failing.problem.name == "AttributeError"
+    assert failing.problem.element_name == "'removed_function'"
+
+
+def test_library_json_versions_match_installed_versions(tmp_path):
+    pool = FakeInstallPool(str(tmp_path), installed_versions={"fakelib": "2.0.0"})
+
+    with pool.acquire("fakelib", "v2.0") as environment:
+        pass
+
+    assert environment.key.version == "v2.0"
@@ -0,0 +1,152 @@
+import pytest
+from sqlalchemy import text
+from upgraider import populate_doc_db
+from upgraider.populate_doc_db import (
+    deduplicate_sections,
+    prepare_db,
+    parse_release_note,
+    parse_release_notes,
+    register_roles,
+    update_library,
+)
+
+
+@pytest.fixture
+def library_dir(tmp_path):
+    register_roles()
+    (tmp_path / "releasenotes").mkdir()
+    return tmp_path
+
+
+def _write_note(library_dir, items, name="v1.5.0.rst"):
+    rst = "Deprecations\n------------\n\n" + "".join(f"- {item}\n" for item in items)
+    (library_dir / "releasenotes" / name).write_text(rst)
+
+
+def _contents(doc_db):
+    session = doc_db.Session()
+    contents = sorted(c.content for c in session.query(doc_db.DeprecationComment))
+    session.close()
+    return contents
+
+
+def test_incremental_ingestion(doc_db, embedding_api, library_dir):
+    session = doc_db.Session()
+    update = lambda dry_run=False: update_library(
+        session, "pandas", str(library_dir), dry_run=dry_run, concurrency=1, workers=1
+    )
+
+    _write_note(library_dir, ["First item is deprecated.", "Second item is deprecated."])
+    assert update() is True
+    assert len(embedding_api) == 1
+    assert update() is False  # unchanged file
+
+    _write_note(library_dir, ["First item is deprecated.", "Third item is deprecated."])
+    assert update(dry_run=True) is True
+    assert _contents(doc_db) == ["First item is deprecated.", "Second item is deprecated."]
+
+    assert update() is True
+    assert _contents(doc_db) == ["First item is deprecated.", "Third item is deprecated."]
+    assert embedding_api[-1] == ["Third item is deprecated."]
+
+    (library_dir / "releasenotes" / "v1.5.0.rst").unlink()
+    assert update() is True
+    assert _contents(doc_db) == []
+    session.close()
+
+
+def test_cross_version_deduplication(doc_db, embedding_api, library_dir):
+    _write_note(library_dir, ["Shared item is deprecated.", "Only in 1.5.0."], name="v1.5.0.rst")
+    _write_note(library_dir, ["Shared item is\n  deprecated.", "Only in 1.5.1."], name="v1.5.1.rst")
+
+    session = doc_db.Session()
+    update_library(session, "pandas", str(library_dir), dry_run=False, concurrency=1, workers=1)
+    sections = {c.content: c.id for c in session.query(doc_db.DeprecationComment)}
+
+    assert len(sections) == 3
+    assert sum(len(texts) for texts in embedding_api) == 3
+    shared_id = sections.get("Shared item is deprecated.") or sections["Shared item is\ndeprecated."]
+    assert doc_db.get_sections([shared_id])[shared_id].releases == (
+        ("pandas", "1.5.0"),
+        ("pandas", "1.5.1"),
+    )
+
+    partition = doc_db.get_embedding_index().partition("pandas", ("1.5.1", "1.5.1"))
+    assert sorted(partition.ids.tolist()) == sorted([shared_id, sections["Only in 1.5.1."]])
+    assert [i for _, i in doc_db.get_bm25_index().search("shared", note_ids=partition.note_ids)] == [shared_id]
+
+    (library_dir / "releasenotes" / "v1.5.0.rst").unlink()
+    update_library(session, "pandas", str(library_dir), dry_run=False, concurrency=1, workers=1)
+    assert len(_contents(doc_db)) == 2
+    assert doc_db.get_sections([shared_id])[shared_id].releases == (("pandas", "1.5.1"),)
+    session.close()
+
+
+def test_deduplicate_legacy_sections(doc_db):
+    session = doc_db.Session()
+    session.add_all(
+        [
+            doc_db.DeprecationComment(id=1, content="Old  text.", lib_release_note=1),
+            doc_db.DeprecationComment(id=2, content="Old text.", lib_release_note=2),
+            doc_db.DeprecationComment(id=3, content="Other text.", lib_release_note=2),
+            doc_db.ApiSymbol(symbol="old_api", deprecation_comment=2),
+        ]
+    )
+    session.commit()
+
+    deduplicate_sections(session)
+
+    assert [c.id for c in session.query(doc_db.DeprecationComment)] == [1, 3]
+    assert doc_db.get_section_release_notes(session) == {1: [1, 2], 3: [2]}
+    assert [s.deprecation_comment for s in session.query(doc_db.ApiSymbol)] == [1]
+    session.close()
+
+
+def test_dry_run_leaves_schema_alone(doc_db, monkeypatch):
+    monkeypatch.setattr(populate_doc_db, "Session", doc_db.Session)
+    session = doc_db.Session()
+    session.execute(text("DROP TABLE deprecation_comments"))
+    session.execute(
+        text(
+            "CREATE TABLE deprecation_comments (id INTEGER PRIMARY KEY, "
+            "lib_release_note INTEGER, content VARCHAR, embedding TEXT)"
+        )
+    )
+    session.commit()
+    session.close()
+    missing = doc_db.missing_schema()
+    assert "deprecation_comments.num_tokens" in missing
+
+    assert prepare_db(dry_run=True) is False
+    assert doc_db.missing_schema() == missing
+
+    assert prepare_db(dry_run=False) is True
+    assert doc_db.missing_schema() == []
+
+
+def test_parse_release_note_sections():
+    register_roles()
+    items = parse_release_note(
+        "Release 1.0\n===========\n\n"
+        "Deprecations\n------------\n\n"
+        "- Simple item with :issue:`123`.\n\n"
+        "Passing ``a`` is deprecated:\n\n"
+        ".. code-block:: python\n\n    f(a=1)\n\n"
+        "Bug fixes\n---------\n\n"
+        "- Not a deprecation.\n"
+    )
+    assert [item.content for item in items] == [
+        "Simple item with 123.",
+        "Passing a is deprecated:\nf(a=1)",
+    ]
+
+
+def test_parse_release_notes_in_processes(library_dir):
+    _write_note(library_dir, ["First item is deprecated."], name="v1.0.0.rst")
+    _write_note(library_dir, ["Second item is deprecated."], name="v2.0.0.rst")
+
+    parsed = dict(parse_release_notes(str(library_dir), ["v1.0.0.rst", "v2.0.0.rst"], workers=2))
+    assert {note: [item.content for item in items] for note, items in parsed.items()} == {
+        "v1.0.0.rst": ["First item is deprecated."],
+        "v2.0.0.rst": ["Second item is deprecated."],
+    }
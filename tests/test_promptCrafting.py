@@ -0,0 +1,81 @@
+from upgraider import promptCrafting
+from apiexploration.Library import Library
+
+
+def test_get_embeddings_batches_by_tokens(embedding_api, monkeypatch):
+    monkeypatch.setattr(promptCrafting, "EMBEDDING_BATCH_MAX_TOKENS", 6)
+    texts = ["one two three", "four five six", "seven"]
+
+    embeddings = promptCrafting.get_embeddings(texts, concurrency=2)
+
+    assert embeddings == [[13.0, 1.0], [13.0, 1.0], [5.0, 1.0]]
+    assert len(embedding_api) == 2
+
+
+def test_get_embedding_uses_cache(embedding_api):
+    assert promptCrafting.get_embedding("some code") == [9.0, 1.0]
+    assert promptCrafting.get_embeddings(["some code"]) == [[9.0, 1.0]]
+    assert len(embedding_api) == 1
+    assert promptCrafting.embedding_cache.stats() == {"hits": 1, "misses": 1}
+
+
+def test_bm25_references_without_embeddings(doc_db):
+    session = doc_db.Session()
+    session.add_all(
+        [
+            doc_db.LibReleaseNote(id=1, library="networkx", version="3.0"),
+            doc_db.LibReleaseNote(id=2, library="pandas", version="2.0.0"),
+            doc_db.DeprecationComment(
+                content="from_numpy_matrix was removed, use from_numpy_array instead",
+                lib_release_note=1,
+            ),
+            doc_db.DeprecationComment(
+                content="from_numpy_matrix is not a pandas function at all",
+                lib_release_note=2,
+            ),
+        ]
+    )
+    session.commit()
+    session.close()
+
+    references = promptCrafting.get_reference_list(
+        "G = nx.from_numpy_matrix(A)",
+        retrieval=promptCrafting.RetrievalOptions(
+            retriever=promptCrafting.Retriever.bm25
+        ),
+        library=Library(name="networkx", ghurl="", baseversion="2.8.2", currentversion="3.0"),
+    )
+
+    assert references == [
+        "\n1. from_numpy_matrix was removed, use from_numpy_array instead"
+    ]
+
+
+def test_references_packed_by_stored_token_counts(doc_db, monkeypatch):
+    session = doc_db.Session()
+    session.add_all(
+        [
+            doc_db.DeprecationComment(content="first reference", num_tokens=30),
+            doc_db.DeprecationComment(content="second reference", num_tokens=50),
+            doc_db.DeprecationComment(content="third reference", num_tokens=10),
+            doc_db.DeprecationComment(content="tiny", num_tokens=1),
+        ]
+    )
+    session.commit()
+    session.close()
+
+    monkeypatch.setattr(promptCrafting, "separator_len", 2)
+    monkeypatch.setattr(
+        promptCrafting,
+        "rank_document_sections",
+        lambda *args, **kwargs: [(1.0, 1), (0.9, 2), (0.8, 4), (0.7, 3)],
+    )
+
+    references = promptCrafting.get_reference_list("code", token_budget=50)
+
+    assert references == ["\n1. first reference", "\n2. third reference"]
+
+
+def test_reference_budget_fits_context_window():
+    assert promptCrafting.reference_token_budget("gpt-4", "x = 1") == promptCrafting.MAX_REFERENCE_TOKENS
+    assert promptCrafting.reference_token_budget("gpt-4", "x = 1\n" * 5000) == 0
@@ -0,0 +1,44 @@
+from upgraider import VenvPool as venv_pool_module
+from upgraider.VenvPool import set_venv_pool
+from upgraider.Cache import PersistentCache
+from upgraider.Report import ProblemType
+from upgraider.run_code import run_code
+from apiexploration.Library import Library
+from tests.test_VenvPool import FakeInstallPool
+
+
+def test_run_results_recorded_per_code_and_environment(tmp_path, monkeypatch):
+    monkeypatch.setattr(venv_pool_module, "_venv_pool", None)
+    set_venv_pool(FakeInstallPool(str(tmp_path / "pool")))
+    cache = PersistentCache("run_results", 100, path=str(tmp_path / "cache.db"))
+    library = Library(name="fakelib", ghurl="", baseversion="0.1", currentversion="1.0")
+
+    # counts its runs in a file outside the run's overlay
+    runs_file = tmp_path / "runs.txt"
+    example = tmp_path / "example.py"
+    example.write_text(
+        f"open({str(runs_file)!r}, 'a').write('run\\n')\n"
+        "import warnings\n"
+        "warnings.warn('fakelib.old is deprecated since 1.0', FutureWarning)\n"
+    )
+
+    def num_runs():
+        return len(runs_file.read_text().splitlines())
+
+    first = run_code(library, str(example), None, cache=cache)
+    reused = run_code(library, str(example), None, cache=cache)
+    assert num_runs() == 1
+    assert reused == first
+    assert reused.problem.type.value == ProblemType.DEPRECATION_WARNING.value
+
+    # a new library version is a different environment
+    newer = Library(name="fakelib", ghurl="", baseversion="0.1", currentversion="2.0")
+    run_code(newer, str(example), None, cache=cache)
+    assert num_runs() == 2
+
+    # as is changed code
+    example.write_text(example.read_text() + "print('changed')\n")
+    run_code(library, str(example), None, cache=cache)
+    assert num_runs() == 3
+
+    assert cache.stats() == {"hits": 1, "misses": 3}
@@ -1,4 +1,8 @@
-from upgraider.upgraide import _fix_imports
+import asyncio
+from upgraider.upgraide import _fix_imports, pack_batches, Upgraider
+from upgraider.Model import Model, CacheMode, parse_batch_response
+from upgraider.Backend import Backend, LocalBackend
+from upgraider.Report import UpdateStatus
 from apiexploration.Library import CodeSnippet
 
 
@@ -46,3 +50,92 @@ print("hello there")
     fixed_code = _fix_imports(CodeSnippet(code=old_code), CodeSnippet(code=new_code))
     assert "from modulex import y as z" in fixed_code.code
     assert "from pandas import Index" in fixed_code.code
+
+
+def test_pack_batches():
+    assert pack_batches([10, 10, 10, 10], header_tokens=5, token_budget=30, max_batch_size=8) == [[0, 1], [2, 3]]
+    assert pack_batches([10, 10, 10], header_tokens=0, token_budget=100, max_batch_size=2) == [[0, 1], [2]]
+    # too large to share a prompt
+    assert pack_batches([10, 50, 10], header_tokens=0, token_budget=30, max_batch_size=8) == [[0], [1], [2]]
+
+
+def test_parse_batch_response():
+    snippets = [CodeSnippet(code="import a"), CodeSnippet(code="import b")]
+    answer = """### Snippet 1
+1. ```python
+import a
+```
+2. No update needed
+3. No references used
+
+### Snippet 2
+1. ```python
+import c
+```
+2. Reason for update: b was renamed to c
+3. 1
+"""
+    first, second = parse_batch_response(answer, snippets)
+    assert first.update_status == UpdateStatus.NO_UPDATE
+    assert second.update_status == UpdateStatus.UPDATE
+    assert second.updated_code.code == "import c"
+    assert second.reason == "b was renamed to c"
+    assert second.references == "1"
+
+    assert parse_batch_response(answer.split("### Snippet 2")[0], snippets) is None
+    assert parse_batch_response("1. ```python\nimport a\n```", snippets) is None
+
+
+class FixedAnswerBackend(Backend):
+    def __init__(self, answer: str):
+        self.answer = answer
+        self.prompts = []
+
+    async def achat(self, messages, model, **params):
+        self.prompts.append(messages[-1]["content"])
+        return {"choices": [{"message": {"content": self.answer}}]}
+
+
+def _fix_all(upgraider, code_snippets):
+    async def fix_all():
+        return [
+            model_response
+            async for model_response in upgraider.aupgraide_all(
+                code_snippets, library=None, use_references=False
+            )
+        ]
+
+    return asyncio.run(fix_all())
+
+
+def test_batched_prompts():
+    code_snippets = [
+        CodeSnippet(filename=f"example{i}.py", code=f"import pandas\nprint({i})") for i in range(5)
+    ]
+    backend = LocalBackend()
+    try:
+        model = Model("gpt-4", cache_mode=CacheMode.off, backend=backend)
+        model_responses = _fix_all(Upgraider(model, batch_tokens=4000, max_batch_size=3), code_snippets)
+    finally:
+        backend.server.stop()
+
+    assert backend.server.requests == 2
+    assert sorted(r.original_code.filename for r in model_responses) == [s.filename for s in code_snippets]
+    for model_response in model_responses:
+        assert model_response.update_status == UpdateStatus.NO_UPDATE
+        assert model_response.updated_code.code == model_response.original_code.code
+        assert "### Snippet 3" in model_response.prompt or "### Snippet 2" in model_response.prompt
+
+
+def test_batched_prompts_fall_back_to_single_prompts():
+    code_snippets = [CodeSnippet(filename=f"example{i}.py", code=f"print({i})") for i in range(3)]
+    backend = FixedAnswerBackend("No update needed")
+    model = Model("gpt-4", cache_mode=CacheMode.off, backend=backend)
+
+    model_responses = _fix_all(Upgraider(model, batch_tokens=4000), code_snippets)
+
+    assert len(backend.prompts) == 4
+    assert "### Snippet 3" in backend.prompts[0]
+    assert all("### Snippet" not in prompt for prompt in backend.prompts[1:])
+    assert len(model_responses) == 3
+    assert all(r.update_status == UpdateStatus.NO_UPDATE for r in model_responses)